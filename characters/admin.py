@@ -1,18 +1,27 @@
 from django.contrib import admin
+
+from core.admin import HighVolumeAdmin
 from .models import CharacterSheet, CharacterEquipment
 
 
 @admin.register(CharacterSheet)
-class CharacterSheetAdmin(admin.ModelAdmin):
+class CharacterSheetAdmin(HighVolumeAdmin):
     list_display = ("name", "player", "system", "controlled_by")
-    list_filter = ("system", "player")
-    search_fields = ("name",)
+    # Фильтр по игроку заменен поиском: выпадающий список всех пользователей
+    # не масштабируется
+    list_filter = ("system", ("controlled_by", admin.EmptyFieldListFilter))
+    list_select_related = ("player", "system", "controlled_by")
+    search_fields = ("name", "player__username")
+    autocomplete_fields = ("player", "system", "controlled_by", "traits", "features")
 
 
 @admin.register(CharacterEquipment)
-class CharacterEquipmentAdmin(admin.ModelAdmin):
+class CharacterEquipmentAdmin(HighVolumeAdmin):
     list_display = ("get_character_name", "template", "quantity", "location")
-    list_filter = ("character", "template", "location")
+    list_filter = ("location", "template__system")
+    list_select_related = ("character", "template__system")
+    search_fields = ("character__name", "template__name")
+    autocomplete_fields = ("character", "template", "parent_equipment")
 
     # Метод, чтобы красиво отображать имя персонажа
     def get_character_name(self, obj):
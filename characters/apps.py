@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CharactersConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "characters"
+
+    def ready(self):
+        # Подключаем сигналы, перестраивающие документы листов
+        from . import signals  # noqa: F401
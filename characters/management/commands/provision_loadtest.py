@@ -0,0 +1,145 @@
+import json
+import math
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from characters.models import CharacterEquipment, CharacterSheet
+from characters.services import CharacterStateService, SheetDocumentService
+from core.models import CharacterTrait, EquipmentTemplate, Feature, GameSystem
+
+USERNAME_PREFIX = "loadtest-"
+# Сколько первых страниц каталога листают игроки
+BROWSE_PAGES = 5
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates load-test players with character sheets in a game system and "
+        "writes a manifest for run_loadtest. Never run this against production."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--system", type=str, required=True, help="Slug of the game system."
+        )
+        parser.add_argument("--players", type=int, default=50)
+        parser.add_argument("--sheets-per-player", type=int, default=3)
+        parser.add_argument("--password", type=str, default="loadtest")
+        parser.add_argument(
+            "--output",
+            type=str,
+            default="loadtest.json",
+            help="Where to write the manifest (users, password, sheet IDs).",
+        )
+        parser.add_argument(
+            "--cleanup",
+            action="store_true",
+            help="Delete previously provisioned players and their sheets and exit.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        deleted, _ = User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+        if options["cleanup"]:
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} objects."))
+            return
+
+        try:
+            system = GameSystem.objects.get(slug=options["system"])
+        except GameSystem.DoesNotExist:
+            raise CommandError(f"Game system '{options['system']}' not found.")
+
+        rnd = random.Random(options["seed"])
+        # По одной корневой черте каждой категории: формулы ищут черту по категории
+        traits_by_category = {}
+        for trait_id, category in CharacterTrait.objects.filter(
+            system=system, parent__isnull=True
+        ).values_list("id", "category__name"):
+            traits_by_category.setdefault(category, []).append(trait_id)
+        # И по одному предмету в каждый слот
+        templates_by_location = {}
+        for template_id, metadata in EquipmentTemplate.objects.filter(
+            system=system
+        ).values_list("id", "metadata"):
+            location = (metadata or {}).get("location")
+            if location:
+                templates_by_location.setdefault(location, []).append(template_id)
+
+        with transaction.atomic():
+            # Хэш пароля считаем один раз: он намеренно медленный
+            password = make_password(options["password"])
+            users = User.objects.bulk_create(
+                User(username=f"{USERNAME_PREFIX}{index:05d}", password=password)
+                for index in range(options["players"])
+            )
+            sheets = CharacterSheet.objects.bulk_create(
+                CharacterSheet(
+                    player=user,
+                    system=system,
+                    name=f"Load test hero {index}",
+                    stats={"level": rnd.randint(1, 10)},
+                )
+                for user in users
+                for index in range(options["sheets_per_player"])
+            )
+
+            Through = CharacterSheet.traits.through
+            Through.objects.bulk_create(
+                Through(charactersheet=sheet, charactertrait_id=rnd.choice(traits))
+                for sheet in sheets
+                for traits in traits_by_category.values()
+            )
+            CharacterEquipment.objects.bulk_create(
+                CharacterEquipment(
+                    character=sheet,
+                    template_id=rnd.choice(templates),
+                    location=location,
+                )
+                for sheet in sheets
+                for location, templates in templates_by_location.items()
+            )
+
+            state_service = CharacterStateService()
+            for sheet in sheets:
+                state_service.recalculate_and_save(sheet)
+            sheet_ids = [sheet.pk for sheet in sheets]
+            documents = SheetDocumentService()
+            for start in range(0, len(sheet_ids), documents.batch_size):
+                documents.rebuild(sheet_ids[start : start + documents.batch_size])
+
+        sheets_by_player = {}
+        for sheet in sheets:
+            sheets_by_player.setdefault(sheet.player_id, []).append(sheet.pk)
+        page_size = settings.REST_FRAMEWORK["PAGE_SIZE"]
+
+        def pages(count):
+            return max(1, min(BROWSE_PAGES, math.ceil(count / page_size)))
+
+        manifest = {
+            "password": options["password"],
+            "system": {
+                "id": system.pk,
+                "categories": sorted(traits_by_category),
+                # Эндпоинты особенностей и экипировки отдают каталог всех систем
+                "feature_pages": pages(Feature.objects.count()),
+                "equipment_pages": pages(EquipmentTemplate.objects.count()),
+            },
+            "players": [
+                {"username": user.username, "sheets": sheets_by_player[user.pk]}
+                for user in users
+            ],
+        }
+        with open(options["output"], "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Created {len(users)} players with {len(sheets)} sheets; "
+                f"manifest written to {options['output']}."
+            )
+        )
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from characters.models import CharacterSheet
+from characters.services import SheetDocumentService
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds pre-rendered character sheet documents, e.g. after a migration "
+        "or a catalog change made outside the admin, API and seed loader"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--system",
+            type=str,
+            default=None,
+            help="Only rebuild sheets of the game system with this slug.",
+        )
+        parser.add_argument(
+            "--missing",
+            action="store_true",
+            help="Only build documents for sheets that have none yet.",
+        )
+
+    def handle(self, *args, **options):
+        sheets = CharacterSheet.objects.all()
+        if options["system"]:
+            sheets = sheets.filter(system__slug=options["system"])
+        if options["missing"]:
+            sheets = sheets.filter(document__isnull=True)
+
+        service = SheetDocumentService()
+        sheet_ids = list(sheets.values_list("id", flat=True))
+        rebuilt = 0
+        for start in range(0, len(sheet_ids), service.batch_size):
+            # Каждая пачка - в своей транзакции, чтобы не держать блокировки долго
+            with transaction.atomic():
+                rebuilt += len(
+                    service.rebuild(sheet_ids[start : start + service.batch_size])
+                )
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rebuilt} sheet documents."))
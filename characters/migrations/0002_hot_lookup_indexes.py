@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:58
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("characters", "0001_initial"),
+        ("core", "0004_traitcategory_upper_name_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="characterequipment",
+            index=models.Index(
+                fields=["character", "location"], name="charequip_char_location_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="charactersheet",
+            index=models.Index(
+                condition=models.Q(("controlled_by__isnull", True)),
+                fields=["player"],
+                name="charsheet_player_root_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("characters", "0002_hot_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CharacterSheetDocument",
+            fields=[
+                (
+                    "sheet",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="document",
+                        serialize=False,
+                        to="characters.charactersheet",
+                    ),
+                ),
+                (
+                    "content",
+                    models.BinaryField(help_text="Отрендеренный JSON детального листа"),
+                ),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name": "Character Sheet Document",
+                "verbose_name_plural": "Character Sheet Documents",
+            },
+        ),
+    ]
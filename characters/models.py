@@ -67,6 +67,15 @@ class CharacterSheet(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
+        indexes = [
+            # Список "своих" персонажей без питомцев:
+            # filter(player=..., controlled_by__isnull=True)
+            models.Index(
+                fields=["player"],
+                condition=models.Q(controlled_by__isnull=True),
+                name="charsheet_player_root_idx",
+            ),
+        ]
         verbose_name = "Character Sheet"
         verbose_name_plural = "Character Sheets"
 
@@ -107,8 +116,39 @@ class CharacterEquipment(models.Model):
     metadata = models.JSONField(default=dict, blank=True)
 
     class Meta:
+        indexes = [
+            # Поиск предмета персонажа по слоту: equipment.get(location=...)
+            models.Index(
+                fields=["character", "location"], name="charequip_char_location_idx"
+            ),
+        ]
         verbose_name = "Character Equipment"
         verbose_name_plural = "Character Equipment"
 
     def __str__(self):
         return f"{self.quantity} x {self.template.name} ({self.character.name})"
+
+
+class CharacterSheetDocument(models.Model):
+    """
+    Денормализованное детальное представление листа персонажа:
+    готовый JSON (как его отдает CharacterSheetDetailSerializer).
+    Перестраивается при изменении листа, его инвентаря и связанных строк
+    каталога, чтобы чтение листа было одним запросом по первичному ключу.
+    """
+
+    sheet = models.OneToOneField(
+        CharacterSheet,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="document",
+    )
+    content = models.BinaryField(help_text="Отрендеренный JSON детального листа")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Character Sheet Document"
+        verbose_name_plural = "Character Sheet Documents"
+
+    def __str__(self):
+        return f"Document for sheet {self.sheet_id}"
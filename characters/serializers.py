@@ -1,27 +1,83 @@
 from rest_framework import serializers
 from .models import CharacterSheet, CharacterEquipment
 from core.serializers import (
+    TimedListSerializer,
+    TimedSerializerMixin,
     CharacterTraitSerializer,
     FeatureSerializer,
     EquipmentTemplateSerializer,
 )
+from core.engine.equipment import EquipmentIndex
 from core.models import CharacterTrait, Feature
 
+# Сколько бросков можно запросить за раз через API
+ROLL_LIMIT = 1000
+# Сколько состояний можно включить или снять за раз
+CONDITION_LIMIT = 50
+# Сколько листов можно запросить в одной сводке партии
+PARTY_LIMIT = 50
+# Сколько уровней и альтернативных предметов можно спроецировать за раз
+PROJECTION_LEVEL_LIMIT = 100
+PROJECTION_EQUIPMENT_LIMIT = 20
+# Границы перебираемых значений: с запасом для уровней и статов, но так,
+# чтобы формулы над ними не выходили за int64 при векторном вычислении
+PROJECTION_VALUE_LIMIT = 1_000_000
+# Сколько черт, особенностей и предметов можно передать в предпросмотр
+PREVIEW_ITEM_LIMIT = 200
+
+
+def equipment_index(context, character_id, items=None):
+    """
+    Индекс экипировки листа (см. ``EquipmentIndex``), один на лист в контексте
+    сериализатора: дерево вложений собирается одним запросом, а не по запросу
+    на предмет. ``items`` - уже загруженные предметы листа, если они есть.
+    """
+    indexes = context.setdefault("equipment_indexes", {})
+    if character_id not in indexes:
+        if items is None:
+            items = CharacterEquipment.objects.filter(
+                character_id=character_id
+            ).select_related("template")
+        indexes[character_id] = EquipmentIndex(items)
+    return indexes[character_id]
+
+
+def parse_id_list(value, limit):
+    """'12, 15,19' -> [12, 15, 19]: без повторов, в исходном порядке."""
+    try:
+        ids = [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise serializers.ValidationError("Expected comma-separated IDs")
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > limit:
+        raise serializers.ValidationError(f"At most {limit} IDs per request")
+    return ids
+
 
 class CharacterEquipmentSerializer(serializers.ModelSerializer):
     # При просмотре инвентаря хотим видеть полную инфу о шаблоне предмета
     template = EquipmentTemplateSerializer(read_only=True)
+    # Установленные на предмет вложения (оружие меха, модули) - рекурсивно
+    attachments = serializers.SerializerMethodField()
 
     class Meta:
         model = CharacterEquipment
-        fields = ["id", "template", "quantity", "location", "metadata"]
+        fields = ["id", "template", "quantity", "location", "metadata", "attachments"]
+
+    def get_attachments(self, obj):
+        # Дерево листа собирается в памяти один раз на сериализацию
+        index = equipment_index(self.context, obj.character_id)
+        return CharacterEquipmentSerializer(
+            index.children.get(obj.pk, []), many=True, context=self.context
+        ).data
 
 
-class CharacterSheetListSerializer(serializers.ModelSerializer):
+class CharacterSheetListSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Сериализатор для краткого отображения в списке персонажей."""
 
     class Meta:
         model = CharacterSheet
+        list_serializer_class = TimedListSerializer
         fields = ["id", "name", "system", "stats"]  # Показываем только основное
 
 
@@ -30,7 +86,8 @@ class CharacterSheetDetailSerializer(CharacterSheetListSerializer):
 
     traits = CharacterTraitSerializer(many=True, read_only=True)
     features = FeatureSerializer(many=True, read_only=True)
-    equipment = CharacterEquipmentSerializer(many=True, read_only=True)
+    # Дерево экипировки: предметы верхнего уровня с вложениями внутри
+    equipment = serializers.SerializerMethodField()
 
     # Рекурсивно показываем компаньонов, используя этот же детальный сериализатор
     companions = serializers.SerializerMethodField()
@@ -44,6 +101,14 @@ class CharacterSheetDetailSerializer(CharacterSheetListSerializer):
             "companions",
         ]
 
+    def get_equipment(self, obj):
+        # Все предметы листа приходят одним (prefetch) запросом, дерево
+        # собирается в памяти
+        index = equipment_index(self.context, obj.pk, obj.equipment.all())
+        return CharacterEquipmentSerializer(
+            index.roots, many=True, context=self.context
+        ).data
+
     def get_companions(self, obj):
         # Используем CharacterSheetDetailSerializer для вложенных компаньонов
         return CharacterSheetDetailSerializer(obj.companions.all(), many=True).data
@@ -64,3 +129,275 @@ class CharacterSheetCreateUpdateSerializer(serializers.ModelSerializer):
         model = CharacterSheet
         # `player` будет установлен автоматически, поэтому его здесь нет
         fields = ["id", "name", "system", "traits", "features", "stats", "conditions"]
+
+
+class DiceRollRequestSerializer(serializers.Serializer):
+    """Параметры броска кубиков от имени листа (query-параметры)."""
+
+    expression = serializers.CharField(
+        max_length=200,
+        help_text="Выражение с кубиками, например 2d12+1d6kh1+stat('agility')",
+    )
+    count = serializers.IntegerField(
+        min_value=1,
+        max_value=ROLL_LIMIT,
+        default=1,
+        help_text="Сколько независимых бросков сделать",
+    )
+    threshold = serializers.IntegerField(
+        required=False,
+        help_text="Вернуть вероятность выбросить не меньше этого значения",
+    )
+    distribution = serializers.BooleanField(
+        default=False, help_text="Вернуть полное распределение результатов"
+    )
+
+
+class EligibleFeaturesRequestSerializer(serializers.Serializer):
+    """Фильтры списка доступных листу особенностей (query-параметры)."""
+
+    type = serializers.CharField(
+        required=False,
+        max_length=100,
+        help_text="Только особенности с этим metadata.type, например domain_card",
+    )
+
+
+class DiceDistributionSerializer(serializers.Serializer):
+    min = serializers.IntegerField()
+    max = serializers.IntegerField()
+    mean = serializers.FloatField()
+    stddev = serializers.FloatField()
+    at_least = serializers.FloatField(
+        required=False, help_text="P(результат >= threshold)"
+    )
+    probabilities = serializers.DictField(
+        child=serializers.FloatField(),
+        required=False,
+        help_text="Значение -> вероятность",
+    )
+
+
+class DiceRollSerializer(serializers.Serializer):
+    expression = serializers.CharField()
+    resolved = serializers.CharField(
+        help_text="Выражение после подстановки статов листа"
+    )
+    rolls = serializers.ListField(child=serializers.IntegerField())
+    distribution = DiceDistributionSerializer()
+
+
+class PerformActionSerializer(serializers.Serializer):
+    action_type = serializers.CharField(
+        max_length=100,
+        help_text="Ключ действия из available_actions правил системы (short_rest, level_up...)",
+    )
+
+
+class ConditionsUpdateSerializer(serializers.Serializer):
+    """Состояния, которые нужно включить и снять у листа."""
+
+    add = serializers.ListField(
+        child=serializers.CharField(max_length=100),
+        required=False,
+        default=list,
+        max_length=CONDITION_LIMIT,
+        help_text="Состояния, которые нужно включить, например ['vulnerable']",
+    )
+    remove = serializers.ListField(
+        child=serializers.CharField(max_length=100),
+        required=False,
+        default=list,
+        max_length=CONDITION_LIMIT,
+        help_text="Состояния, которые нужно снять",
+    )
+
+    def validate(self, data):
+        both = set(data["add"]) & set(data["remove"])
+        if both:
+            raise serializers.ValidationError(
+                {"remove": f"Conditions both added and removed: {sorted(both)}"}
+            )
+        return data
+
+
+class PartyRequestSerializer(serializers.Serializer):
+    """Параметры сводки партии (query-параметры)."""
+
+    ids = serializers.CharField(help_text="ID листов через запятую, например 12,15,19")
+    recalculate = serializers.BooleanField(
+        default=False,
+        help_text="Пересчитать вычисляемые статы для ответа (без записи в БД)",
+    )
+
+    def validate_ids(self, value):
+        # Порядок сохраняем: в нем мастер видит партию
+        ids = parse_id_list(value, PARTY_LIMIT)
+        if not ids:
+            raise serializers.ValidationError("At least one sheet ID is required")
+        return ids
+
+
+class PartyTraitSerializer(serializers.ModelSerializer):
+    category = serializers.CharField(source="category.name")
+
+    class Meta:
+        model = CharacterTrait
+        fields = ["id", "name", "category"]
+
+
+class PartyEquipmentSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(source="template.name")
+
+    class Meta:
+        model = CharacterEquipment
+        fields = ["id", "template", "name", "location", "quantity"]
+
+
+class PartyMemberSerializer(serializers.ModelSerializer):
+    """
+    Компактный лист для экрана мастера: статы, состояния, черты и надетые
+    предметы (все, что не лежит в инвентаре). Компаньоны передаются
+    в context["companions"] словарем {ID хозяина: [листы]}.
+    """
+
+    traits = PartyTraitSerializer(many=True, read_only=True)
+    equipped = serializers.SerializerMethodField()
+    companions = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CharacterSheet
+        fields = [
+            "id",
+            "name",
+            "stats",
+            "conditions",
+            "traits",
+            "equipped",
+            "companions",
+        ]
+
+    def get_equipped(self, obj):
+        return PartyEquipmentSerializer(
+            [item for item in obj.equipment.all() if item.location != "inventory"],
+            many=True,
+        ).data
+
+    def get_companions(self, obj):
+        companions = self.context.get("companions", {}).get(obj.pk, [])
+        return PartyMemberSerializer(companions, many=True).data
+
+
+class PartySerializer(serializers.Serializer):
+    members = PartyMemberSerializer(many=True)
+    missing = serializers.ListField(
+        child=serializers.IntegerField(),
+        help_text="Запрошенные ID, которых нет среди листов пользователя",
+    )
+
+
+class ProjectionRequestSerializer(serializers.Serializer):
+    """Параметры проекции статов по уровням (query-параметры)."""
+
+    stat = serializers.CharField(
+        default="level",
+        max_length=100,
+        help_text="Стат, значения которого перебираются (обычно level)",
+    )
+    start = serializers.IntegerField(
+        default=1,
+        min_value=-PROJECTION_VALUE_LIMIT,
+        max_value=PROJECTION_VALUE_LIMIT,
+        help_text="Первое значение",
+    )
+    end = serializers.IntegerField(
+        default=10,
+        min_value=-PROJECTION_VALUE_LIMIT,
+        max_value=PROJECTION_VALUE_LIMIT,
+        help_text="Последнее значение",
+    )
+    equipment = serializers.CharField(
+        required=False,
+        help_text="ID альтернативных предметов через запятую: каждый примеряется "
+        "вместо предмета в своем слоте (metadata.location)",
+    )
+
+    def validate_equipment(self, value):
+        return parse_id_list(value, PROJECTION_EQUIPMENT_LIMIT)
+
+    def validate(self, data):
+        if data["end"] < data["start"]:
+            raise serializers.ValidationError({"end": "Must not be less than start"})
+        if data["end"] - data["start"] >= PROJECTION_LEVEL_LIMIT:
+            raise serializers.ValidationError(
+                {"end": f"At most {PROJECTION_LEVEL_LIMIT} values per request"}
+            )
+        return data
+
+
+class ProjectionEquipmentSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    location = serializers.CharField()
+
+
+class ProjectionVariantSerializer(serializers.Serializer):
+    equipment = ProjectionEquipmentSerializer(
+        allow_null=True, help_text="Примеренный предмет; null - текущая экипировка"
+    )
+    stats = serializers.DictField(
+        child=serializers.ListField(child=serializers.IntegerField()),
+        help_text="Вычисляемые статы: по значению на каждый элемент values",
+    )
+
+
+class ProjectionSerializer(serializers.Serializer):
+    stat = serializers.CharField()
+    values = serializers.ListField(child=serializers.IntegerField())
+    variants = ProjectionVariantSerializer(many=True)
+
+
+class PreviewEquipmentItemSerializer(serializers.Serializer):
+    template = serializers.IntegerField(help_text="ID шаблона предмета")
+    location = serializers.CharField(
+        max_length=50, default="inventory", help_text="Слот предмета"
+    )
+
+
+class PreviewRequestSerializer(serializers.Serializer):
+    """
+    Предлагаемые изменения листа. Переданные связи заменяют текущие целиком,
+    stats дополняют текущие статы.
+    """
+
+    stats = serializers.DictField(required=False, help_text="Измененные статы")
+    traits = serializers.ListField(
+        child=serializers.IntegerField(),
+        required=False,
+        max_length=PREVIEW_ITEM_LIMIT,
+        help_text="ID всех черт листа после изменения",
+    )
+    features = serializers.ListField(
+        child=serializers.IntegerField(),
+        required=False,
+        max_length=PREVIEW_ITEM_LIMIT,
+        help_text="ID всех особенностей листа после изменения",
+    )
+    equipment = PreviewEquipmentItemSerializer(
+        many=True,
+        required=False,
+        max_length=PREVIEW_ITEM_LIMIT,
+        help_text="Вся экипировка листа после изменения",
+    )
+
+
+class PreviewSerializer(serializers.Serializer):
+    stats = serializers.DictField(help_text="Все статы листа после изменений")
+    changed = serializers.DictField(
+        help_text="Статы, значения которых отличаются от сохраненных"
+    )
+    unavailable_features = serializers.ListField(
+        child=serializers.IntegerField(),
+        help_text="Переданные особенности, которые лист с этими чертами "
+        "и уровнем взять не может",
+    )
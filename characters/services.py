@@ -1,4 +1,61 @@
-from core.engine.evaluator import RuleEvaluator
+import copy
+import logging
+import time
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from core.db_router import replica_reads
+from core.engine import conditions, dice, eligibility, vector
+from core.engine.evaluator import PreviewEvaluator, RuleEvaluator
+from core.engine.parser import metadata_value, stat_references
+from core.metrics import RECALCULATIONS, RULE_EVALUATION_DURATION, RULE_EVALUATIONS
+from core.models import CharacterTrait, Feature
+from core.profiling import timed
+
+from .models import CharacterSheet, CharacterEquipment, CharacterSheetDocument
+from .serializers import CharacterSheetDetailSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingDocuments:
+    """
+    ID листов, документы которых нужно перестроить после коммита транзакции.
+    Сам объект регистрируется как on_commit-колбэк своей точки сохранения,
+    поэтому при ее откате Django отбрасывает его вместе с ID.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.ids = set()
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        if self.ids:
+            sheet_ids = set(self.ids)
+            self.ids.clear()
+            self.service.rebuild(sheet_ids)
+
+    @classmethod
+    def registered(cls):
+        """Еще не выполненные колбэки: пары (ID точек сохранения, колбэк)."""
+        for entry in transaction.get_connection().run_on_commit:
+            if isinstance(entry[1], cls) and not entry[1].done:
+                yield entry[0], entry[1]
+
+    @classmethod
+    def current(cls):
+        """Колбэк текущей точки сохранения или None."""
+        savepoint_ids = set(transaction.get_connection().savepoint_ids)
+        for sids, pending in cls.registered():
+            if sids == savepoint_ids:
+                return pending
+        return None
 
 
 class CharacterStateService:
@@ -6,15 +63,44 @@ class CharacterStateService:
     Сервис для управления состоянием и вычисляемыми параметрами персонажа.
     """
 
-    def recalculate_and_save(self, character):
+    @timed("recalc")
+    def recalculate_and_save(self, character, changed_stats=None):
         """
         Пересчитывает все вычисляемые параметры персонажа и сохраняет их.
         Этот метод является идемпотентным - его можно безопасно вызывать много раз.
+        ``changed_stats`` - см. ``recalculate``.
+        """
+        previous_stats = character.stats
+        updated_stats = self.recalculate(character, changed_stats=changed_stats)
+        system_slug = character.system.slug
+        if updated_stats == previous_stats:
+            # Ничего не изменилось - лишняя запись в БД (и перестройка документа)
+            # не нужна
+            RECALCULATIONS.labels(system_slug, "skipped").inc()
+            return character
+
+        character.save(update_fields=["stats"])
+        RECALCULATIONS.labels(system_slug, "written").inc()
+
+        return character
+
+    def recalculate(self, character, changed_stats=None, evaluator=None):
         """
-        print(f"--- Recalculating stats for Character ID: {character.id} ---")
+        Вычисляет статы персонажа в памяти, без записи в БД: ``character.stats``
+        заменяется новым словарем, который и возвращается. Вычисляемые статы
+        идут в порядке схемы и видят уже пересчитанные значения предыдущих.
 
+        ``changed_stats`` - имена статов, измененных с прошлого пересчета
+        (черты и экипировка при этом не менялись). Тогда пересчитываются только
+        статы, формулы которых читают их через stat() - напрямую или через
+        другие изменившиеся вычисляемые статы.
+
+        ``evaluator`` - готовый вычислитель для этого листа (например,
+        PreviewEvaluator); по умолчанию RuleEvaluator по связям листа.
+        """
         # Инициализируем наш движок правил для конкретного персонажа
-        evaluator = RuleEvaluator(character)
+        if evaluator is None:
+            evaluator = RuleEvaluator(character)
 
         # Получаем схему вычисляемых статов из правил игровой системы
         # Убеждаемся, что работаем со словарем, даже если в metadata ничего нет
@@ -22,14 +108,22 @@ class CharacterStateService:
         computed_stats_schema = schema.get("computed_stats", {})
 
         if not computed_stats_schema:
-            print("No computed_stats schema found. Exiting.")
+            logger.debug("No computed_stats schema for character %s", character.id)
             # Если для этой системы нет вычисляемых статов, ничего не делаем
-            return character
+            return character.stats
 
         # Создаем копию объекта stats, чтобы изменять ее
         # Это хорошая практика, чтобы не менять объект "на лету"
-        updated_stats = character.stats.copy()
-        print(f"Initial stats: {updated_stats}")
+        previous_stats = character.stats
+        updated_stats = previous_stats.copy()
+        character.stats = updated_stats
+        dirty = set(changed_stats) if changed_stats is not None else None
+
+        # Модификаторы состояний - последний слой: формулы видят базовые значения
+        modifiers = self.condition_modifiers(evaluator, character)
+        conditions.apply(updated_stats, modifiers, sign=-1)
+
+        system_slug = character.system.slug
 
         # Проходим по каждому вычисляемому стату, описанному в схеме
         for stat_name, rule in computed_stats_schema.items():
@@ -38,20 +132,721 @@ class CharacterStateService:
                 continue
 
             try:
+                if dirty is not None and not (
+                    stat_references(evaluator.compiled_formula(formula)) & dirty
+                ):
+                    continue
+                start = time.perf_counter()
                 # Вычисляем новое значение с помощью нашего движка
                 new_value = evaluator.evaluate(formula)
-                # Записываем результат в наш обновленный словарь stats
-                updated_stats[stat_name] = new_value
             except ValueError as e:
-                # В будущем здесь можно будет добавить логирование ошибок
-                print(
-                    f"Error evaluating formula for '{stat_name}' on character {character.id}: {e}"
+                RULE_EVALUATIONS.labels(system_slug, stat_name, "error").inc()
+                logger.warning(
+                    "Failed to evaluate %s for character %s: %s",
+                    stat_name,
+                    character.id,
+                    e,
+                    extra={
+                        "system": system_slug,
+                        "stat": stat_name,
+                        "formula": formula,
+                        "character_id": character.id,
+                    },
                 )
                 # Пропускаем этот стат, но не прерываем весь процесс
                 continue
+            RULE_EVALUATION_DURATION.labels(system_slug, stat_name).observe(
+                time.perf_counter() - start
+            )
+            RULE_EVALUATIONS.labels(system_slug, stat_name, "ok").inc()
 
-        print(f"Final calculated stats: {updated_stats}")
-        character.stats = updated_stats
-        character.save(update_fields=["stats"])
+            if dirty is not None and updated_stats.get(stat_name) != new_value:
+                dirty.add(stat_name)
+            # Записываем результат в наш обновленный словарь stats
+            updated_stats[stat_name] = new_value
 
-        return character
+        conditions.apply(updated_stats, modifiers)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Recalculated character %s: %s -> %s",
+                character.id,
+                previous_stats,
+                updated_stats,
+                extra={"character_id": character.id, "system": system_slug},
+            )
+        return updated_stats
+
+    @staticmethod
+    def condition_modifiers(evaluator, character):
+        """Суммарные модификаторы активных состояний листа по статам."""
+        if evaluator.rules is None or not character.conditions:
+            return {}
+        return conditions.get_table(evaluator.rules).totals(character.conditions)
+
+    def sheets_affected_by_catalog_changes(self, report):
+        """
+        Возвращает ID листов, на вычисляемые статы которых могли повлиять
+        изменения каталога из отчета загрузчика (core.loader.loader.LoadReport).
+        """
+        if report.system is None or report.skipped:
+            return set()
+        if report.rules_changed:
+            # Изменились сами формулы - пересчитываем все листы системы
+            return set(
+                CharacterSheet.objects.filter(system=report.system).values_list(
+                    "id", flat=True
+                )
+            )
+
+        trait_ids = (
+            report.changed_ids["character_trait"]
+            | report.deleted_ids["character_trait"]
+        )
+        template_ids = (
+            report.changed_ids["equipment_template"]
+            | report.deleted_ids["equipment_template"]
+        )
+        sheet_ids = set()
+        if trait_ids:
+            sheet_ids.update(
+                CharacterSheet.objects.filter(traits__in=trait_ids).values_list(
+                    "id", flat=True
+                )
+            )
+        if template_ids:
+            sheet_ids.update(
+                CharacterEquipment.objects.filter(
+                    template_id__in=template_ids
+                ).values_list("character_id", flat=True)
+            )
+        return sheet_ids
+
+    batch_size = 500
+
+    @staticmethod
+    def with_rules_context(queryset):
+        """
+        Загружает вместе с листами все, что читают формулы: систему, черты
+        с категориями и экипировку с шаблонами. Вычислитель берет их из
+        prefetch, и пересчет любого числа листов стоит фиксированного числа
+        запросов.
+        """
+        return queryset.select_related("system").prefetch_related(
+            "traits__category", "equipment__template"
+        )
+
+    @timed("recalc")
+    def recalculate_many(self, characters):
+        """
+        Пересчитывает листы (загруженные через ``with_rules_context``) в памяти
+        и записывает изменившиеся одним bulk_update. Возвращает изменившиеся листы.
+        """
+        changed = []
+        for character in characters:
+            previous_stats = character.stats
+            if self.recalculate(character) == previous_stats:
+                RECALCULATIONS.labels(character.system.slug, "skipped").inc()
+            else:
+                RECALCULATIONS.labels(character.system.slug, "written").inc()
+                changed.append(character)
+        if changed:
+            now = timezone.now()
+            for character in changed:
+                character.updated_at = now
+            CharacterSheet.objects.bulk_update(changed, ["stats", "updated_at"])
+            # bulk_update не отправляет post_save: документы планируем сами
+            SheetDocumentService().schedule([character.pk for character in changed])
+        return changed
+
+    def recalculate_sheets(self, sheet_ids):
+        """Пересчитывает набор листов по их ID пакетами."""
+        ids = sorted(sheet_ids)
+        for start in range(0, len(ids), self.batch_size):
+            self.recalculate_many(
+                self.with_rules_context(
+                    CharacterSheet.objects.filter(
+                        pk__in=ids[start : start + self.batch_size]
+                    )
+                )
+            )
+
+
+class ProjectionService:
+    """
+    Проекция вычисляемых статов листа по диапазону значений одного стата
+    (обычно уровня) и по альтернативным предметам, без записи в БД.
+    Каждая формула вычисляется один раз над массивом "варианты x значения".
+    """
+
+    def project(self, sheet, stat, values, templates=()):
+        """
+        ``values`` - значения стата ``stat``, ``templates`` - шаблоны предметов:
+        каждый дает вариант, где он заменяет предмет в слоте metadata.location.
+        Первый вариант - текущая экипировка листа.
+        """
+        evaluator = RuleEvaluator(sheet)
+        computed_stats = evaluator.rules_schema.get("character_sheet_schema", {}).get(
+            "computed_stats", {}
+        )
+        values = np.asarray(list(values), dtype=np.int64)
+        shape = (len(templates) + 1, len(values))
+        results = {}
+        # Как при пересчете: формулы видят статы без модификаторов состояний
+        modifiers = CharacterStateService.condition_modifiers(evaluator, sheet)
+        base_stats = dict(sheet.stats or {})
+        conditions.apply(base_stats, modifiers, sign=-1)
+
+        def lookup(call):
+            _, func, args = call
+            if func == "stat" and args[0] == stat:
+                return values
+            if func == "stat" and args[0] in results:
+                return results[args[0]]
+            if func == "stat":
+                try:
+                    return int(base_stats.get(args[0], 0))
+                except (TypeError, ValueError):
+                    return 0
+            if func == "equipment_meta":
+                location, path = args
+                current = evaluator.call(func, args)
+                return np.array(
+                    [current]
+                    + [
+                        (
+                            metadata_value(template.metadata, path)
+                            if (template.metadata or {}).get("location") == location
+                            else current
+                        )
+                        for template in templates
+                    ]
+                )[:, None]
+            return evaluator.call(func, args)
+
+        for stat_name, rule in computed_stats.items():
+            formula = rule.get("formula")
+            if not formula or stat_name == stat:
+                continue
+            invalid = np.zeros(shape, dtype=bool)
+            try:
+                result = vector.evaluate(
+                    evaluator.compiled_formula(formula), lookup, invalid
+                )
+            except ValueError as e:
+                logger.warning(
+                    "Failed to project %s for character %s: %s",
+                    stat_name,
+                    sheet.id,
+                    e,
+                    extra={
+                        "stat": stat_name,
+                        "formula": formula,
+                        "character_id": sheet.id,
+                    },
+                )
+                continue
+            # Как при пересчете: стат, который не удалось вычислить, сохраняет
+            # текущее значение
+            previous = lookup((None, "stat", (stat_name,)))
+            results[stat_name] = np.broadcast_to(
+                np.where(invalid, previous, result).astype(np.int64), shape
+            )
+
+        for stat_name, value in modifiers.items():
+            if stat_name in results:
+                results[stat_name] = results[stat_name] + value
+
+        variants = [None] + [
+            {
+                "id": template.pk,
+                "name": template.name,
+                "location": (template.metadata or {}).get("location"),
+            }
+            for template in templates
+        ]
+        return {
+            "stat": stat,
+            "values": values.tolist(),
+            "variants": [
+                {
+                    "equipment": equipment,
+                    "stats": {
+                        name: result[index].tolist() for name, result in results.items()
+                    },
+                }
+                for index, equipment in enumerate(variants)
+            ],
+        }
+
+
+class PreviewError(Exception):
+    """Предлагаемые изменения ссылаются на черты или предметы вне каталога."""
+
+    def __init__(self, detail):
+        super().__init__(detail)
+        self.detail = detail
+
+
+class PreviewService:
+    """
+    Предпросмотр изменений листа из конструктора персонажа: вычисляемые статы
+    после предлагаемой смены черт, экипировки и статов, без записи в БД.
+    Черты и предметы берутся из каталога правил в памяти процесса
+    (``PreviewEvaluator``), доступность особенностей - из индекса
+    ``core.engine.eligibility``, поэтому запросы нужны только для загрузки
+    самого листа и тех связей, которые не переданы в изменениях.
+    """
+
+    def preview(self, sheet, stats=None, traits=None, features=None, equipment=None):
+        """
+        ``stats`` дополняют статы листа, ``traits``, ``features`` и ``equipment``
+        (пары (location, template_id)) заменяют связи листа целиком; None -
+        оставить как есть. Лист в памяти не меняется.
+        """
+        if traits is None:
+            traits = list(sheet.traits.values_list("pk", flat=True))
+        if equipment is None:
+            equipment = list(
+                sheet.equipment.order_by("pk").values_list("location", "template_id")
+            )
+
+        current_stats = sheet.stats or {}
+        # Копия листа: recalculate заменяет stats у переданного объекта
+        preview = copy.copy(sheet)
+        preview.stats = {**current_stats, **(stats or {})}
+        evaluator = PreviewEvaluator(preview, traits, equipment)
+        unknown_traits = [
+            trait_id for trait_id in traits if evaluator.rules.trait(trait_id) is None
+        ]
+        if unknown_traits:
+            raise PreviewError({"traits": f"Unknown traits: {unknown_traits}"})
+        unknown_equipment = [
+            template_id
+            for _, template_id in equipment
+            if evaluator.rules.equipment_template(template_id) is None
+        ]
+        if unknown_equipment:
+            raise PreviewError({"equipment": f"Unknown equipment: {unknown_equipment}"})
+
+        preview_stats = CharacterStateService().recalculate(
+            preview, evaluator=evaluator
+        )
+
+        unavailable = []
+        if features:
+            index = eligibility.get_index(sheet.system)
+            try:
+                level = int(preview_stats.get(eligibility.LEVEL_STAT) or 0)
+            except (TypeError, ValueError):
+                level = 0
+            eligible = set(
+                index.feature_ids_of(
+                    index.eligible_mask(traits, level, user_id=sheet.player_id)
+                    & index.mask_of(features)
+                )
+            )
+            unavailable = [
+                feature_id for feature_id in features if feature_id not in eligible
+            ]
+
+        return {
+            "stats": preview_stats,
+            "changed": {
+                name: value
+                for name, value in preview_stats.items()
+                if current_stats.get(name) != value
+            },
+            "unavailable_features": unavailable,
+        }
+
+
+class ActionError(Exception):
+    """Действие не описано в правилах системы или недоступно персонажу."""
+
+
+class ActionExecutionService:
+    """
+    Выполняет игровые действия (короткий отдых, повышение уровня...),
+    описанные в ``available_actions`` правил системы::
+
+        "available_actions": {
+            "level_up": {
+                "label": "Level Up",
+                "requires": "10 - stat('level')",
+                "effects": [{"op": "add", "stat": "level", "formula": "1"}]
+            },
+            "short_rest": {
+                "label": "Short Rest",
+                "effects": [
+                    {"op": "subtract", "stat": "hp_marked", "roll": "1d4 + 1",
+                     "min": "0"}
+                ]
+            }
+        }
+
+    ``requires`` - формула, которая должна быть больше нуля. Эффект меняет стат
+    (``set``, ``add``, ``subtract``) на значение формулы (``formula``) или броска
+    кубиков (``roll``, см. ``core.engine.dice``), с необязательными границами
+    ``min``/``max``. Эффекты применяются по порядку в памяти - каждый видит
+    результат предыдущих, - затем пересчитываются только зависящие от них
+    вычисляемые статы, и лист записывается один раз.
+    """
+
+    OPERATIONS = {
+        "set": lambda current, value: value,
+        "add": lambda current, value: current + value,
+        "subtract": lambda current, value: current - value,
+    }
+
+    def __init__(self, rng=None):
+        # Генератор случайных чисел для бросков (фиксируется в тестах)
+        self.rng = rng
+
+    @timed("action")
+    def perform(self, queryset, sheet_id, action_name):
+        """
+        Выполняет действие над листом из ``queryset`` (например, только листы
+        текущего игрока) и возвращает (лист, {стат: (было, стало)}).
+        Лист блокируется до конца транзакции, поэтому параллельные действия
+        над ним выполняются по очереди и не теряют изменения друг друга.
+        """
+        with transaction.atomic():
+            sheet = (
+                queryset.select_for_update(of=("self",))
+                .select_related("system")
+                .get(pk=sheet_id)
+            )
+            evaluator = RuleEvaluator(sheet)
+            action = evaluator.rules_schema.get("available_actions", {}).get(
+                action_name
+            )
+            if action is None:
+                raise ActionError(f"Unknown action: {action_name}")
+            computed_stats = evaluator.rules_schema.get(
+                "character_sheet_schema", {}
+            ).get("computed_stats", {})
+
+            previous_stats = sheet.stats
+            # Формулы эффектов читают статы листа, поэтому правим их на месте
+            sheet.stats = previous_stats.copy()
+            try:
+                if (
+                    action.get("requires")
+                    and evaluator.evaluate(action["requires"]) <= 0
+                ):
+                    raise ActionError(
+                        f"Action {action_name} is not available for this character"
+                    )
+                for effect in action.get("effects", []):
+                    self.apply_effect(evaluator, sheet, effect, computed_stats)
+            except ValueError as e:
+                raise ActionError(f"Action {action_name} failed: {e}")
+
+            changed = {
+                name
+                for name, value in sheet.stats.items()
+                if previous_stats.get(name) != value
+            }
+            CharacterStateService().recalculate(sheet, changed_stats=changed)
+            changes = {
+                name: (previous_stats.get(name), value)
+                for name, value in sheet.stats.items()
+                if previous_stats.get(name) != value
+            }
+            if changes:
+                sheet.save(update_fields=["stats"])
+        return sheet, changes
+
+    def apply_effect(self, evaluator, sheet, effect, computed_stats):
+        stat_name = effect.get("stat")
+        operation = self.OPERATIONS.get(effect.get("op"))
+        if not stat_name or operation is None:
+            raise ValueError(f"Invalid effect: {effect}")
+        if stat_name in computed_stats:
+            raise ValueError(f"{stat_name} is computed and cannot be changed")
+
+        if "roll" in effect:
+            value = int(dice.roll(evaluator.bind_dice(effect["roll"]), rng=self.rng)[0])
+        else:
+            value = evaluator.evaluate(effect["formula"])
+        try:
+            current = int(sheet.stats.get(stat_name, 0))
+        except (TypeError, ValueError):
+            current = 0
+        value = operation(current, value)
+        if "min" in effect:
+            value = max(value, evaluator.evaluate(effect["min"]))
+        if "max" in effect:
+            value = min(value, evaluator.evaluate(effect["max"]))
+        sheet.stats[stat_name] = value
+
+
+class ConditionService:
+    """
+    Включает и выключает состояния листа. Модификаторы состояний - последний
+    слой поверх вычисляемых статов (см. ``core.engine.conditions``): слой
+    снимается, базовые значения затронутых им статов вычисляются заново,
+    и слой накладывается для новых состояний. Остальные формулы не трогаются.
+    """
+
+    @timed("conditions")
+    def update(self, queryset, sheet_id, add=(), remove=()):
+        """
+        Добавляет состояния ``add`` и снимает ``remove`` у листа из ``queryset``
+        и возвращает (лист, {стат: (было, стало)}). Лист блокируется до конца
+        транзакции, как при выполнении действий.
+        """
+        with transaction.atomic():
+            sheet = (
+                queryset.select_for_update(of=("self",))
+                .select_related("system")
+                .get(pk=sheet_id)
+            )
+            before = list(sheet.conditions or [])
+            removed = set(remove)
+            after = [condition for condition in before if condition not in removed]
+            after += [condition for condition in add if condition not in after]
+            if after == before:
+                return sheet, {}
+
+            evaluator = RuleEvaluator(sheet)
+            previous_totals = CharacterStateService.condition_modifiers(
+                evaluator, sheet
+            )
+            sheet.conditions = after
+            totals = CharacterStateService.condition_modifiers(evaluator, sheet)
+            previous_stats = sheet.stats
+            sheet.stats = previous_stats.copy()
+            # Как при пересчете: сначала снимается слой, потом накладывается
+            # заново. Хранимые статы могли быть посчитаны по прежней версии
+            # правил, поэтому затронутые слоем статы вычисляются по формулам,
+            # а не правятся на разницу модификаторов.
+            conditions.apply(sheet.stats, previous_totals, sign=-1)
+            self._evaluate(evaluator, sheet, set(previous_totals) | set(totals))
+            conditions.apply(sheet.stats, totals)
+            sheet.save(update_fields=["stats", "conditions"])
+            changes = {
+                name: (previous_stats.get(name), value)
+                for name, value in sheet.stats.items()
+                if previous_stats.get(name) != value
+            }
+        return sheet, changes
+
+    @staticmethod
+    def _evaluate(evaluator, sheet, stat_names):
+        """Вычисляет базовые значения статов ``stat_names`` по их формулам."""
+        computed_stats = evaluator.rules_schema.get("character_sheet_schema", {}).get(
+            "computed_stats", {}
+        )
+        for stat_name, rule in computed_stats.items():
+            formula = rule.get("formula")
+            if stat_name not in stat_names or not formula:
+                continue
+            try:
+                sheet.stats[stat_name] = evaluator.evaluate(formula)
+            except ValueError as e:
+                logger.warning(
+                    "Failed to evaluate %s for character %s: %s",
+                    stat_name,
+                    sheet.id,
+                    e,
+                )
+
+
+class SheetDocumentService:
+    """
+    Сервис для CharacterSheetDocument - заранее отрендеренного JSON листа.
+    Документ содержит черты (с подклассами), особенности, инвентарь
+    и компаньонов, поэтому перестраивается при изменении любой из этих частей.
+    """
+
+    batch_size = 500
+
+    @staticmethod
+    def _trait_prefetches(prefix):
+        return [
+            f"{prefix}traits__category",
+            f"{prefix}traits__features__feature_set",
+            f"{prefix}traits__children__category",
+            f"{prefix}traits__children__features__feature_set",
+            f"{prefix}features__feature_set",
+            f"{prefix}equipment__template",
+        ]
+
+    def get_queryset(self):
+        """Листы со всем, что нужно сериализатору (и компаньонам первого уровня)."""
+        return CharacterSheet.objects.prefetch_related(
+            *self._trait_prefetches(""),
+            Prefetch("companions", queryset=CharacterSheet.objects.order_by("id")),
+            *self._trait_prefetches("companions__"),
+        )
+
+    def render(self, sheet):
+        return JSONRenderer().render(CharacterSheetDetailSerializer(sheet).data)
+
+    def with_controllers(self, sheet_ids):
+        """
+        Добавляет к листам их хозяев (по всей цепочке controlled_by):
+        документ хозяина включает документы компаньонов.
+        """
+        result = set(sheet_ids)
+        frontier = result
+        while frontier:
+            frontier = (
+                set(
+                    CharacterSheet.objects.filter(
+                        pk__in=frontier, controlled_by__isnull=False
+                    ).values_list("controlled_by_id", flat=True)
+                )
+                - result
+            )
+            result |= frontier
+        return result
+
+    @timed("document")
+    def rebuild(self, sheet_ids):
+        """
+        Перестраивает документы листов (и их хозяев) и возвращает словарь
+        {ID листа: содержимое}. Листы, которых уже нет, пропускаются.
+
+        Документ сохраняется в основную БД, поэтому и собирается по ней, даже
+        внутри GET-запроса с разрешенным чтением с реплик: иначе отстающая
+        реплика записала бы в документ старое состояние листа.
+        """
+        with replica_reads(False):
+            return self._rebuild(sheet_ids)
+
+    def _rebuild(self, sheet_ids):
+        sheet_ids = self.with_controllers(sheet_ids)
+        for _, pending in _PendingDocuments.registered():
+            pending.ids.difference_update(sheet_ids)
+
+        contents = {}
+        ids = sorted(sheet_ids)
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start : start + self.batch_size]
+            documents = [
+                CharacterSheetDocument(sheet=sheet, content=self.render(sheet))
+                for sheet in self.get_queryset().filter(pk__in=batch)
+            ]
+            CharacterSheetDocument.objects.bulk_create(
+                documents,
+                update_conflicts=True,
+                unique_fields=["sheet"],
+                update_fields=["content", "updated_at"],
+            )
+            contents.update(
+                (document.sheet_id, document.content) for document in documents
+            )
+        return contents
+
+    def get_or_build(self, sheet_id, content=None):
+        """Возвращает содержимое документа, собирая его, если документа еще нет."""
+        if content is None:
+            content = self.rebuild([sheet_id]).get(sheet_id)
+        return bytes(content)
+
+    def schedule(self, sheet_ids):
+        """
+        Откладывает перестройку документов до коммита текущей транзакции.
+        Несколько изменений одного листа в транзакции дают одну перестройку,
+        а ID из откаченной транзакции в следующую не попадают.
+        """
+        if not sheet_ids:
+            return
+        pending = _PendingDocuments.current()
+        if pending is not None:
+            pending.ids.update(sheet_ids)
+            return
+        # Вне транзакции колбэк выполняется сразу, поэтому ID добавляются до него
+        pending = _PendingDocuments(self)
+        pending.ids.update(sheet_ids)
+        transaction.on_commit(pending)
+
+    def sheets_referencing_catalog(
+        self,
+        trait_ids=(),
+        feature_ids=(),
+        template_ids=(),
+        category_ids=(),
+        feature_set_ids=(),
+    ):
+        """
+        ID листов, в документы которых попадают указанные строки каталога.
+        Черта показывается в документе вместе со всеми подклассами, поэтому
+        изменение черты затрагивает листы с любым ее предком.
+        """
+        trait_ids = set(trait_ids)
+        feature_ids = set(feature_ids)
+        if feature_set_ids:
+            feature_ids.update(
+                Feature.objects.filter(feature_set__in=feature_set_ids).values_list(
+                    "id", flat=True
+                )
+            )
+        if category_ids:
+            trait_ids.update(
+                CharacterTrait.objects.filter(category__in=category_ids).values_list(
+                    "id", flat=True
+                )
+            )
+        if feature_ids:
+            trait_ids.update(
+                CharacterTrait.features.through.objects.filter(
+                    feature_id__in=feature_ids
+                ).values_list("charactertrait_id", flat=True)
+            )
+
+        # Поднимаемся по дереву черт до корней
+        frontier = trait_ids
+        while frontier:
+            frontier = (
+                set(
+                    CharacterTrait.objects.filter(
+                        pk__in=frontier, parent__isnull=False
+                    ).values_list("parent_id", flat=True)
+                )
+                - trait_ids
+            )
+            trait_ids |= frontier
+
+        sheet_ids = set()
+        if trait_ids:
+            sheet_ids.update(
+                CharacterSheet.traits.through.objects.filter(
+                    charactertrait_id__in=trait_ids
+                ).values_list("charactersheet_id", flat=True)
+            )
+        if feature_ids:
+            sheet_ids.update(
+                CharacterSheet.features.through.objects.filter(
+                    feature_id__in=feature_ids
+                ).values_list("charactersheet_id", flat=True)
+            )
+        if template_ids:
+            sheet_ids.update(
+                CharacterEquipment.objects.filter(
+                    template_id__in=template_ids
+                ).values_list("character_id", flat=True)
+            )
+        return sheet_ids
+
+    def sheets_affected_by_load(self, report):
+        """
+        ID листов, документы которых устарели после загрузки сида
+        (core.loader.loader.LoadReport).
+        """
+        if report.system is None or report.skipped:
+            return set()
+
+        def ids(record_type):
+            return report.changed_ids[record_type] | report.deleted_ids[record_type]
+
+        return self.sheets_referencing_catalog(
+            trait_ids=ids("character_trait"),
+            feature_ids=ids("feature"),
+            template_ids=ids("equipment_template"),
+            category_ids=ids("trait_category"),
+            feature_set_ids=ids("feature_set"),
+        )
@@ -0,0 +1,109 @@
+"""
+Сигналы, поддерживающие CharacterSheetDocument в актуальном состоянии.
+Перестройка документов откладывается до коммита транзакции
+(SheetDocumentService.schedule), поэтому серия изменений одного листа
+дает одну перестройку. Загрузчик сидов пишет каталог пакетами
+(bulk-операции сигналов не вызывают) и перестраивает документы сам.
+"""
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from core.models import (
+    CharacterTrait,
+    EquipmentTemplate,
+    Feature,
+    FeatureSet,
+    TraitCategory,
+)
+
+from .models import CharacterEquipment, CharacterSheet
+from .services import SheetDocumentService
+
+documents = SheetDocumentService()
+
+
+@receiver(post_save, sender=CharacterSheet)
+def sheet_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        documents.schedule([instance.pk])
+
+
+@receiver(post_delete, sender=CharacterSheet)
+def sheet_deleted(sender, instance, **kwargs):
+    # Документ удаляется каскадно, но хозяин показывает своих компаньонов
+    if instance.controlled_by_id:
+        documents.schedule([instance.controlled_by_id])
+
+
+@receiver(post_save, sender=CharacterEquipment)
+@receiver(post_delete, sender=CharacterEquipment)
+def equipment_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        documents.schedule([instance.character_id])
+
+
+@receiver(m2m_changed, sender=CharacterSheet.traits.through)
+@receiver(m2m_changed, sender=CharacterSheet.features.through)
+def sheet_links_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            documents.schedule([instance.pk])
+        return
+    # instance - черта или особенность, pk_set - ID листов
+    if action in ("post_add", "post_remove"):
+        documents.schedule(pk_set)
+    elif action == "pre_clear":
+        # Поле through-таблицы называется по модели: charactertrait или feature
+        documents.schedule(
+            sender.objects.filter(**{instance._meta.model_name: instance}).values_list(
+                "charactersheet_id", flat=True
+            )
+        )
+
+
+# --- Изменения каталога через админку или API ---
+
+CATALOG_LOOKUPS = {
+    CharacterTrait: "trait_ids",
+    Feature: "feature_ids",
+    EquipmentTemplate: "template_ids",
+    TraitCategory: "category_ids",
+    FeatureSet: "feature_set_ids",
+}
+
+
+def catalog_row_changed(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    documents.schedule(
+        documents.sheets_referencing_catalog(**{CATALOG_LOOKUPS[sender]: [instance.pk]})
+    )
+
+
+for model in CATALOG_LOOKUPS:
+    post_save.connect(
+        catalog_row_changed,
+        sender=model,
+        dispatch_uid=f"sheet-documents-save-{model.__name__}",
+    )
+    # До удаления: потом связи с листами будут уже удалены каскадом
+    pre_delete.connect(
+        catalog_row_changed,
+        sender=model,
+        dispatch_uid=f"sheet-documents-delete-{model.__name__}",
+    )
+
+
+@receiver(m2m_changed, sender=CharacterTrait.features.through)
+def trait_features_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if reverse:
+        # instance - особенность, pk_set - ID черт
+        trait_ids = pk_set or []
+        if action == "pre_clear":
+            trait_ids = instance.charactertrait_set.values_list("id", flat=True)
+    else:
+        trait_ids = [instance.pk]
+    documents.schedule(documents.sheets_referencing_catalog(trait_ids=trait_ids))
@@ -1,3 +1,1109 @@
-# from django.test import TestCase
+import gc
+import io
+import json
+import tempfile
+import weakref
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from characters.models import (
+    CharacterEquipment,
+    CharacterSheet,
+    CharacterSheetDocument,
+)
+from characters.serializers import CharacterEquipmentSerializer
+from characters.services import (
+    ActionExecutionService,
+    CharacterStateService,
+    PreviewService,
+    SheetDocumentService,
+)
+from core.models import (
+    CharacterTrait,
+    EquipmentTemplate,
+    Feature,
+    FeatureSet,
+    GameSystem,
+    TraitCategory,
+)
+from core import db_router
+from core.engine import conditions, eligibility, registry
+from core.engine.evaluator import RuleEvaluator
+from core.tests import QueryPlanTestCase, load_synthetic_system
+
+
+class CharacterQueryPlanTests(QueryPlanTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        system = load_synthetic_system("plan-sheets")
+        templates = list(EquipmentTemplate.objects.filter(system=system))
+        root_traits = list(
+            CharacterTrait.objects.filter(system=system, parent__isnull=True)[:20]
+        )
+
+        users = User.objects.bulk_create(
+            User(username=f"player-{index:04d}") for index in range(200)
+        )
+        sheets = CharacterSheet.objects.bulk_create(
+            CharacterSheet(player=user, system=system, name=f"Hero {index}")
+            for index, user in enumerate(users)
+            for _ in range(3)
+        )
+        # Питомцы: часть листов не должна попадать в список игрока
+        CharacterSheet.objects.bulk_create(
+            CharacterSheet(
+                player=sheet.player,
+                system=system,
+                name=f"Companion of {sheet.name}",
+                controlled_by=sheet,
+            )
+            for sheet in sheets[::2]
+        )
+
+        CharacterEquipment.objects.bulk_create(
+            CharacterEquipment(
+                character=sheet,
+                template=templates[(index + offset) % len(templates)],
+                location=templates[(index + offset) % len(templates)].metadata[
+                    "location"
+                ],
+            )
+            for index, sheet in enumerate(sheets)
+            for offset in range(4)
+        )
+        Through = CharacterSheet.traits.through
+        Through.objects.bulk_create(
+            Through(
+                charactersheet=sheet,
+                charactertrait=root_traits[index % len(root_traits)],
+            )
+            for index, sheet in enumerate(sheets)
+        )
+
+        cls.user = users[100]
+        cls.sheet = sheets[300]
+
+    def test_player_sheet_list(self):
+        # Запрос из CharacterSheetViewSet.get_queryset
+        self.assertUsesIndex(
+            CharacterSheet.objects.filter(player=self.user, controlled_by__isnull=True),
+            "charsheet_player_root_idx",
+        )
+
+    def test_equipment_by_location(self):
+        # Запрос из RuleEvaluator._get_equipment_in_location
+        self.assertUsesIndex(
+            self.sheet.equipment.filter(location="armor"),
+            "charequip_char_location_idx",
+        )
+
+    def test_trait_by_category(self):
+        # Запрос из RuleEvaluator._get_trait_by_category
+        self.assertUsesIndex(
+            self.sheet.traits.filter(category__name__iexact="class"),
+            "core_traitcat_upper_name_idx",
+        )
+
+    def test_companions(self):
+        self.assertNoSeqScan(self.sheet.companions.all())
+
+
+class RecalculationLoggingTests(TestCase):
+    def test_formula_error_is_logged_with_context(self):
+        system = GameSystem.objects.create(
+            name="Broken",
+            slug="broken",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "hp": {"formula": "stat('level') + 10"},
+                        "evasion": {"formula": "stat('level') / 0"},
+                    }
+                }
+            },
+        )
+        sheet = CharacterSheet.objects.create(
+            player=User.objects.create(username="logger"),
+            system=system,
+            name="Hero",
+            stats={"level": 2},
+        )
+
+        with self.assertLogs("characters.services", "WARNING") as logs:
+            CharacterStateService().recalculate_and_save(sheet)
+
+        self.assertEqual(sheet.stats["hp"], 12)
+        (record,) = logs.records
+        self.assertEqual(record.stat, "evasion")
+        self.assertEqual(record.formula, "stat('level') / 0")
+        self.assertEqual(record.character_id, sheet.id)
+
+
+class ProvisionLoadTestTests(TestCase):
+    def test_players_get_sheets_with_documents(self):
+        load_synthetic_system("loadtest", features=50, traits=30, equipment=20)
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            call_command(
+                "provision_loadtest",
+                "--system=loadtest",
+                "--players=3",
+                "--sheets-per-player=2",
+                f"--output={output.name}",
+                stdout=io.StringIO(),
+            )
+            manifest = json.load(output)
+
+        self.assertEqual(len(manifest["players"]), 3)
+        sheet_ids = [pk for player in manifest["players"] for pk in player["sheets"]]
+        sheets = CharacterSheet.objects.filter(pk__in=sheet_ids)
+        self.assertEqual(sheets.filter(document__isnull=False).count(), 6)
+        self.assertTrue(all("computed_0" in sheet.stats for sheet in sheets))
+        self.assertTrue(
+            self.client.login(
+                username=manifest["players"][0]["username"], password="loadtest"
+            )
+        )
+
+
+class SheetRollTests(TestCase):
+    def test_roll_resolves_sheet_stats(self):
+        system = GameSystem.objects.create(name="Dice", slug="dice")
+        player = User.objects.create(username="roller")
+        sheet = CharacterSheet.objects.create(
+            player=player, system=system, name="Hero", stats={"agility": 2}
+        )
+        self.client.force_login(player)
+
+        response = self.client.get(
+            f"/api/v1/sheets/{sheet.pk}/roll/",
+            {"expression": "2d12 + stat('agility')", "count": 3, "threshold": 25},
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["resolved"], "2d12 + 2")
+        self.assertEqual(len(data["rolls"]), 3)
+        self.assertAlmostEqual(data["distribution"]["at_least"], 3 / 144)
+
+        response = self.client.get(
+            f"/api/v1/sheets/{sheet.pk}/roll/", {"expression": "2d12 *"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+        # Дорогой kh/kl отклоняется до вычисления распределения
+        response = self.client.get(
+            f"/api/v1/sheets/{sheet.pk}/roll/", {"expression": "12d833kh6"}
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(
+            f"/api/v1/sheets/{sheet.pk}/roll/",
+            {"expression": "+".join(["100d100"] * 24)},
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class PerformActionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.system = GameSystem.objects.create(
+            name="Actions",
+            slug="actions",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "max_hp": {"formula": "stat('level') + 5"},
+                        "bloodied": {"formula": "stat('max_hp') / 2"},
+                        "armor": {"formula": "equipment_meta('armor', 'score')"},
+                    }
+                },
+                "available_actions": {
+                    "level_up": {
+                        "requires": "3 - stat('level')",
+                        "effects": [{"op": "add", "stat": "level", "formula": "1"}],
+                    },
+                    "rest": {
+                        "effects": [
+                            {
+                                "op": "subtract",
+                                "stat": "hp_marked",
+                                "roll": "1d4 + 10",
+                                "min": "0",
+                            }
+                        ]
+                    },
+                },
+            },
+        )
+        cls.player = User.objects.create(username="actor")
+
+    def setUp(self):
+        self.sheet = CharacterSheet.objects.create(
+            player=self.player,
+            system=self.system,
+            name="Hero",
+            stats={"level": 2, "hp_marked": 3},
+        )
+        CharacterStateService().recalculate_and_save(self.sheet)
+        self.client.force_login(self.player)
+
+    def perform(self, action_type):
+        return self.client.post(
+            f"/api/v1/sheets/{self.sheet.pk}/perform_action/",
+            {"action_type": action_type},
+            content_type="application/json",
+        )
+
+    def test_effects_and_dependent_stats_in_one_write(self):
+        response = self.perform("level_up")
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()["stats"]
+        self.assertEqual(
+            (stats["level"], stats["max_hp"], stats["bloodied"]), (3, 8, 4)
+        )
+
+        self.sheet.refresh_from_db()
+        self.assertEqual(self.sheet.stats["bloodied"], 4)
+        self.assertEqual(self.perform("level_up").status_code, 400)
+        self.assertEqual(self.perform("fly").status_code, 400)
+
+    def test_only_dependent_stats_are_recalculated(self):
+        service = ActionExecutionService(rng=np.random.default_rng(0))
+        # Савепоинт, чтение листа с блокировкой, одна запись; черты и экипировка
+        # не читаются: от hp_marked не зависит ни один вычисляемый стат
+        with self.assertNumQueries(4):
+            sheet, changes = service.perform(
+                CharacterSheet.objects.all(), self.sheet.pk, "rest"
+            )
+        self.assertEqual(changes, {"hp_marked": (3, 0)})
+
+
+class EligibleFeaturesTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.system = GameSystem.objects.create(name="Eligible", slug="eligible")
+        cls.player = User.objects.create(username="chooser")
+        other = User.objects.create(username="other")
+        sets = {
+            name: FeatureSet.objects.create(
+                system=cls.system, name=name, set_type="Domain"
+            )
+            for name in ("Blade", "Valor", "Arcana")
+        }
+        category = TraitCategory.objects.create(system=cls.system, name="Class")
+        guardian = CharacterTrait.objects.create(
+            system=cls.system,
+            category=category,
+            name="Guardian",
+            metadata={
+                "grants_access_to": {
+                    "type": "FeatureSet",
+                    "set_type": "Domain",
+                    "names": ["Blade", "Valor"],
+                }
+            },
+        )
+        cls.stalwart = CharacterTrait.objects.create(
+            system=cls.system, category=category, name="Stalwart", parent=guardian
+        )
+        wizard = CharacterTrait.objects.create(
+            system=cls.system, category=category, name="Wizard"
+        )
+
+        def feature(name, feature_set=None, **metadata):
+            return Feature.objects.create(
+                system=cls.system,
+                name=name,
+                feature_set=sets.get(feature_set),
+                metadata={"type": "domain_card" if feature_set else "feat", **metadata},
+            )
+
+        cls.reckless = feature("Reckless", "Valor", level_requirement=1)
+        feature("Whirlwind", "Blade", level_requirement=5)
+        feature("Fireball", "Arcana", level_requirement=1)
+        cls.frontline = feature("Frontline Tank")
+        guardian.features.add(cls.frontline)
+        wizard.features.add(feature("Spellbook"))
+        feature("Unbreakable", required_trait="Stalwart")
+        feature("Mage Armor", required_trait=["Wizard"])
+        Feature.objects.create(system=cls.system, name="Homebrew", created_by=other)
+        cls.system.refresh_from_db()
+
+    def setUp(self):
+        eligibility.clear()
+        self.sheet = CharacterSheet.objects.create(
+            player=self.player, system=self.system, name="Hero", stats={"level": 3}
+        )
+        self.sheet.traits.add(self.stalwart)
+        self.client.force_login(self.player)
+
+    def eligible(self, **params):
+        response = self.client.get(
+            f"/api/v1/sheets/{self.sheet.pk}/eligible-features/", params
+        )
+        self.assertEqual(response.status_code, 200)
+        return {feature["name"] for feature in response.json()["results"]}
+
+    def test_access_level_and_required_trait(self):
+        self.assertEqual(self.eligible(), {"Reckless", "Frontline Tank", "Unbreakable"})
+        self.assertEqual(self.eligible(type="domain_card"), {"Reckless"})
+
+        self.sheet.features.add(self.reckless)
+        self.sheet.stats = {"level": 5}
+        self.sheet.save()
+        self.assertEqual(
+            self.eligible(), {"Whirlwind", "Frontline Tank", "Unbreakable"}
+        )
+
+    def test_index_follows_catalog_version(self):
+        index = eligibility.get_index(self.system)
+        self.assertIs(eligibility.get_index(self.system), index)
+
+        mage_armor = Feature.objects.get(system=self.system, name="Mage Armor")
+        mage_armor.metadata = {"type": "feat"}
+        mage_armor.save()
+        self.system.refresh_from_db()
+        self.assertIsNot(eligibility.get_index(self.system), index)
+        self.assertIn("Mage Armor", self.eligible())
+
+    def test_invalid_metadata_does_not_break_the_index(self):
+        Feature.objects.create(
+            system=self.system,
+            name="Homebrew Feat",
+            metadata={"type": "feat", "level_requirement": "3+"},
+        )
+        Feature.objects.create(
+            system=self.system,
+            name="Broken Feat",
+            metadata={"level_requirement": {}, "required_trait": [{}]},
+        )
+        category = TraitCategory.objects.get(system=self.system, name="Class")
+        for index, metadata in enumerate(
+            (["grants_access_to"], "Valor", 7, {"grants_access_to": "Valor"})
+        ):
+            CharacterTrait.objects.create(
+                system=self.system,
+                category=category,
+                name=f"Broken {index}",
+                metadata=metadata,
+            )
+        CharacterTrait.objects.create(
+            system=self.system,
+            category=category,
+            name="Broken Names",
+            metadata={"grants_access_to": {"type": "FeatureSet", "names": [["Valor"]]}},
+        )
+        with self.assertLogs("core.engine.eligibility", "WARNING") as logs:
+            names = self.eligible()
+        self.assertEqual(len(logs.records), 2)
+        # Некорректный порог считается отсутствующим
+        self.assertIn("Homebrew Feat", names)
+        self.assertIn("Reckless", names)
+
+
+class PartyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.system = GameSystem.objects.create(
+            name="Party",
+            slug="party",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "max_hp": {
+                            "formula": "trait_meta('Class', 'base_hp') + stat('level')"
+                        },
+                        "evasion": {"formula": "equipment_meta('armor', 'evasion')"},
+                    }
+                }
+            },
+        )
+        category = TraitCategory.objects.create(system=cls.system, name="Class")
+        cls.guardian = CharacterTrait.objects.create(
+            system=cls.system,
+            category=category,
+            name="Guardian",
+            metadata={"base_hp": 7},
+        )
+        cls.armor = EquipmentTemplate.objects.create(
+            system=cls.system, name="Chainmail", metadata={"evasion": 9}
+        )
+        cls.rope = EquipmentTemplate.objects.create(system=cls.system, name="Rope")
+        cls.player = User.objects.create(username="gm")
+
+        cls.sheets = []
+        for index in range(3):
+            sheet = CharacterSheet.objects.create(
+                player=cls.player,
+                system=cls.system,
+                name=f"Hero {index}",
+                stats={"level": index + 1},
+                conditions=["hidden"] if index == 0 else [],
+            )
+            sheet.traits.add(cls.guardian)
+            CharacterEquipment.objects.create(
+                character=sheet, template=cls.armor, location="armor"
+            )
+            CharacterEquipment.objects.create(character=sheet, template=cls.rope)
+            CharacterStateService().recalculate_and_save(sheet)
+            cls.sheets.append(sheet)
+        cls.companion = CharacterSheet.objects.create(
+            player=cls.player,
+            system=cls.system,
+            name="Wolf",
+            controlled_by=cls.sheets[0],
+        )
+        cls.stranger = CharacterSheet.objects.create(
+            player=User.objects.create(username="stranger"),
+            system=cls.system,
+            name="Spy",
+        )
+
+    def setUp(self):
+        self.client.force_login(self.player)
+
+    def party(self, sheets, **params):
+        ids = ",".join(str(sheet.pk) for sheet in sheets)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v1/sheets/party/", {"ids": ids, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries)
+
+    def test_fixed_number_of_queries(self):
+        data, few = self.party(self.sheets[:1])
+        _, many = self.party(self.sheets)
+        self.assertEqual(few, many)
+
+        member = data["members"][0]
+        self.assertEqual(member["stats"], {"level": 1, "max_hp": 8, "evasion": 9})
+        self.assertEqual(member["conditions"], ["hidden"])
+        self.assertEqual([item["name"] for item in member["equipped"]], ["Chainmail"])
+        self.assertEqual(member["companions"][0]["name"], "Wolf")
+
+        data, _ = self.party([self.sheets[2], self.stranger, self.sheets[1]])
+        self.assertEqual(
+            [member["name"] for member in data["members"]], ["Hero 2", "Hero 1"]
+        )
+        self.assertEqual(data["missing"], [self.stranger.pk])
+
+    def test_batch_recalculation(self):
+        # Статы "устарели": уровень изменен в обход пересчета
+        CharacterSheet.objects.filter(pk=self.sheets[1].pk).update(
+            stats={"level": 5, "max_hp": 9, "evasion": 9}
+        )
+        data, _ = self.party(self.sheets, recalculate="true")
+        self.assertEqual(data["members"][1]["stats"]["max_hp"], 12)
+        self.sheets[1].refresh_from_db()
+        self.assertEqual(self.sheets[1].stats["max_hp"], 9)
+
+        service = CharacterStateService()
+        # Листы, черты с категориями, экипировка с шаблонами и один UPDATE
+        with self.assertNumQueries(6):
+            changed = service.recalculate_many(
+                service.with_rules_context(
+                    CharacterSheet.objects.filter(
+                        pk__in=[sheet.pk for sheet in self.sheets]
+                    )
+                )
+            )
+        self.assertEqual([sheet.pk for sheet in changed], [self.sheets[1].pk])
+        self.sheets[1].refresh_from_db()
+        self.assertEqual(self.sheets[1].stats["max_hp"], 12)
+
+
+class ProjectionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # На SQLite ID откаченной системы переиспользуется: правила в реестре
+        # процесса могут остаться от другой системы с тем же ID и версией
+        registry.clear()
+        cls.system = GameSystem.objects.create(
+            name="Projection",
+            slug="projection",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "max_hp": {
+                            "formula": "trait_meta('Class', 'base_hp') + stat('level')"
+                        },
+                        "major": {
+                            "formula": "equipment_meta('armor', 'major') + stat('level')"
+                        },
+                        "ratio": {
+                            "formula": "stat('max_hp') / equipment_meta('armor', 'div')"
+                        },
+                    }
+                }
+            },
+        )
+        category = TraitCategory.objects.create(system=cls.system, name="Class")
+        trait = CharacterTrait.objects.create(
+            system=cls.system,
+            category=category,
+            name="Guardian",
+            metadata={"base_hp": 7},
+        )
+        cls.templates = [
+            EquipmentTemplate.objects.create(
+                system=cls.system,
+                name=name,
+                metadata={"location": "armor", "major": major, "div": div},
+            )
+            for name, major, div in (
+                ("Leather", 6, 2),
+                ("Chainmail", 7, 3),
+                ("Cursed", 9, 0),
+            )
+        ]
+        cls.player = User.objects.create(username="planner")
+        cls.sheet = CharacterSheet.objects.create(
+            player=cls.player, system=cls.system, name="Hero", stats={"level": 1}
+        )
+        cls.sheet.traits.add(trait)
+        CharacterEquipment.objects.create(
+            character=cls.sheet, template=cls.templates[0], location="armor"
+        )
+        CharacterStateService().recalculate_and_save(cls.sheet)
+
+    def test_matches_recalculation_at_every_level(self):
+        self.client.force_login(self.player)
+        ids = ",".join(str(template.pk) for template in self.templates[1:])
+        response = self.client.get(
+            f"/api/v1/sheets/{self.sheet.pk}/projection/",
+            {"start": 1, "end": 10, "equipment": ids},
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["values"], list(range(1, 11)))
+        current, chainmail, cursed = data["variants"]
+        self.assertIsNone(current["equipment"])
+        self.assertEqual(chainmail["equipment"]["name"], "Chainmail")
+
+        service = CharacterStateService()
+        for index, level in enumerate(range(1, 11)):
+            sheet = CharacterSheet.objects.get(pk=self.sheet.pk)
+            sheet.stats = {**sheet.stats, "level": level}
+            expected = service.recalculate(sheet)
+            for name in ("max_hp", "major", "ratio"):
+                self.assertEqual(current["stats"][name][index], expected[name])
+        self.assertEqual(chainmail["stats"]["major"][:2], [8, 9])
+        self.assertEqual(chainmail["stats"]["ratio"][:3], [2, 3, 3])
+        # Деление на ноль: как при пересчете, остается текущее значение
+        self.assertEqual(cursed["stats"]["ratio"], [4] * 10)
+
+        self.sheet.refresh_from_db()
+        self.assertEqual(self.sheet.stats["level"], 1)
+
+        response = self.client.get(
+            f"/api/v1/sheets/{self.sheet.pk}/projection/", {"start": 5, "end": 1}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_values_outside_int64_are_rejected(self):
+        self.client.force_login(self.player)
+        for start, end in ((10**20, 10**20 + 1), (-(10**20), -(10**20))):
+            with self.subTest(start=start):
+                response = self.client.get(
+                    f"/api/v1/sheets/{self.sheet.pk}/projection/",
+                    {"start": start, "end": end},
+                )
+                self.assertEqual(response.status_code, 400)
+
+
+class PreviewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        registry.clear()
+        cls.system = GameSystem.objects.create(
+            name="Preview",
+            slug="preview",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "max_hp": {
+                            "formula": "trait_meta('Class', 'base_hp') + stat('level')"
+                        },
+                        "major": {
+                            "formula": "equipment_meta('armor', 'major') + stat('max_hp')"
+                        },
+                    }
+                }
+            },
+        )
+        category = TraitCategory.objects.create(system=cls.system, name="Class")
+        cls.guardian, cls.wizard = (
+            CharacterTrait.objects.create(
+                system=cls.system, category=category, name=name, metadata=metadata
+            )
+            for name, metadata in (
+                ("Guardian", {"base_hp": 7}),
+                ("Wizard", {"base_hp": 5}),
+            )
+        )
+        cls.leather, cls.chainmail = (
+            EquipmentTemplate.objects.create(
+                system=cls.system,
+                name=name,
+                metadata={"location": "armor", "major": major},
+            )
+            for name, major in (("Leather", 6), ("Chainmail", 9))
+        )
+        cls.fireball = Feature.objects.create(
+            system=cls.system,
+            name="Fireball",
+            metadata={"required_trait": "Wizard", "level_requirement": 3},
+        )
+        cls.player = User.objects.create(username="builder")
+        cls.sheet = CharacterSheet.objects.create(
+            player=cls.player, system=cls.system, name="Hero", stats={"level": 1}
+        )
+        cls.sheet.traits.add(cls.guardian)
+        CharacterEquipment.objects.create(
+            character=cls.sheet, template=cls.leather, location="armor"
+        )
+        CharacterStateService().recalculate_and_save(cls.sheet)
+
+    def setUp(self):
+        eligibility.clear()
+
+    def test_preview_matches_saved_recalculation_without_writes(self):
+        self.client.force_login(self.player)
+        url = f"/api/v1/sheets/{self.sheet.pk}/preview/"
+        changes = {
+            "stats": {"level": 2},
+            "traits": [self.wizard.pk],
+            "features": [self.fireball.pk],
+            "equipment": [{"template": self.chainmail.pk, "location": "armor"}],
+        }
+        response = self.client.post(url, changes, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["stats"], {"level": 2, "max_hp": 7, "major": 16})
+        self.assertEqual(data["changed"], {"level": 2, "max_hp": 7, "major": 16})
+        # Fireball требует 3-го уровня
+        self.assertEqual(data["unavailable_features"], [self.fireball.pk])
+
+        self.sheet.refresh_from_db()
+        self.assertEqual(self.sheet.stats, {"level": 1, "max_hp": 8, "major": 14})
+
+        # Тот же результат дает сохранение изменений и обычный пересчет
+        sheet = CharacterSheet.objects.get(pk=self.sheet.pk)
+        sheet.stats = {**sheet.stats, "level": 2}
+        sheet.traits.set([self.wizard])
+        sheet.equipment.update(template=self.chainmail)
+        self.assertEqual(CharacterStateService().recalculate(sheet), data["stats"])
+
+    def test_full_change_set_needs_no_queries(self):
+        sheet = CharacterSheet.objects.select_related("system").get(pk=self.sheet.pk)
+        changes = {
+            "stats": {"level": 3},
+            "traits": [self.wizard.pk],
+            "features": [self.fireball.pk],
+            "equipment": [("armor", self.leather.pk)],
+        }
+        service = PreviewService()
+        service.preview(sheet, **changes)  # прогрев реестра правил и индекса
+        with self.assertNumQueries(0):
+            result = service.preview(sheet, **changes)
+        self.assertEqual(result["stats"]["major"], 14)
+        self.assertEqual(result["unavailable_features"], [])
+
+    def test_unknown_catalog_ids_are_rejected(self):
+        self.client.force_login(self.player)
+        response = self.client.post(
+            f"/api/v1/sheets/{self.sheet.pk}/preview/",
+            {"traits": [self.guardian.pk, 999999]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("traits", response.json())
+
+
+class ConditionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        registry.clear()
+        cls.system = GameSystem.objects.create(
+            name="Conditions",
+            slug="conditions",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "evasion": {"formula": "trait_meta('Class', 'base_evasion')"},
+                        "major": {"formula": "stat('evasion') + stat('level')"},
+                    }
+                },
+                "conditions": {
+                    "vulnerable": {"modifiers": {"evasion": -2}},
+                    "hidden": {"modifiers": {"evasion": 1, "major": 3}},
+                    # Обычные статы не модифицируются
+                    "blessed": {"modifiers": {"level": 5}},
+                },
+            },
+        )
+        category = TraitCategory.objects.create(system=cls.system, name="Class")
+        trait = CharacterTrait.objects.create(
+            system=cls.system,
+            category=category,
+            name="Guardian",
+            metadata={"base_evasion": 10},
+        )
+        cls.player = User.objects.create(username="fighter")
+        cls.sheet = CharacterSheet.objects.create(
+            player=cls.player, system=cls.system, name="Hero", stats={"level": 1}
+        )
+        cls.sheet.traits.add(trait)
+        CharacterStateService().recalculate_and_save(cls.sheet)
+
+    def setUp(self):
+        conditions.clear()
+        self.client.force_login(self.player)
+        self.url = f"/api/v1/sheets/{self.sheet.pk}/conditions/"
+
+    def post(self, **changes):
+        response = self.client.post(self.url, changes, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def assert_matches_recalculation(self, stats):
+        sheet = CharacterSheet.objects.get(pk=self.sheet.pk)
+        self.assertEqual(sheet.stats, stats)
+        self.assertEqual(CharacterStateService().recalculate(sheet), stats)
+
+    def test_toggling_applies_modifiers_as_final_layer(self):
+        data = self.post(add=["vulnerable", "inspired"])
+        self.sheet.refresh_from_db()
+        self.assertEqual(self.sheet.conditions, ["vulnerable", "inspired"])
+        # major читает базовое уклонение, а не уменьшенное состоянием
+        self.assertEqual(data["stats"], {"level": 1, "evasion": 8, "major": 11})
+        self.assert_matches_recalculation(data["stats"])
+
+        data = self.post(add=["hidden", "blessed"], remove=["vulnerable"])
+        self.assertEqual(data["stats"], {"level": 1, "evasion": 11, "major": 14})
+        self.assert_matches_recalculation(data["stats"])
+
+        # Пересчет после смены уровня сохраняет слой состояний
+        sheet = CharacterSheet.objects.get(pk=self.sheet.pk)
+        sheet.stats = {**sheet.stats, "level": 2}
+        CharacterStateService().recalculate_and_save(sheet, changed_stats={"level"})
+        self.assertEqual(sheet.stats, {"level": 2, "evasion": 11, "major": 15})
+
+        data = self.post(remove=["hidden", "blessed", "inspired"])
+        self.assertEqual(data["stats"], {"level": 2, "evasion": 10, "major": 12})
+
+    def test_removal_after_rules_change_recomputes_the_layer(self):
+        self.assertEqual(
+            self.post(add=["hidden"])["stats"], {"level": 1, "evasion": 11, "major": 14}
+        )
+
+        # Статы листа хранят модификатор прежней версии правил
+        system = GameSystem.objects.get(pk=self.system.pk)
+        system.metadata["conditions"]["hidden"]["modifiers"]["evasion"] = 4
+        system.save()
+
+        data = self.post(remove=["hidden"])
+        self.assertEqual(data["stats"], {"level": 1, "evasion": 10, "major": 11})
+        self.assert_matches_recalculation(data["stats"])
+
+    def test_conflicting_changes_are_rejected(self):
+        response = self.client.post(
+            self.url,
+            {"add": ["hidden"], "remove": ["hidden"]},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class EquipmentTreeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        registry.clear()
+        cls.system = GameSystem.objects.create(
+            name="Mechs",
+            slug="mechs",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "weight": {"formula": "equipment_sum('mech', 'weight')"},
+                        "heat": {"formula": "equipment_max('mech', 'heat')"},
+                    }
+                }
+            },
+        )
+        frame, cannon, scope = (
+            EquipmentTemplate.objects.create(
+                system=cls.system,
+                name=name,
+                metadata={"weight": weight, "heat": heat},
+            )
+            for name, weight, heat in (
+                ("Frame", 50, 1),
+                ("Cannon", 10, 5),
+                ("Scope", 1, 2),
+            )
+        )
+        cls.player = User.objects.create(username="pilot")
+        cls.sheet = CharacterSheet.objects.create(
+            player=cls.player, system=cls.system, name="Pilot", stats={}
+        )
+        cls.frame = CharacterEquipment.objects.create(
+            character=cls.sheet, template=frame, location="mech"
+        )
+        cls.cannon = CharacterEquipment.objects.create(
+            character=cls.sheet,
+            template=cannon,
+            location="hardpoint",
+            parent_equipment=cls.frame,
+        )
+        cls.scope = CharacterEquipment.objects.create(
+            character=cls.sheet,
+            template=scope,
+            location="rail",
+            parent_equipment=cls.cannon,
+        )
+        # Запасная пушка в инвентаре в вес меха не входит
+        cls.spare = CharacterEquipment.objects.create(
+            character=cls.sheet, template=cannon, location="inventory"
+        )
+        cls.scope_template = scope
+
+    def test_aggregates_cover_attachment_subtrees(self):
+        service = CharacterStateService()
+        sheet = CharacterSheet.objects.select_related("system").get(pk=self.sheet.pk)
+        self.assertEqual(service.recalculate(sheet), {"weight": 61, "heat": 5})
+
+        (prefetched,) = service.with_rules_context(
+            CharacterSheet.objects.filter(pk=self.sheet.pk)
+        )
+        self.assertEqual(service.recalculate(prefetched), {"weight": 61, "heat": 5})
+
+    def test_large_tree_is_loaded_in_one_query(self):
+        CharacterEquipment.objects.bulk_create(
+            CharacterEquipment(
+                character=self.sheet,
+                template=self.scope_template,
+                location="rail",
+                parent_equipment=self.cannon,
+            )
+            for _ in range(300)
+        )
+        sheet = CharacterSheet.objects.select_related("system").get(pk=self.sheet.pk)
+        evaluator = RuleEvaluator(sheet)
+        with self.assertNumQueries(1):
+            self.assertEqual(evaluator.evaluate("equipment_sum('mech', 'weight')"), 361)
+            self.assertEqual(evaluator.evaluate("equipment_max('mech', 'heat')"), 5)
+
+    def test_equipment_meta_reads_the_top_level_item(self):
+        # Вложение в том же слоте, что и его родитель
+        CharacterEquipment.objects.create(
+            character=self.sheet,
+            template=self.scope_template,
+            location="mech",
+            parent_equipment=self.frame,
+        )
+        service = CharacterStateService()
+        for sheet in (
+            CharacterSheet.objects.select_related("system").get(pk=self.sheet.pk),
+            *service.with_rules_context(
+                CharacterSheet.objects.filter(pk=self.sheet.pk)
+            ),
+        ):
+            with self.subTest(prefetched=hasattr(sheet, "_prefetched_objects_cache")):
+                evaluator = RuleEvaluator(sheet)
+                self.assertEqual(
+                    evaluator.evaluate("equipment_meta('mech', 'weight')"), 50
+                )
+                self.assertEqual(
+                    evaluator.evaluate("equipment_meta('rail', 'weight')"), 0
+                )
+
+    def test_attachments_without_prefetched_index(self):
+        frame = CharacterEquipment.objects.select_related("template").get(
+            pk=self.frame.pk
+        )
+        with self.assertNumQueries(1):
+            (data,) = CharacterEquipmentSerializer([frame], many=True).data
+        (cannon,) = data["attachments"]
+        self.assertEqual(cannon["template"]["name"], "Cannon")
+        self.assertEqual(
+            [item["id"] for item in cannon["attachments"]], [self.scope.pk]
+        )
+
+    def test_evaluator_is_not_kept_alive_by_caches(self):
+        sheet = CharacterSheet.objects.select_related("system").get(pk=self.sheet.pk)
+        evaluator = RuleEvaluator(sheet)
+        evaluator.evaluate(
+            "equipment_sum('mech', 'weight') + equipment_meta('mech', 'heat') "
+            "+ trait_meta('Class', 'base_hp')"
+        )
+        reference = weakref.ref(evaluator)
+        del evaluator
+        gc.collect()
+        self.assertIsNone(reference())
+
+    def test_document_nests_attachments(self):
+        self.client.force_login(self.player)
+        response = self.client.get(f"/api/v1/sheets/{self.sheet.pk}/")
+        self.assertEqual(response.status_code, 200)
+        roots = response.json()["equipment"]
+        self.assertEqual([item["id"] for item in roots], [self.frame.pk, self.spare.pk])
+        (cannon,) = roots[0]["attachments"]
+        self.assertEqual(cannon["id"], self.cannon.pk)
+        self.assertEqual(
+            [item["id"] for item in cannon["attachments"]], [self.scope.pk]
+        )
+        self.assertEqual(roots[1]["attachments"], [])
+
+
+class SheetDocumentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        registry.clear()
+        cls.system = GameSystem.objects.create(
+            name="Documents", slug="documents", metadata={}
+        )
+        category = TraitCategory.objects.create(system=cls.system, name="Class")
+        cls.feature = Feature.objects.create(
+            system=cls.system, name="Get Back Up", description="Clear a stress."
+        )
+        cls.trait = CharacterTrait.objects.create(
+            system=cls.system, category=category, name="Guardian"
+        )
+        cls.trait.features.add(cls.feature)
+        cls.template = EquipmentTemplate.objects.create(
+            system=cls.system, name="Leather", metadata={"score": 3}
+        )
+        cls.player = User.objects.create(username="reader")
+        cls.sheet = CharacterSheet.objects.create(
+            player=cls.player, system=cls.system, name="Hero", stats={"level": 1}
+        )
+        cls.sheet.traits.add(cls.trait)
+
+    def setUp(self):
+        self.client.force_login(self.player)
+        self.url = f"/api/v1/sheets/{self.sheet.pk}/"
+
+    def document(self, sheet=None):
+        sheet = sheet or self.sheet
+        return json.loads(
+            bytes(CharacterSheetDocument.objects.get(sheet=sheet).content)
+        )
+
+    def test_document_follows_sheet_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.sheet.name = "Renamed"
+            self.sheet.save()
+        self.assertEqual(self.document()["name"], "Renamed")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            companion = CharacterSheet.objects.create(
+                player=self.player,
+                system=self.system,
+                name="Wolf",
+                controlled_by=self.sheet,
+            )
+        self.assertEqual(
+            [sheet["name"] for sheet in self.document()["companions"]], ["Wolf"]
+        )
+
+        # Документ хозяина включает компаньона и перестраивается вместе с ним
+        with self.captureOnCommitCallbacks(execute=True):
+            companion.name = "Dire Wolf"
+            companion.save()
+        self.assertEqual(self.document()["companions"][0]["name"], "Dire Wolf")
+
+    def test_document_follows_equipment_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            item = CharacterEquipment.objects.create(
+                character=self.sheet, template=self.template, location="armor"
+            )
+        (equipment,) = self.document()["equipment"]
+        self.assertEqual(
+            (equipment["template"]["name"], equipment["location"]),
+            ("Leather", "armor"),
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            item.delete()
+        self.assertEqual(self.document()["equipment"], [])
+
+    def test_document_follows_catalog_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            CharacterEquipment.objects.create(
+                character=self.sheet, template=self.template
+            )
+        # Несколько изменений в одной транзакции дают одну перестройку
+        rebuild = mock.patch.object(
+            SheetDocumentService,
+            "rebuild",
+            autospec=True,
+            side_effect=SheetDocumentService.rebuild,
+        )
+        with rebuild as rebuilds, self.captureOnCommitCallbacks(execute=True):
+            self.trait.name = "Warden"
+            self.trait.save()
+            self.feature.description = "Clear two stress."
+            self.feature.save()
+            self.template.metadata = {"score": 4}
+            self.template.save()
+        self.assertEqual(rebuilds.call_count, 1)
+
+        document = self.document()
+        (trait,) = document["traits"]
+        self.assertEqual(trait["name"], "Warden")
+        self.assertEqual(trait["features"][0]["description"], "Clear two stress.")
+        self.assertEqual(document["equipment"][0]["template"]["metadata"], {"score": 4})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.trait.features.remove(self.feature)
+        self.assertEqual(self.document()["traits"][0]["features"], [])
+
+    def test_rolled_back_changes_are_not_rebuilt(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            rival = CharacterSheet.objects.create(
+                player=self.player, system=self.system, name="Rival"
+            )
+        rebuild = mock.patch.object(
+            SheetDocumentService,
+            "rebuild",
+            autospec=True,
+            side_effect=SheetDocumentService.rebuild,
+        )
+        with rebuild as rebuilds:
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(ValueError), transaction.atomic():
+                    rival.name = "Ghost"
+                    rival.save()
+                    raise ValueError
+            self.assertEqual(rebuilds.call_count, 0)
+
+            # ID откаченного листа не попадают в следующую перестройку
+            with self.captureOnCommitCallbacks(execute=True):
+                self.sheet.name = "Renamed"
+                self.sheet.save()
+        ((_, sheet_ids),) = [call.args for call in rebuilds.call_args_list]
+        self.assertEqual(set(sheet_ids), {self.sheet.pk})
+        self.assertEqual(self.document()["name"], "Renamed")
+
+    def test_missing_document_is_rendered_from_primary(self):
+        CharacterSheetDocument.objects.filter(sheet=self.sheet).delete()
+        render = SheetDocumentService.render
+        replica_reads = []
+
+        def tracking_render(service, sheet):
+            replica_reads.append(db_router._read_from_replica.get())
+            return render(service, sheet)
+
+        with mock.patch.object(SheetDocumentService, "render", tracking_render):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["name"], "Hero")
+        # GET читает с реплик, но документ собирается по основной БД
+        self.assertEqual(replica_reads, [False])
+        self.assertTrue(
+            CharacterSheetDocument.objects.filter(sheet=self.sheet).exists()
+        )
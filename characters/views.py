@@ -1,15 +1,54 @@
+import json
+
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Q
+from django.http import Http404, HttpResponse
 from rest_framework import viewsets, permissions, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from drf_spectacular.utils import extend_schema, extend_schema_view
 
+from core.db_router import ReplicaReadMixin
+from core.engine import dice, eligibility
+from core.engine.evaluator import RuleEvaluator
+from core.metrics import SHEET_DOCUMENT_READS
+from core.models import EquipmentTemplate, Feature
+from core.serializers import FeatureSerializer
+
 from .models import CharacterSheet
 from .permissions import IsOwner
 from .serializers import (
     CharacterSheetListSerializer,
     CharacterSheetDetailSerializer,
     CharacterSheetCreateUpdateSerializer,
+    ConditionsUpdateSerializer,
+    DiceRollRequestSerializer,
+    DiceRollSerializer,
+    EligibleFeaturesRequestSerializer,
+    PartyMemberSerializer,
+    PartyRequestSerializer,
+    PartySerializer,
+    PerformActionSerializer,
+    PreviewRequestSerializer,
+    PreviewSerializer,
+    ProjectionRequestSerializer,
+    ProjectionSerializer,
+)
+from .services import (
+    ActionError,
+    ActionExecutionService,
+    CharacterStateService,
+    ConditionService,
+    PreviewError,
+    PreviewService,
+    ProjectionService,
+    SheetDocumentService,
 )
-from .services import CharacterStateService
 
 
 @extend_schema(tags=["Characters"])
@@ -47,7 +86,7 @@ from .services import CharacterStateService
         description="Безвозвратно удаляет лист персонажа и все связанные с ним данные (инвентарь, компаньоны).",
     ),
 )
-class CharacterSheetViewSet(viewsets.ModelViewSet):
+class CharacterSheetViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     """
     API эндпоинт для управления листами персонажей.
     Требует аутентификации.
@@ -81,26 +120,51 @@ class CharacterSheetViewSet(viewsets.ModelViewSet):
             return CharacterSheetDetailSerializer
         return CharacterSheetListSerializer
 
+    def document_response(self, content, status_code=status.HTTP_200_OK):
+        """
+        Отдает готовый документ листа без повторной сериализации.
+        Для других рендереров (например, browsable API) документ декодируется
+        и отдается через обычный Response.
+        """
+        if isinstance(self.request.accepted_renderer, JSONRenderer):
+            return HttpResponse(
+                content, content_type="application/json", status=status_code
+            )
+        return Response(json.loads(content), status=status_code)
+
+    def retrieve(self, request, *args, **kwargs):
+        # Один запрос по первичному ключу: get_queryset уже ограничивает выборку
+        # листами текущего пользователя, поэтому отдельная проверка IsOwner
+        # по загруженному объекту не нужна.
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        sheet_id, content = get_object_or_404(
+            self.get_queryset().values_list("pk", "document__content"),
+            pk=self.kwargs[lookup_url_kwarg],
+        )
+        SHEET_DOCUMENT_READS.labels("miss" if content is None else "hit").inc()
+        return self.document_response(
+            SheetDocumentService().get_or_build(sheet_id, content)
+        )
+
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        # Стандартное сохранение, которое создает объект и M2M связи
-        instance = serializer.save(player=self.request.user)
+        with transaction.atomic():
+            # Стандартное сохранение, которое создает объект и M2M связи
+            instance = serializer.save(player=self.request.user)
 
-        # Принудительно обновляем инстанс из БД, чтобы подтянуть M2M связи
-        instance.refresh_from_db()
+            # Принудительно обновляем инстанс из БД, чтобы подтянуть M2M связи
+            instance.refresh_from_db()
 
-        # А ТЕПЕРЬ, когда все связи установлены, вызываем сервис
-        state_service = CharacterStateService()
-        recalculated_instance = state_service.recalculate_and_save(character=instance)
+            # А ТЕПЕРЬ, когда все связи установлены, вызываем сервис
+            state_service = CharacterStateService()
+            state_service.recalculate_and_save(character=instance)
 
-        # Формируем ответ на основе самого свежего объекта
-        response_serializer = CharacterSheetDetailSerializer(recalculated_instance)
-        headers = self.get_success_headers(response_serializer.data)
-        return Response(
-            response_serializer.data, status=status.HTTP_201_CREATED, headers=headers
-        )
+            # Документ листа собирается в той же транзакции и сразу отдается
+            content = SheetDocumentService().get_or_build(instance.pk)
+
+        return self.document_response(content, status_code=status.HTTP_201_CREATED)
 
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop("partial", False)
@@ -108,17 +172,269 @@ class CharacterSheetViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
 
-        # Стандартное обновление
-        updated_instance = serializer.save()
+        with transaction.atomic():
+            # Стандартное обновление
+            updated_instance = serializer.save()
+
+            updated_instance.refresh_from_db()
+
+            # И снова вызываем сервис ПОСЛЕ всех операций
+            state_service = CharacterStateService()
+            state_service.recalculate_and_save(character=updated_instance)
+
+            content = SheetDocumentService().get_or_build(updated_instance.pk)
+
+        return self.document_response(content)
+
+    @extend_schema(
+        summary="Сводка партии для экрана мастера",
+        description=(
+            "Возвращает компактные листы (статы, состояния, черты, надетые предметы) "
+            "для списка ID вместе с их компаньонами. Число запросов к БД не зависит "
+            "от размера партии. С recalculate=true вычисляемые статы пересчитываются "
+            "для ответа, без записи в БД."
+        ),
+        parameters=[PartyRequestSerializer],
+        responses={200: PartySerializer},
+    )
+    @action(detail=False, methods=["get"])
+    def party(self, request):
+        params = PartyRequestSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        ids = params.validated_data["ids"]
 
-        updated_instance.refresh_from_db()
+        # Участники и их компаньоны одним запросом; черты и экипировка - prefetch
+        sheets = list(
+            CharacterStateService.with_rules_context(
+                self.queryset.filter(player=request.user).filter(
+                    Q(pk__in=ids, controlled_by__isnull=True) | Q(controlled_by__in=ids)
+                )
+            ).order_by("pk")
+        )
+        if params.validated_data["recalculate"]:
+            state_service = CharacterStateService()
+            for sheet in sheets:
+                state_service.recalculate(sheet)
 
-        # И снова вызываем сервис ПОСЛЕ всех операций
-        state_service = CharacterStateService()
-        recalculated_instance = state_service.recalculate_and_save(
-            character=updated_instance
+        members = {}
+        companions = defaultdict(list)
+        for sheet in sheets:
+            if sheet.controlled_by_id is None:
+                members[sheet.pk] = sheet
+            else:
+                companions[sheet.controlled_by_id].append(sheet)
+        return Response(
+            {
+                "members": PartyMemberSerializer(
+                    [members[pk] for pk in ids if pk in members],
+                    many=True,
+                    context={"companions": companions},
+                ).data,
+                "missing": [pk for pk in ids if pk not in members],
+            }
         )
 
-        # Формируем ответ
-        response_serializer = CharacterSheetDetailSerializer(recalculated_instance)
-        return Response(response_serializer.data)
+    @extend_schema(
+        summary="Бросок кубиков от имени персонажа",
+        description=(
+            "Бросает выражение с кубиками (2d12, 4d6kh3, 2d20kl1, константы, "
+            "stat(), trait_meta(), equipment_meta()) для этого листа и возвращает "
+            "броски и точное распределение результата. С threshold - вероятность "
+            "выбросить не меньше заданного значения (например, порога урона)."
+        ),
+        parameters=[DiceRollRequestSerializer],
+        responses={200: DiceRollSerializer},
+    )
+    @action(detail=True, methods=["get"])
+    def roll(self, request, pk=None):
+        params = DiceRollRequestSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+
+        sheet = self.get_object()
+        try:
+            node = RuleEvaluator(sheet).bind_dice(params["expression"])
+        except ValueError as e:
+            raise ValidationError({"expression": str(e)})
+
+        # Распределение кэшируется по выражению после подстановки статов
+        outcome = dice.distribution(node)
+        summary = {
+            "min": outcome.min,
+            "max": outcome.max,
+            "mean": outcome.mean,
+            "stddev": outcome.stddev,
+        }
+        if "threshold" in params:
+            summary["at_least"] = outcome.at_least(params["threshold"])
+        if params["distribution"]:
+            summary["probabilities"] = outcome.as_dict()
+
+        return Response(
+            {
+                "expression": params["expression"],
+                "resolved": dice.to_string(node),
+                "rolls": dice.roll(node, params["count"]).tolist(),
+                "distribution": summary,
+            }
+        )
+
+    @extend_schema(
+        summary="Особенности, доступные персонажу",
+        description=(
+            "Возвращает особенности, которые лист может взять: открытые его "
+            "чертами (grants_access_to, привязанные к черте), с level_requirement "
+            "не выше уровня листа и с выполненным required_trait. Уже полученные "
+            "особенности и чужие пользовательские не возвращаются."
+        ),
+        parameters=[EligibleFeaturesRequestSerializer],
+        responses={200: FeatureSerializer(many=True)},
+    )
+    @action(detail=True, methods=["get"], url_path="eligible-features")
+    def eligible_features(self, request, pk=None):
+        params = EligibleFeaturesRequestSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+
+        sheet = get_object_or_404(self.get_queryset().select_related("system"), pk=pk)
+        index = eligibility.get_index(sheet.system)
+        feature_ids = index.eligible(
+            sheet,
+            trait_ids=sheet.traits.values_list("pk", flat=True),
+            owned_ids=list(sheet.features.values_list("pk", flat=True)),
+            feature_type=params.validated_data.get("type"),
+        )
+
+        # Страница - срез списка ID; из БД читается только она
+        page = self.paginate_queryset(feature_ids)
+        features = Feature.objects.select_related("feature_set").in_bulk(page)
+        serializer = FeatureSerializer(
+            [features[feature_id] for feature_id in page if feature_id in features],
+            many=True,
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @extend_schema(
+        summary="Предпросмотр изменений листа",
+        description=(
+            "Вычисляет статы листа с предлагаемыми чертами, особенностями, "
+            "экипировкой и статами, ничего не сохраняя. Черты и предметы "
+            "берутся из каталога правил в памяти, поэтому полный набор изменений "
+            "стоит одного запроса (загрузка листа)."
+        ),
+        request=PreviewRequestSerializer,
+        responses={200: PreviewSerializer},
+    )
+    @action(detail=True, methods=["post"])
+    def preview(self, request, pk=None):
+        params = PreviewRequestSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+
+        sheet = get_object_or_404(self.get_queryset().select_related("system"), pk=pk)
+        equipment = params.get("equipment")
+        if equipment is not None:
+            equipment = [(item["location"], item["template"]) for item in equipment]
+        try:
+            result = PreviewService().preview(
+                sheet,
+                stats=params.get("stats"),
+                traits=params.get("traits"),
+                features=params.get("features"),
+                equipment=equipment,
+            )
+        except PreviewError as e:
+            raise ValidationError(e.detail)
+        return Response(result)
+
+    @extend_schema(
+        summary="Прогрессия статов по уровням",
+        description=(
+            "Вычисляет вычисляемые статы листа для каждого значения stat (по "
+            "умолчанию level) от start до end, а с equipment - и для каждого "
+            "альтернативного предмета в его слоте. Лист не изменяется."
+        ),
+        parameters=[ProjectionRequestSerializer],
+        responses={200: ProjectionSerializer},
+    )
+    @action(detail=True, methods=["get"])
+    def projection(self, request, pk=None):
+        params = ProjectionRequestSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+
+        sheet = get_object_or_404(
+            CharacterStateService.with_rules_context(self.get_queryset()), pk=pk
+        )
+        template_ids = params.get("equipment", [])
+        templates = EquipmentTemplate.objects.filter(system_id=sheet.system_id).in_bulk(
+            template_ids
+        )
+        missing = [
+            template_id for template_id in template_ids if template_id not in templates
+        ]
+        if missing:
+            raise ValidationError({"equipment": f"Unknown equipment: {missing}"})
+
+        return Response(
+            ProjectionService().project(
+                sheet,
+                params["stat"],
+                range(params["start"], params["end"] + 1),
+                [templates[template_id] for template_id in template_ids],
+            )
+        )
+
+    @extend_schema(
+        summary="Выполнить игровое действие",
+        description=(
+            "Выполняет действие из available_actions правил системы (например, "
+            "short_rest или level_up): все эффекты применяются в одной транзакции, "
+            "затем пересчитываются зависящие от них статы. Возвращает лист."
+        ),
+        request=PerformActionSerializer,
+        responses={200: CharacterSheetDetailSerializer},
+    )
+    @action(detail=True, methods=["post"])
+    def perform_action(self, request, pk=None):
+        params = PerformActionSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            try:
+                sheet, _ = ActionExecutionService().perform(
+                    self.get_queryset(), pk, params.validated_data["action_type"]
+                )
+            except CharacterSheet.DoesNotExist:
+                raise Http404
+            except ActionError as e:
+                raise ValidationError({"action_type": str(e)})
+            content = SheetDocumentService().get_or_build(sheet.pk)
+
+        return self.document_response(content)
+
+    @extend_schema(
+        summary="Включить или снять состояния",
+        description=(
+            "Добавляет состояния из add и снимает состояния из remove. "
+            "Модификаторы состояний из правил системы (conditions) сразу "
+            "применяются к вычисляемым статам, без пересчета формул. Состояния, "
+            "которых нет в правилах, сохраняются и на статы не влияют."
+        ),
+        request=ConditionsUpdateSerializer,
+        responses={200: CharacterSheetDetailSerializer},
+    )
+    @action(detail=True, methods=["post"])
+    def conditions(self, request, pk=None):
+        params = ConditionsUpdateSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+
+        with transaction.atomic():
+            try:
+                sheet, _ = ConditionService().update(
+                    self.get_queryset(), pk, **params.validated_data
+                )
+            except CharacterSheet.DoesNotExist:
+                raise Http404
+            content = SheetDocumentService().get_or_build(sheet.pk)
+
+        return self.document_response(content)
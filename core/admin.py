@@ -8,38 +8,102 @@ from .models import (
     Feature,
     EquipmentTemplate,
 )
+from .pagination import EstimatedCountPaginator
 
-# Для удобства можно создать кастомные классы админки
-# Например, чтобы фильтровать по системе или категории
+
+class HighVolumeAdmin(admin.ModelAdmin):
+    """
+    Базовый класс админки для больших таблиц (каталог с homebrew, листы персонажей).
+    Не считает точное число строк на каждой странице, а связи, которые
+    используются в __str__, должны подтягиваться через list_select_related.
+    """
+
+    paginator = EstimatedCountPaginator
+    # Не выполнять второй COUNT(*) по всей таблице при фильтрации
+    show_full_result_count = False
+
+
+class SystemRelatedListFilter(admin.RelatedFieldListFilter):
+    """
+    Фильтр по связанной модели каталога, чей __str__ обращается к системе.
+    Подтягивает систему одним JOIN и, если уже выбран фильтр по системе,
+    показывает варианты только из нее.
+    """
+
+    def field_choices(self, field, request, model_admin):
+        queryset = field.related_model._default_manager.select_related("system")
+        system_id = request.GET.get("system__id__exact")
+        if system_id and system_id.isdigit():
+            queryset = queryset.filter(system_id=system_id)
+        ordering = self.field_admin_ordering(field, request, model_admin)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return [(obj.pk, str(obj)) for obj in queryset]
 
 
 @admin.register(GameSystem)
 class GameSystemAdmin(admin.ModelAdmin):
-    list_display = ("name", "version", "slug")
+    list_display = ("name", "version", "slug", "catalog_version", "rules_version")
+    search_fields = ("name", "slug")
+
+
+@admin.register(TraitCategory)
+class TraitCategoryAdmin(HighVolumeAdmin):
+    list_display = ("name", "system")
+    list_filter = ("system",)
+    list_select_related = ("system",)
+    search_fields = ("name",)
+    autocomplete_fields = ("system",)
+
+
+@admin.register(DamageType)
+class DamageTypeAdmin(HighVolumeAdmin):
+    list_display = ("name", "system")
+    list_filter = ("system",)
+    list_select_related = ("system",)
+    search_fields = ("name",)
+    autocomplete_fields = ("system",)
+
+
+@admin.register(FeatureSet)
+class FeatureSetAdmin(HighVolumeAdmin):
+    list_display = ("name", "set_type", "system")
+    list_filter = ("system", "set_type")
+    list_select_related = ("system",)
+    search_fields = ("name",)
+    autocomplete_fields = ("system",)
 
 
 @admin.register(CharacterTrait)
-class CharacterTraitAdmin(admin.ModelAdmin):
+class CharacterTraitAdmin(HighVolumeAdmin):
     list_display = ("name", "category", "system", "parent")
-    list_filter = ("system", "category")
+    list_filter = ("system", ("category", SystemRelatedListFilter))
+    # __str__ родителя тоже обращается к его категории и системе
+    list_select_related = (
+        "category__system",
+        "system",
+        "parent__category",
+        "parent__system",
+    )
     search_fields = ("name", "description")
+    autocomplete_fields = ("system", "category", "parent", "features")
 
 
 @admin.register(Feature)
-class FeatureAdmin(admin.ModelAdmin):
+class FeatureAdmin(HighVolumeAdmin):
     list_display = ("name", "system", "feature_set", "created_by")
-    list_filter = ("system", "feature_set", "created_by")
-    search_fields = ("name", "description")
+    # Фильтр по автору показывает только "официальная/homebrew",
+    # а не выпадающий список всех пользователей
+    list_filter = ("system", ("created_by", admin.EmptyFieldListFilter))
+    list_select_related = ("system", "feature_set__system", "created_by")
+    search_fields = ("name", "description", "feature_set__name")
+    autocomplete_fields = ("system", "feature_set", "created_by")
 
 
 @admin.register(EquipmentTemplate)
-class EquipmentTemplateAdmin(admin.ModelAdmin):
+class EquipmentTemplateAdmin(HighVolumeAdmin):
     list_display = ("name", "system")
     list_filter = ("system",)
+    list_select_related = ("system",)
     search_fields = ("name", "description")
-
-
-# Простая регистрация для остальных моделей
-admin.site.register(DamageType)
-admin.site.register(TraitCategory)
-admin.site.register(FeatureSet)
+    autocomplete_fields = ("system",)
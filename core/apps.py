@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "core"
+
+    def ready(self):
+        # Подключаем сигналы, отслеживающие изменения каталога
+        from . import signals  # noqa: F401
+        from .engine import registry
+
+        registry.preload_snapshots()
@@ -0,0 +1,306 @@
+"""
+Воспроизводимый набор бенчмарков движка правил, пересчета листов,
+сериализации, эндпоинтов каталога и загрузчика сидов.
+
+Данные генерируются детерминированно (``core.loader.synthetic``) в текущей БД
+внутри транзакции, которая затем откатывается, поэтому набор можно запускать
+и на SQLite, и на локальном PostgreSQL. Запуск - командой ``run_benchmarks``.
+
+Каждый результат - медиана и p95 времени одного вызова и число SQL-запросов
+на вызов. ``compare`` сравнивает результаты с сохраненным базовым прогоном:
+время может вырасти не больше чем на ``tolerance``, число запросов - никак.
+"""
+
+import itertools
+import platform
+import statistics
+import time
+
+import django
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.utils import timezone
+
+from characters.models import CharacterEquipment, CharacterSheet
+from characters.serializers import CharacterSheetListSerializer
+from characters.services import CharacterStateService, SheetDocumentService
+from core.engine.evaluator import RuleEvaluator
+from core.engine.parser import compile_formula
+from core.loader.loader import SystemLoader
+from core.loader.synthetic import EQUIPMENT_LOCATIONS, generate_system_records
+from core.models import CharacterTrait, EquipmentTemplate
+from core.profiling import QueryCounter
+
+# Размер сгенерированной системы при scale=1
+SYSTEM_SIZE = {"features": 2000, "traits": 1000, "equipment": 300, "formulas": 30}
+# Число черт и предметов у листов разного размера
+SHEET_SIZES = {"small": 2, "medium": 10, "large": 40}
+SHEETS_PER_PLAYER = 20
+
+SCENARIOS = ("evaluator", "recalc", "serialization", "api", "loader")
+
+
+def run(name, func, repeat, number=1, setup=None):
+    """
+    Вызывает ``func`` ``repeat`` раз по ``number`` вызовов (после одного
+    прогревочного) и возвращает время одного вызова и число запросов на вызов.
+    ``setup`` выполняется перед каждым замером и в него не входит.
+    """
+    if setup:
+        setup()
+    func()
+
+    timings = []
+    queries = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            elapsed = time.perf_counter() - start
+        timings.append(elapsed / number)
+        queries.append(counter.count / number)
+
+    timings.sort()
+    median = statistics.median(timings)
+    return {
+        "name": name,
+        "median_ms": round(median * 1000, 4),
+        "p95_ms": round(timings[int(0.95 * (len(timings) - 1))] * 1000, 4),
+        "min_ms": round(timings[0] * 1000, 4),
+        "ops_per_second": round(1 / median, 1) if median else None,
+        "queries": max(queries),
+    }
+
+
+class BenchmarkData:
+    """Синтетическая система и листы игрока разного размера."""
+
+    def __init__(self, scale=1.0):
+        self.params = {
+            key: max(1, int(value * scale)) for key, value in SYSTEM_SIZE.items()
+        }
+        report = SystemLoader().load(
+            generate_system_records(slug="benchmark", **self.params)
+        )
+        self.system = report.system
+        self.player = User.objects.create(username="benchmark-player")
+        self.sheets = {
+            size: self.create_sheet(f"Benchmark {size}", count)
+            for size, count in SHEET_SIZES.items()
+        }
+        # Остальные листы нужны только для списка
+        for index in range(SHEETS_PER_PLAYER - len(self.sheets)):
+            self.create_sheet(f"Benchmark filler {index}", SHEET_SIZES["small"])
+
+        # Документы обычно строятся после коммита, а здесь транзакция откатывается
+        SheetDocumentService().rebuild([sheet.pk for sheet in self.sheets.values()])
+
+    def create_sheet(self, name, size):
+        sheet = CharacterSheet.objects.create(
+            player=self.player, system=self.system, name=name, stats={"level": 3}
+        )
+        # Формулам нужен ровно один класс; остальные черты - нагрузка
+        # на сериализацию
+        traits = CharacterTrait.objects.filter(system=self.system).order_by("pk")
+        sheet.traits.add(
+            traits.filter(category__name="Class").first(),
+            *traits.exclude(category__name="Class").values_list("pk", flat=True)[
+                : size - 1
+            ],
+        )
+        templates = EquipmentTemplate.objects.filter(system=self.system).order_by("pk")
+        # Движок ищет один предмет в слоте: лишние предметы лежат в инвентаре
+        locations = itertools.chain(EQUIPMENT_LOCATIONS, itertools.repeat("inventory"))
+        CharacterEquipment.objects.bulk_create(
+            CharacterEquipment(
+                character=sheet,
+                template=template,
+                location=location,
+            )
+            for template, location in zip(templates[:size], locations)
+        )
+        return sheet
+
+    @property
+    def formulas(self):
+        schema = self.system.metadata["character_sheet_schema"]
+        return [rule["formula"] for rule in schema["computed_stats"].values()]
+
+
+def bench_evaluator(data, repeat):
+    formulas = data.formulas
+    sheet = data.sheets["medium"]
+    evaluator = RuleEvaluator(sheet)
+
+    def compile_all():
+        for formula in formulas:
+            # Без кэша compile_formula: измеряем сам разбор
+            compile_formula.__wrapped__(formula)
+
+    def evaluate_all():
+        for formula in formulas:
+            evaluator.evaluate(formula)
+
+    results = [
+        run("evaluator.compile", compile_all, repeat, number=10),
+        run("evaluator.evaluate", evaluate_all, repeat, number=10),
+    ]
+    for result in results:
+        result["formulas"] = len(formulas)
+    return results
+
+
+def bench_recalc(data, repeat):
+    service = CharacterStateService()
+    results = []
+    for size, sheet in data.sheets.items():
+
+        def reset(sheet=sheet):
+            # Иначе пересчет увидит неизменившиеся статы и ничего не запишет
+            sheet.stats = {"level": 3}
+
+        results.append(
+            run(
+                f"recalc.{size}",
+                lambda sheet=sheet: service.recalculate_and_save(sheet),
+                repeat,
+                setup=reset,
+            )
+        )
+    return results
+
+
+def bench_serialization(data, repeat):
+    documents = SheetDocumentService()
+    results = []
+    for size, sheet in data.sheets.items():
+        results.append(
+            run(
+                f"serialize.detail.{size}",
+                lambda sheet=sheet: documents.render(
+                    documents.get_queryset().get(pk=sheet.pk)
+                ),
+                repeat,
+            )
+        )
+
+    sheets = CharacterSheet.objects.filter(player=data.player).select_related("system")
+    results.append(
+        run(
+            "serialize.list",
+            lambda: CharacterSheetListSerializer(sheets.all(), many=True).data,
+            repeat,
+        )
+    )
+    return results
+
+
+def bench_api(data, repeat):
+    client = Client()
+    client.force_login(data.player)
+    system = data.system.pk
+    endpoints = {
+        "api.systems.list": "/api/v1/systems/",
+        "api.systems.retrieve": f"/api/v1/systems/{system}/",
+        "api.traits.list": f"/api/v1/systems/{system}/traits/?category=Class",
+        "api.features.list": "/api/v1/features/",
+        "api.equipment.list": "/api/v1/equipment-templates/",
+        "api.sheets.list": "/api/v1/sheets/",
+        "api.sheets.retrieve": f"/api/v1/sheets/{data.sheets['large'].pk}/",
+    }
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+
+    return [
+        run(name, lambda url=url: get(url), repeat) for name, url in endpoints.items()
+    ]
+
+
+def bench_loader(data, repeat):
+    slugs = (f"benchmark-load-{index}" for index in itertools.count())
+    last = []
+
+    def initial():
+        slug = next(slugs)
+        SystemLoader().load(generate_system_records(slug=slug, **data.params))
+        last[:] = [slug]
+
+    def reload():
+        # Тот же сид еще раз: загрузчик сравнивает хэши и ничего не пишет
+        SystemLoader().load(generate_system_records(slug=last[0], **data.params))
+
+    # Загрузка целой системы на порядки дольше остальных сценариев
+    repeat = max(1, repeat // 5)
+    return [
+        run("loader.initial", initial, repeat),
+        run("loader.reload", reload, repeat),
+    ]
+
+
+BENCHMARKS = {
+    "evaluator": bench_evaluator,
+    "recalc": bench_recalc,
+    "serialization": bench_serialization,
+    "api": bench_api,
+    "loader": bench_loader,
+}
+
+
+def run_suite(scenarios=SCENARIOS, repeat=20, scale=1.0):
+    """
+    Запускает выбранные сценарии. Вызывать внутри транзакции, которая будет
+    откачена: набор создает систему, пользователя и листы.
+    """
+    data = BenchmarkData(scale=scale)
+    results = []
+    for scenario in scenarios:
+        results.extend(BENCHMARKS[scenario](data, repeat))
+    return {
+        "meta": {
+            "created": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "repeat": repeat,
+            "scale": scale,
+            "system": data.params,
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Сравнивает результаты с базовым прогоном. Возвращает список
+    (имя, описание) для регрессий; сценарии без базы пропускаются.
+    """
+    base = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results["results"]:
+        previous = base.get(result["name"])
+        if previous is None:
+            continue
+        if result["queries"] > previous["queries"]:
+            regressions.append(
+                (
+                    result["name"],
+                    f"queries {previous['queries']:g} -> {result['queries']:g}",
+                )
+            )
+        limit = previous["median_ms"] * (1 + tolerance)
+        if result["median_ms"] > limit:
+            change = result["median_ms"] / previous["median_ms"] - 1
+            regressions.append(
+                (
+                    result["name"],
+                    f"median {previous['median_ms']:.3f}ms -> "
+                    f"{result['median_ms']:.3f}ms (+{change:.0%})",
+                )
+            )
+    return regressions
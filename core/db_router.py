@@ -0,0 +1,152 @@
+"""
+Маршрутизация чтения на реплики PostgreSQL.
+
+Чтение уходит на реплику, только если запрос явно это разрешил
+(``replica_reads()``, см. ``ReplicaReadMixin``) и модель относится к данным
+приложения (каталог и листы). Сессии, пользователи и все записи всегда идут
+в ``default``. После собственной записи пользователь на короткое время
+"прикрепляется" к основной БД через cookie (read-your-writes), а реплика
+с отставанием больше ``REPLICA_MAX_LAG_SECONDS`` временно не используется.
+"""
+
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from rest_framework import permissions
+
+# Приложения, модели которых можно читать с реплик
+REPLICA_APPS = ("core", "characters")
+# Как часто (в секундах) перепроверять отставание каждой реплики
+LAG_CHECK_INTERVAL = 5
+PIN_COOKIE = "db_primary_pin"
+
+_read_from_replica = ContextVar("read_from_replica", default=False)
+
+_lag_lock = threading.Lock()
+# alias -> (время проверки, реплика пригодна для чтения)
+_lag_checks = {}
+
+LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0
+        )
+    END
+"""
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Разрешает (или запрещает) чтение с реплик внутри блока."""
+    token = _read_from_replica.set(enabled)
+    try:
+        yield
+    finally:
+        _read_from_replica.reset(token)
+
+
+def replica_aliases():
+    return list(getattr(settings, "REPLICA_DATABASES", []))
+
+
+def replica_lag(alias):
+    """
+    Отставание реплики в секундах. Для не-PostgreSQL (локальные SQLite-алиасы)
+    и для основной БД (функции реплики возвращают NULL) - 0.
+    """
+    connection = connections[alias]
+    if connection.vendor != "postgresql":
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(LAG_SQL)
+        lag = cursor.fetchone()[0]
+    return float(lag or 0)
+
+
+def is_replica_healthy(alias):
+    """Реплика доступна и отстает не больше REPLICA_MAX_LAG_SECONDS (с кэшем)."""
+    max_lag = getattr(settings, "REPLICA_MAX_LAG_SECONDS", None)
+    if max_lag is None:
+        return True
+
+    now = time.monotonic()
+    checked = _lag_checks.get(alias)
+    if checked is not None and now - checked[0] < LAG_CHECK_INTERVAL:
+        return checked[1]
+
+    with _lag_lock:
+        checked = _lag_checks.get(alias)
+        if checked is not None and now - checked[0] < LAG_CHECK_INTERVAL:
+            return checked[1]
+        try:
+            healthy = replica_lag(alias) <= max_lag
+        except DatabaseError:
+            healthy = False
+            connections[alias].close()
+        _lag_checks[alias] = (now, healthy)
+    return healthy
+
+
+def clear_lag_checks():
+    """Сбрасывает кэш проверок отставания (для тестов)."""
+    with _lag_lock:
+        _lag_checks.clear()
+
+
+class ReplicaRouter:
+    """
+    Роутер Django: чтение данных приложения - с исправной реплики, если
+    текущий запрос это разрешил, все остальное - с основной БД.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not _read_from_replica.get():
+            return None
+        if model._meta.app_label not in REPLICA_APPS:
+            return None
+        healthy = [alias for alias in replica_aliases() if is_replica_healthy(alias)]
+        if not healthy:
+            return None
+        return random.choice(healthy)
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и основная БД
+        databases = {"default", *replica_aliases()}
+        return obj1._state.db in databases and obj2._state.db in databases
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replica_aliases()
+
+
+def is_pinned_to_primary(request):
+    return PIN_COOKIE in request.COOKIES
+
+
+class ReplicaReadMixin:
+    """
+    Миксин для ViewSet'ов: безопасные запросы (GET, HEAD, OPTIONS) читают
+    с реплик, а после небезопасного запроса клиент на REPLICA_PIN_SECONDS
+    прикрепляется к основной БД, чтобы сразу видеть свои изменения.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        safe = request.method in permissions.SAFE_METHODS
+        use_replica = safe and not is_pinned_to_primary(request)
+        with replica_reads(use_replica):
+            response = super().dispatch(request, *args, **kwargs)
+
+        pin_seconds = getattr(settings, "REPLICA_PIN_SECONDS", 0)
+        if not safe and pin_seconds and replica_aliases():
+            response.set_cookie(
+                PIN_COOKIE, "1", max_age=pin_seconds, httponly=True, samesite="Lax"
+            )
+        return response
@@ -0,0 +1,122 @@
+"""
+Модификаторы состояний (conditions) листа.
+
+Состояния описываются в правилах системы рядом со схемой листа::
+
+    "conditions": {
+        "vulnerable": {
+            "label": "Vulnerable",
+            "modifiers": {"damage_threshold_major": -2, "evasion": -1}
+        },
+        "hidden": {"label": "Hidden", "modifiers": {"evasion": 2}}
+    }
+
+Модификатор - целое число, которое прибавляется к вычисляемому стату.
+Состояния - последний слой поверх формул: в ``stats`` листа хранятся значения
+с учетом активных состояний, формулы же всегда видят базовые значения (слой
+снимается перед пересчетом и накладывается после). При включении
+и выключении состояния заново вычисляются только статы, затронутые слоем.
+
+Таблица модификаторов собирается из правил один раз и живет в процессе,
+пока не изменится GameSystem.rules_version. Состояния, которых нет
+в правилах, по-прежнему допустимы и на статы не влияют.
+"""
+
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# system_id -> ModifierTable
+_tables = {}
+
+
+class ModifierTable:
+    """Модификаторы состояний одной системы для одной версии правил."""
+
+    def __init__(self, rules):
+        self.system_id = rules.system_id
+        self.rules_version = rules.rules_version
+        metadata = rules.metadata or {}
+        computed_stats = metadata.get("character_sheet_schema", {}).get(
+            "computed_stats", {}
+        )
+
+        # состояние -> ((стат, модификатор), ...)
+        self.modifiers = {}
+        self.labels = {}
+        for name, condition in (metadata.get("conditions") or {}).items():
+            condition = condition or {}
+            self.labels[name] = condition.get("label", name)
+            modifiers = []
+            for stat_name, value in (condition.get("modifiers") or {}).items():
+                if stat_name not in computed_stats:
+                    # Обычные статы задает игрок: модификатор смешался бы с его
+                    # значением
+                    logger.warning(
+                        "Condition %s modifies %s, which is not a computed stat",
+                        name,
+                        stat_name,
+                    )
+                    continue
+                if isinstance(value, bool) or not isinstance(value, int):
+                    logger.warning(
+                        "Condition %s has a non-integer modifier for %s: %r",
+                        name,
+                        stat_name,
+                        value,
+                    )
+                    continue
+                if value:
+                    modifiers.append((stat_name, value))
+            self.modifiers[name] = tuple(modifiers)
+
+    def __contains__(self, condition):
+        return condition in self.modifiers
+
+    def totals(self, conditions):
+        """Суммарные модификаторы по статам для списка активных состояний."""
+        result = defaultdict(int)
+        for condition in set(conditions or ()):
+            for stat_name, value in self.modifiers.get(condition, ()):
+                result[stat_name] += value
+        return {stat_name: value for stat_name, value in result.items() if value}
+
+
+def get_table(rules):
+    """
+    Таблица модификаторов для объекта правил из ``registry.get_rules``;
+    пересобирается при изменении версии правил.
+    """
+    table = _tables.get(rules.system_id)
+    if table is not None and table.rules_version == rules.rules_version:
+        return table
+    with _lock:
+        table = _tables.get(rules.system_id)
+        if table is None or table.rules_version != rules.rules_version:
+            table = ModifierTable(rules)
+            _tables[rules.system_id] = table
+    return table
+
+
+def apply(stats, modifiers, sign=1):
+    """
+    Прибавляет (или при ``sign=-1`` вычитает) модификаторы к статам на месте.
+    Статы, которых в словаре еще нет (лист не пересчитывался), пропускаются.
+    """
+    for stat_name, value in modifiers.items():
+        if stat_name not in stats:
+            continue
+        try:
+            current = int(stats.get(stat_name, 0))
+        except (TypeError, ValueError):
+            current = 0
+        stats[stat_name] = current + sign * value
+
+
+def clear():
+    """Сбрасывает таблицы (для тестов и бенчмарков)."""
+    with _lock:
+        _tables.clear()
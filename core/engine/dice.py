@@ -0,0 +1,455 @@
+"""
+Выражения с кубиками: разбор, броски и точные распределения.
+
+Грамматика - формулы правил (см. ``parser``), в которых вместо умножения
+и деления есть кубики::
+
+    expr  := ["-"] atom (("+" | "-") atom)*
+    atom  := DICE | NUMBER | call | "(" expr ")"
+    DICE  := [N] "d" M [("kh" | "kl") K]     # 2d12, d6, 4d6kh3, 2d20kl1
+
+Узлы дерева - как в ``parser``, плюс ``("dice", N, M, режим, K)``, где режим -
+``"kh"``/``"kl"`` (оставить K старших/младших) или ``None``.
+
+Вызовы функций (``stat('agility')``) сначала подставляются для конкретного
+листа (``bind``), после чего выражение содержит только кубики и числа.
+Распределение такого выражения считается точно - сверткой распределений
+отдельных групп кубиков - и кэшируется: повторный вопрос "какой шанс выбросить
+не меньше 15" сводится к чтению из готового массива.
+"""
+
+import math
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from .parser import FUNCTIONS, TOKEN_RE, FormulaError
+
+DICE_RE = re.compile(
+    r"\s*(?P<count>\d*)d(?P<sides>\d+)(?:(?P<keep_mode>kh|kl)(?P<keep>\d+))?(?!\w)"
+)
+
+# Ограничения, чтобы одно выражение не занимало воркер надолго
+MAX_DICE = 100
+MAX_SIDES = 1000
+# Размах суммы одной группы (N * M): от него зависит длина массивов при свертке
+MAX_GROUP_RANGE = 10000
+# То же на все выражение: свертка групп стоит до (сумма N * M)^2 / 2 операций
+MAX_EXPRESSION_RANGE = 20000
+MAX_DICE_GROUPS = 20
+# Для "оставить K из N" распределение считается перебором исходов по граням
+MAX_KEEP_DICE = 12
+# Оценка работы _dice_keep (см. keep_work) на все выражение: ~0.2 с
+MAX_KEEP_WORK = 20_000_000
+MAX_ROLLS = 100000
+
+
+class DiceError(FormulaError):
+    """Некорректное выражение с кубиками."""
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = DICE_RE.match(expression, position)
+        if match:
+            count = int(match.group("count") or 1)
+            sides = int(match.group("sides"))
+            keep_mode = match.group("keep_mode")
+            keep = int(match.group("keep")) if keep_mode else None
+            tokens.append(("dice", (count, sides, keep_mode, keep)))
+            position = match.end()
+            continue
+        match = TOKEN_RE.match(expression, position)
+        if not match:
+            raise DiceError(
+                f"Unexpected character at position {position} in: {expression}"
+            )
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            tokens.append(("number", int(value)))
+        elif kind in ("squote", "dquote"):
+            tokens.append(("string", value))
+        else:
+            tokens.append((kind, value))
+    return tokens
+
+
+def keep_work(count, sides, keep):
+    """
+    Оценка числа шагов _dice_keep: грани (M) x состояния (N * K * K * M)
+    x варианты числа кубиков на грани (N).
+    """
+    return (count * keep * sides) ** 2
+
+
+class _DiceParser:
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.position = 0
+        # Суммарная оценка работы по всем группам kh/kl выражения
+        self.keep_work = 0
+        # Число групп кубиков и суммарный размах (N * M) по выражению
+        self.groups = 0
+        self.range = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if (
+            token[0] is None
+            or (kind and token[0] != kind)
+            or (value and token[1] != value)
+        ):
+            expected = value or kind or "a token"
+            raise DiceError(f"Expected {expected} in: {self.expression}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise DiceError("Empty dice expression")
+        node = self.expr()
+        if self.position != len(self.tokens):
+            raise DiceError(f"Unexpected token in: {self.expression}")
+        return node
+
+    def expr(self):
+        if self.peek() == ("punct", "-"):
+            self.take()
+            node = ("neg", self.atom())
+        else:
+            node = self.atom()
+        while self.peek() in (("punct", "+"), ("punct", "-")):
+            operator = self.take()[1]
+            node = ("op", operator, node, self.atom())
+        return node
+
+    def atom(self):
+        kind, value = self.peek()
+        if kind == "dice":
+            self.take()
+            return self.dice(*value)
+        if kind == "number":
+            self.take()
+            return ("num", value)
+        if kind == "name":
+            return self.call()
+        if (kind, value) == ("punct", "("):
+            self.take()
+            node = self.expr()
+            self.take("punct", ")")
+            return node
+        raise DiceError(f"Invalid term in: {self.expression}")
+
+    def dice(self, count, sides, keep_mode, keep):
+        if not 1 <= count <= MAX_DICE:
+            raise DiceError(f"Dice count must be between 1 and {MAX_DICE}")
+        if not 1 <= sides <= MAX_SIDES:
+            raise DiceError(f"Dice sides must be between 1 and {MAX_SIDES}")
+        if count * sides > MAX_GROUP_RANGE:
+            raise DiceError(f"{count}d{sides} has too many outcomes")
+        self.groups += 1
+        if self.groups > MAX_DICE_GROUPS:
+            raise DiceError(f"At most {MAX_DICE_GROUPS} dice groups per expression")
+        self.range += count * sides
+        if self.range > MAX_EXPRESSION_RANGE:
+            raise DiceError(
+                "Too many outcomes in the expression, use fewer dice or sides"
+            )
+        if keep_mode:
+            if not 1 <= keep <= count:
+                raise DiceError(f"Cannot keep {keep} of {count} dice")
+            if keep == count:
+                keep_mode = keep = None
+            elif count > MAX_KEEP_DICE:
+                raise DiceError(
+                    f"At most {MAX_KEEP_DICE} dice are supported with kh/kl"
+                )
+            else:
+                self.keep_work += keep_work(count, sides, keep)
+                if self.keep_work > MAX_KEEP_WORK:
+                    raise DiceError(
+                        "Too many outcomes to compute with kh/kl, "
+                        "use fewer dice or sides"
+                    )
+        return ("dice", count, sides, keep_mode, keep)
+
+    def call(self):
+        name = self.take("name")[1]
+        if name not in FUNCTIONS:
+            raise DiceError(f"Unknown function: {name}")
+        self.take("punct", "(")
+        args = []
+        if self.peek() != ("punct", ")"):
+            while True:
+                kind, value = self.peek()
+                if kind not in ("string", "number"):
+                    raise DiceError(
+                        f"Function arguments must be literals in: {self.expression}"
+                    )
+                self.take()
+                args.append(value)
+                if self.peek() != ("punct", ","):
+                    break
+                self.take()
+        self.take("punct", ")")
+        if len(args) != FUNCTIONS[name]:
+            raise DiceError(
+                f"Function {name} expects {FUNCTIONS[name]} arguments, got {len(args)}"
+            )
+        return ("call", name, tuple(args))
+
+
+@lru_cache(maxsize=4096)
+def compile_dice(expression):
+    """Разбирает выражение с кубиками в AST. Результат кэшируется."""
+    return _DiceParser(expression).parse()
+
+
+def bind(node, call):
+    """
+    Подставляет значения функций (``call(name, args)``, как в ``evaluate_ast``)
+    и сворачивает константы: в результате остаются только кубики и числа.
+    """
+    kind = node[0]
+    if kind == "call":
+        return ("num", int(call(node[1], node[2])))
+    if kind == "neg":
+        operand = bind(node[1], call)
+        if operand[0] == "num":
+            return ("num", -operand[1])
+        return ("neg", operand)
+    if kind == "op":
+        left = bind(node[2], call)
+        right = bind(node[3], call)
+        if left[0] == "num" and right[0] == "num":
+            if node[1] == "+":
+                return ("num", left[1] + right[1])
+            return ("num", left[1] - right[1])
+        return ("op", node[1], left, right)
+    return node
+
+
+def to_string(node):
+    """Выражение (например, после ``bind``) обратно в текст."""
+    kind = node[0]
+    if kind == "num":
+        return str(node[1])
+    if kind == "dice":
+        _, count, sides, keep_mode, keep = node
+        return f"{count}d{sides}" + (f"{keep_mode}{keep}" if keep_mode else "")
+    if kind == "call":
+        return f"{node[1]}({', '.join(repr(arg) for arg in node[2])})"
+    if kind == "neg":
+        operand = to_string(node[1])
+        return f"-({operand})" if node[1][0] == "op" else f"-{operand}"
+    right = to_string(node[3])
+    if node[1] == "-" and node[3][0] == "op":
+        right = f"({right})"
+    return f"{to_string(node[2])} {node[1]} {right}"
+
+
+# --- Точные распределения ---
+
+
+class Distribution:
+    """
+    Распределение целочисленной величины: ``probabilities[i]`` - вероятность
+    значения ``offset + i``. Хвосты (P(X >= x)) считаются один раз при создании.
+    """
+
+    __slots__ = ("offset", "probabilities", "_at_least")
+
+    def __init__(self, offset, probabilities):
+        self.offset = offset
+        self.probabilities = probabilities
+        self.probabilities.setflags(write=False)
+        # _at_least[i] = P(X >= offset + i)
+        self._at_least = np.cumsum(probabilities[::-1])[::-1]
+
+    @classmethod
+    def constant(cls, value):
+        return cls(value, np.ones(1))
+
+    @property
+    def min(self):
+        return self.offset
+
+    @property
+    def max(self):
+        return self.offset + len(self.probabilities) - 1
+
+    @property
+    def mean(self):
+        values = np.arange(self.min, self.max + 1)
+        return float(values @ self.probabilities)
+
+    @property
+    def stddev(self):
+        values = np.arange(self.min, self.max + 1)
+        variance = float((values - self.mean) ** 2 @ self.probabilities)
+        return math.sqrt(max(variance, 0.0))
+
+    def __add__(self, other):
+        return Distribution(
+            self.offset + other.offset,
+            np.convolve(self.probabilities, other.probabilities),
+        )
+
+    def __neg__(self):
+        return Distribution(-self.max, self.probabilities[::-1].copy())
+
+    def probability(self, value):
+        index = value - self.offset
+        if 0 <= index < len(self.probabilities):
+            return float(self.probabilities[index])
+        return 0.0
+
+    def at_least(self, value):
+        """P(X >= value)"""
+        index = value - self.offset
+        if index <= 0:
+            return 1.0
+        if index >= len(self._at_least):
+            return 0.0
+        return float(min(self._at_least[index], 1.0))
+
+    def at_most(self, value):
+        """P(X <= value)"""
+        return 1.0 - self.at_least(value + 1)
+
+    def as_dict(self):
+        return {
+            value: float(probability)
+            for value, probability in enumerate(self.probabilities, self.offset)
+            if probability > 0
+        }
+
+
+@lru_cache(maxsize=None)
+def _single_die(sides):
+    return Distribution(1, np.full(sides, 1 / sides))
+
+
+@lru_cache(maxsize=256)
+def _dice_sum(count, sides):
+    """Сумма ``count`` кубиков: свертка половин, каждая тоже из кэша."""
+    if count == 1:
+        return _single_die(sides)
+    half = count // 2
+    return _dice_sum(half, sides) + _dice_sum(count - half, sides)
+
+
+@lru_cache(maxsize=256)
+def _dice_keep(count, sides, keep_mode, keep):
+    """
+    Сумма ``keep`` старших (kh) или младших (kl) из ``count`` кубиков.
+    Грани перебираются от "лучшей" к "худшей"; на каждой решаем, сколько
+    из оставшихся кубиков выпало этой гранью (биномиальные коэффициенты),
+    и сколько из них попадает в оставленные. Число состояний - O(count * keep *
+    сумма), поэтому количество кубиков ограничено MAX_KEEP_DICE, а общая работа -
+    MAX_KEEP_WORK (проверяется при разборе).
+    """
+    faces = range(sides, 0, -1) if keep_mode == "kh" else range(1, sides + 1)
+    # сумма оставленных -> число исходов, в которых все K кубиков уже выбраны
+    counts = {}
+    # (кубиков распределено, кубиков оставлено, сумма оставленных) -> число исходов
+    states = {(0, 0, 0): 1}
+    for index, face in enumerate(faces):
+        faces_left = sides - index
+        next_states = {}
+        for (assigned, kept, total), ways in states.items():
+            remaining = count - assigned
+            if kept == keep:
+                # Остальные кубики не влияют на сумму: любые из оставшихся граней
+                counts[total] = counts.get(total, 0) + ways * faces_left**remaining
+                continue
+            for same in range(remaining + 1):
+                taken = min(same, keep - kept)
+                key = (assigned + same, kept + taken, total + taken * face)
+                next_states[key] = next_states.get(key, 0) + ways * math.comb(
+                    remaining, same
+                )
+        states = next_states
+
+    for (assigned, kept, total), ways in states.items():
+        if assigned == count:
+            counts[total] = counts.get(total, 0) + ways
+    low, high = min(counts), max(counts)
+    outcomes = sides**count
+    probabilities = np.zeros(high - low + 1)
+    for total, ways in counts.items():
+        probabilities[total - low] = ways / outcomes
+    return Distribution(low, probabilities)
+
+
+@lru_cache(maxsize=128)
+def distribution(node):
+    """
+    Точное распределение выражения после ``bind`` (только кубики и числа).
+    Кэшируется только результат для всего выражения: массивы промежуточных
+    узлов (до MAX_EXPRESSION_RANGE значений каждый) в кэше не держим.
+    """
+    return _distribution(node)
+
+
+def _distribution(node):
+    kind = node[0]
+    if kind == "num":
+        return Distribution.constant(node[1])
+    if kind == "dice":
+        _, count, sides, keep_mode, keep = node
+        if keep_mode:
+            return _dice_keep(count, sides, keep_mode, keep)
+        return _dice_sum(count, sides)
+    if kind == "neg":
+        return -_distribution(node[1])
+    if kind == "op":
+        right = _distribution(node[3])
+        return _distribution(node[2]) + (right if node[1] == "+" else -right)
+    raise DiceError("Bind function calls before computing a distribution")
+
+
+# --- Броски ---
+
+
+def roll(node, size=1, rng=None):
+    """
+    ``size`` независимых бросков выражения (после ``bind``) одним вызовом NumPy.
+    Возвращает массив целых чисел длины ``size``.
+    """
+    if not 1 <= size <= MAX_ROLLS:
+        raise DiceError(f"Roll count must be between 1 and {MAX_ROLLS}")
+    rng = rng or np.random.default_rng()
+    return _roll(node, size, rng)
+
+
+def _roll(node, size, rng):
+    kind = node[0]
+    if kind == "num":
+        return np.full(size, node[1], dtype=np.int64)
+    if kind == "dice":
+        _, count, sides, keep_mode, keep = node
+        dice = rng.integers(1, sides + 1, size=(size, count))
+        if keep_mode:
+            dice.sort(axis=1)
+            dice = dice[:, -keep:] if keep_mode == "kh" else dice[:, :keep]
+        return dice.sum(axis=1)
+    if kind == "neg":
+        return -_roll(node[1], size, rng)
+    if kind == "op":
+        left = _roll(node[2], size, rng)
+        right = _roll(node[3], size, rng)
+        return left + right if node[1] == "+" else left - right
+    raise DiceError("Bind function calls before rolling")
@@ -0,0 +1,249 @@
+"""
+Индекс пререквизитов особенностей: "что может взять этот персонаж".
+
+Требования особенностей собираются из метаданных каталога в предикаты,
+проиндексированные битовыми масками (бит - особенность, биты идут по
+возрастанию ID):
+
+* доступ - особенность из набора (``feature_set``) открывают черты
+  с ``grants_access_to``, особенность, привязанную к черте, - сама черта;
+  особенности без набора и без черт открыты всем;
+* уровень - ``metadata.level_requirement`` не больше стата ``level``;
+* требуемая черта - ``metadata.required_trait`` (имя или список имен,
+  достаточно любой из них);
+* собственные особенности игрока (``created_by``) видны только ему.
+
+Ответ для листа - пересечение нескольких масок (одно ``&`` по длинному
+целому), а не проверка каждой особенности. Индекс строится четырьмя
+запросами и живет в процессе, пока не изменится GameSystem.catalog_version.
+"""
+
+import logging
+import threading
+from bisect import bisect_right
+from collections import defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LEVEL_STAT = "level"
+
+_lock = threading.Lock()
+# system_id -> FeatureIndex
+_indexes = {}
+
+
+def _level_requirement(feature_id, metadata):
+    """
+    Порог уровня из metadata особенности. Нечисловое значение (например,
+    "3+" из пользовательских данных) не должно ломать индекс всей системы:
+    оно записывается в лог и считается как отсутствие порога.
+    """
+    value = metadata.get("level_requirement")
+    if value is None or value == "":
+        return 0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        logger.warning(
+            "Feature %s has an invalid level_requirement: %r", feature_id, value
+        )
+        return 0
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+class FeatureIndex:
+    """Маски особенностей одной системы для одной версии каталога."""
+
+    def __init__(self, system):
+        from core.models import CharacterTrait, Feature, FeatureSet
+
+        self.system_id = system.pk
+        self.catalog_version = system.catalog_version
+
+        rows = list(
+            Feature.objects.filter(system=system)
+            .order_by("pk")
+            .values_list("pk", "feature_set_id", "created_by_id", "metadata")
+        )
+        self.feature_ids = np.array([row[0] for row in rows], dtype=np.int64)
+        bits = {feature_id: 1 << index for index, (feature_id, *_) in enumerate(rows)}
+        self.all = (1 << len(rows)) - 1
+
+        traits = {}
+        trait_ids_by_name = defaultdict(list)
+        for trait_id, name, parent_id, metadata in CharacterTrait.objects.filter(
+            system=system
+        ).values_list("pk", "name", "parent_id", "metadata"):
+            traits[trait_id] = (
+                parent_id,
+                metadata if isinstance(metadata, dict) else {},
+            )
+            trait_ids_by_name[name].append(trait_id)
+        self.parents = {trait_id: parent for trait_id, (parent, _) in traits.items()}
+
+        # Доступ: черта -> особенности, которые она открывает
+        self.grants = defaultdict(int)
+        linked = 0
+        for trait_id, feature_id in CharacterTrait.features.through.objects.filter(
+            charactertrait__system=system
+        ).values_list("charactertrait_id", "feature_id"):
+            self.grants[trait_id] |= bits[feature_id]
+            linked |= bits[feature_id]
+
+        set_masks = defaultdict(int)
+        in_sets = 0
+        self.custom = 0
+        self.custom_by_user = defaultdict(int)
+        self.required = 0
+        self.required_by_trait = defaultdict(int)
+        self.by_type = defaultdict(int)
+        thresholds = defaultdict(int)
+        for feature_id, set_id, created_by_id, metadata in rows:
+            bit = bits[feature_id]
+            if not isinstance(metadata, dict):
+                metadata = {}
+            if set_id is not None:
+                set_masks[set_id] |= bit
+                in_sets |= bit
+            if created_by_id is not None:
+                self.custom |= bit
+                self.custom_by_user[created_by_id] |= bit
+            names = [
+                name
+                for name in _as_list(metadata.get("required_trait"))
+                if isinstance(name, str)
+            ]
+            if names:
+                self.required |= bit
+                for name in names:
+                    for trait_id in trait_ids_by_name.get(name, ()):
+                        self.required_by_trait[trait_id] |= bit
+            if metadata.get("type") is not None:
+                self.by_type[str(metadata["type"])] |= bit
+            thresholds[_level_requirement(feature_id, metadata)] |= bit
+
+        self.open = self.all & ~(in_sets | linked)
+
+        sets_by_name = defaultdict(list)
+        for set_id, name, set_type in FeatureSet.objects.filter(
+            system=system
+        ).values_list("pk", "name", "set_type"):
+            sets_by_name[name].append((set_id, set_type))
+        for trait_id, (_, metadata) in traits.items():
+            access = metadata.get("grants_access_to")
+            if not isinstance(access, dict) or access.get("type") != "FeatureSet":
+                continue
+            set_type = access.get("set_type")
+            for name in _as_list(access.get("names")):
+                if not isinstance(name, str):
+                    continue
+                for set_id, candidate_type in sets_by_name.get(name, ()):
+                    if set_type is None or candidate_type == set_type:
+                        self.grants[trait_id] |= set_masks[set_id]
+
+        # Уровень: накопительные маски по возрастанию порога
+        self.levels = sorted(thresholds)
+        self.level_masks = []
+        mask = 0
+        for level in self.levels:
+            mask |= thresholds[level]
+            self.level_masks.append(mask)
+
+    def __len__(self):
+        return len(self.feature_ids)
+
+    def with_ancestors(self, trait_ids):
+        """Черты листа вместе с родительскими (подкласс дает доступ класса)."""
+        result = set()
+        for trait_id in trait_ids:
+            while trait_id is not None and trait_id not in result:
+                result.add(trait_id)
+                trait_id = self.parents.get(trait_id)
+        return result
+
+    def level_mask(self, level):
+        position = bisect_right(self.levels, level)
+        return self.level_masks[position - 1] if position else 0
+
+    def mask_of(self, feature_ids):
+        positions = np.searchsorted(self.feature_ids, list(feature_ids))
+        mask = 0
+        for position, feature_id in zip(positions.tolist(), feature_ids):
+            if (
+                position < len(self.feature_ids)
+                and self.feature_ids[position] == feature_id
+            ):
+                mask |= 1 << position
+        return mask
+
+    def eligible_mask(
+        self, trait_ids, level, user_id=None, owned_ids=(), feature_type=None
+    ):
+        traits = self.with_ancestors(trait_ids)
+        access = self.open
+        required = self.all & ~self.required
+        for trait_id in traits:
+            access |= self.grants.get(trait_id, 0)
+            required |= self.required_by_trait.get(trait_id, 0)
+
+        mask = access & required & self.level_mask(level)
+        mask &= ~(self.custom & ~self.custom_by_user.get(user_id, 0))
+        if owned_ids:
+            mask &= ~self.mask_of(owned_ids)
+        if feature_type is not None:
+            mask &= self.by_type.get(feature_type, 0)
+        return mask
+
+    def feature_ids_of(self, mask):
+        """ID особенностей маски по возрастанию."""
+        if not mask:
+            return []
+        raw = np.frombuffer(
+            mask.to_bytes((mask.bit_length() + 7) // 8, "little"), dtype=np.uint8
+        )
+        positions = np.flatnonzero(np.unpackbits(raw, bitorder="little"))
+        return self.feature_ids[positions].tolist()
+
+    def eligible(self, sheet, trait_ids, owned_ids=(), feature_type=None):
+        """ID особенностей, которые лист может взять."""
+        try:
+            level = int((sheet.stats or {}).get(LEVEL_STAT) or 0)
+        except (TypeError, ValueError):
+            level = 0
+        return self.feature_ids_of(
+            self.eligible_mask(
+                trait_ids,
+                level,
+                user_id=sheet.player_id,
+                owned_ids=owned_ids,
+                feature_type=feature_type,
+            )
+        )
+
+
+def get_index(system):
+    """Индекс системы; пересобирается при изменении версии каталога."""
+    index = _indexes.get(system.pk)
+    if index is not None and index.catalog_version == system.catalog_version:
+        return index
+    with _lock:
+        index = _indexes.get(system.pk)
+        if index is None or index.catalog_version != system.catalog_version:
+            index = FeatureIndex(system)
+            _indexes[system.pk] = index
+    return index
+
+
+def clear():
+    """Сбрасывает индексы (для тестов и бенчмарков)."""
+    with _lock:
+        _indexes.clear()
@@ -0,0 +1,78 @@
+"""
+Деревья экипировки листа: мехи, установленное на них оружие, импланты.
+
+Предмет ссылается на родителя через ``parent_equipment``; все узлы дерева
+принадлежат одному листу, поэтому весь лес загружается одним запросом
+по ``character_id`` и собирается в памяти.
+
+``EquipmentIndex`` строится один раз на вычислитель листа и отвечает
+на агрегатные функции формул::
+
+    equipment_sum('mech', 'weight')  # сумма по предметам слота и их поддеревьям
+    equipment_max('mech', 'heat')    # максимум по ним же
+
+Значение предмета берется из metadata его шаблона, как в equipment_meta().
+Каждая пара (слот, путь) считается один раз за O(число предметов).
+"""
+
+from collections import defaultdict
+
+from .parser import metadata_value
+
+AGGREGATES = {
+    "equipment_sum": sum,
+    "equipment_max": lambda values: max(values, default=0),
+}
+
+
+class EquipmentIndex:
+    """
+    Предметы листа, разложенные по слотам и по родителям. ``items`` -
+    объекты с ``pk``, ``location``, ``parent_equipment_id`` и ``template``
+    (например, CharacterEquipment с select_related("template")).
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.by_location = defaultdict(list)
+        self.children = defaultdict(list)
+        known = {item.pk for item in self.items}
+        self.roots = []
+        for item in self.items:
+            self.by_location[item.location].append(item)
+            if item.parent_equipment_id in known:
+                self.children[item.parent_equipment_id].append(item)
+            else:
+                self.roots.append(item)
+        # Предметы в цикле родителей недостижимы из корней: считаем их корнями,
+        # чтобы они не пропали из листа
+        reachable = {item.pk for item in self.walk(self.roots)}
+        self.roots += [item for item in self.items if item.pk not in reachable]
+        self._aggregates = {}
+
+    def walk(self, items):
+        """Предметы и все их вложения (каждый ровно один раз)."""
+        seen = set()
+        stack = list(reversed(items))
+        while stack:
+            item = stack.pop()
+            if item.pk in seen:
+                continue
+            seen.add(item.pk)
+            yield item
+            stack.extend(reversed(self.children.get(item.pk, ())))
+
+    def subtree(self, location):
+        """Предметы слота вместе со всем, что на них установлено."""
+        return self.walk(self.by_location.get(location, ()))
+
+    def aggregate(self, func_name, location, path):
+        key = (func_name, location, path)
+        if key not in self._aggregates:
+            self._aggregates[key] = AGGREGATES[func_name](
+                [
+                    metadata_value(item.template.metadata, path)
+                    for item in self.subtree(location)
+                ]
+            )
+        return self._aggregates[key]
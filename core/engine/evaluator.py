@@ -1,8 +1,15 @@
-import re
-from functools import lru_cache
+import logging
+from functools import cached_property
 from json.decoder import JSONDecodeError
 from django.core.exceptions import ObjectDoesNotExist
 
+from . import dice
+from .equipment import AGGREGATES, EquipmentIndex
+from .parser import compile_formula, evaluate_ast, metadata_value
+from .registry import get_rules
+
+logger = logging.getLogger(__name__)
+
 # ВАЖНО: Мы не импортируем модели CharacterSheet напрямую,
 # чтобы избежать циклических зависимостей. Вместо этого, мы будем
 # получать объект персонажа в конструкторе.
@@ -16,75 +23,68 @@ class RuleEvaluator:
 
     def __init__(self, character_sheet):
         self.character = character_sheet
-        # Получаем схему правил из metadata игровой системы.
-        # Если ее нет, используем пустой словарь.
+        # Кэши поиска живут столько же, сколько вычислитель (один лист)
+        self._traits_by_category = {}
+        self._equipment_by_location = {}
+        # Получаем правила системы из реестра процесса (снапшот или БД).
+        # Если их нет, используем пустой словарь.
         try:
-            self.rules_schema = self.character.system.metadata or {}
+            self.rules = get_rules(self.character.system)
+            self.rules_schema = self.rules.metadata or {}
         except (JSONDecodeError, AttributeError):
+            self.rules = None
             self.rules_schema = {}
 
     def evaluate(self, formula_string):
         """
         Основной метод для вычисления формулы.
         Пример: "trait_meta('Class', 'base_hp') + stat('level')"
+        Поддерживаются +, -, *, / (целочисленное), унарный минус и скобки.
         """
-        print(f"--- Evaluating formula: '{formula_string}' ---")
-
-        parts = formula_string.split(" ")
-
-        # Простая логика для v1.0: предполагаем формулу вида "значение1 оператор значение2"
-        if len(parts) != 3:
-            # В будущем можно будет добавить поддержку более сложных формул
-            raise ValueError(f"Unsupported formula format: {formula_string}")
-
-        left_operand_str, operator, right_operand_str = parts
-
-        left_value = self._resolve_value(left_operand_str)
-        right_value = self._resolve_value(right_operand_str)
-
-        print(f"Resolved: {left_value} {operator} {right_value}")
-
-        if operator == "+":
-            result = left_value + right_value
-            print(f"Result: {result}")
-            return result
-        elif operator == "-":
-            return left_value - right_value
-        else:
-            raise ValueError(f"Unsupported operator: {operator}")
-
-    def _resolve_value(self, value_str):
+        result = evaluate_ast(self.compiled_formula(formula_string), self._call)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Evaluated %r = %r",
+                formula_string,
+                result,
+                extra={"formula": formula_string, "result": result},
+            )
+        return result
+
+    def compiled_formula(self, formula_string):
+        # Формула разбирается один раз на процесс; из снапшота - уже готовой
+        if self.rules is not None:
+            return self.rules.compiled_formula(formula_string)
+        return compile_formula(formula_string)
+
+    def bind_dice(self, expression):
         """
-        Распознает, является ли строка числом, или функцией-хелпером,
-        и возвращает вычисленное значение.
+        Разбирает выражение с кубиками (см. ``dice``) и подставляет в него
+        значения функций для этого листа: "2d12 + stat('agility')" -> 2d12 + 3.
         """
-        # Проверяем, является ли строка числом
-        if value_str.isdigit() or (
-            value_str.startswith("-") and value_str[1:].isdigit()
-        ):
-            return int(value_str)
+        return dice.bind(dice.compile_dice(expression), self._call)
 
-        # Проверяем, является ли строка вызовом функции
-        match = re.match(r"(\w+)\((.*)\)", value_str)
-        if not match:
-            raise ValueError(f"Invalid value or function format: {value_str}")
-
-        func_name, args_str = match.groups()
+    def call(self, func_name, args):
+        """
+        Значение функции формулы для этого листа, например
+        call("trait_meta", ("Class", "base_hp")). Нужно тем, кто вычисляет
+        AST сам (например, над массивами в ``core.engine.vector``).
+        """
+        return self._call(func_name, args)
 
-        # "Белый список" разрешенных функций
+    def _call(self, func_name, args):
+        """Вызывает разрешенную функцию-хелпер с уже разобранными аргументами."""
         if func_name == "stat":
-            return self._resolve_stat(*self._parse_args(args_str))
+            return self._resolve_stat(*args)
         elif func_name == "trait_meta":
-            return self._resolve_trait_meta(*self._parse_args(args_str))
+            return self._resolve_trait_meta(*args)
         elif func_name == "equipment_meta":
-            return self._resolve_equipment_meta(*self._parse_args(args_str))
+            return self._resolve_equipment_meta(*args)
+        elif func_name in AGGREGATES:
+            return self._resolve_equipment_aggregate(func_name, *args)
         else:
             raise ValueError(f"Unknown function: {func_name}")
 
-    def _parse_args(self, args_str):
-        """Простой парсер аргументов. Пример: "'Class', 'base_hp'" -> ["Class", "base_hp"]"""
-        return [arg.strip().strip("'\"") for arg in args_str.split(",")]
-
     # --- Реализация функций-хелперов ---
 
     def _resolve_stat(self, stat_name):
@@ -94,8 +94,29 @@ class RuleEvaluator:
         except (ValueError, TypeError):
             return 0
 
-    @lru_cache(maxsize=None)  # Кэшируем результат, чтобы не делать лишних запросов к БД
+    def _prefetched(self, relation):
+        """
+        Связанные объекты, уже загруженные prefetch_related (пакетный пересчет),
+        или None - тогда каждый поиск идет отдельным запросом.
+        """
+        return getattr(self.character, "_prefetched_objects_cache", {}).get(relation)
+
     def _get_trait_by_category(self, category_name):
+        # Кэш на вычислитель, чтобы не делать лишних запросов к БД
+        if category_name not in self._traits_by_category:
+            self._traits_by_category[category_name] = self._find_trait_by_category(
+                category_name
+            )
+        return self._traits_by_category[category_name]
+
+    def _find_trait_by_category(self, category_name):
+        traits = self._prefetched("traits")
+        if traits is not None:
+            name = category_name.lower()
+            return next(
+                (trait for trait in traits if trait.category.name.lower() == name),
+                None,
+            )
         try:
             return self.character.traits.get(category__name__iexact=category_name)
         except ObjectDoesNotExist:
@@ -108,21 +129,26 @@ class RuleEvaluator:
             return 0
 
         # Простой парсер пути для v1.0. Пример: 'base_thresholds.major'
-        value = trait.metadata
-        try:
-            for key in path.split("."):
-                value = value[key]
-            return int(value)
-        except (KeyError, ValueError, TypeError):
-            return 0
+        return metadata_value(trait.metadata, path)
 
-    @lru_cache(maxsize=None)
     def _get_equipment_in_location(self, location):
-        try:
-            # Для v1.0 ищем только первый предмет в указанной локации
-            return self.character.equipment.get(location=location)
-        except ObjectDoesNotExist:
-            return None
+        if location not in self._equipment_by_location:
+            self._equipment_by_location[location] = self._find_equipment_in_location(
+                location
+            )
+        return self._equipment_by_location[location]
+
+    def _find_equipment_in_location(self, location):
+        # Первый предмет верхнего уровня в слоте: в одном слоте может быть
+        # несколько строк, а вложения установлены на другие предметы
+        return next(
+            (
+                item
+                for item in self._equipment_index.by_location.get(location, ())
+                if item.parent_equipment_id is None
+            ),
+            None,
+        )
 
     def _resolve_equipment_meta(self, location, path):
         """Получает значение из metadata экипированного предмета."""
@@ -130,10 +156,66 @@ class RuleEvaluator:
         if not equipment:
             return 0
 
-        value = equipment.template.metadata
-        try:
-            for key in path.split("."):
-                value = value[key]
-            return int(value)
-        except (KeyError, ValueError, TypeError):
+        return metadata_value(equipment.template.metadata, path)
+
+    @cached_property
+    def _equipment_index(self):
+        items = self._prefetched("equipment")
+        if items is None:
+            # Все предметы листа (с вложениями) - одним запросом
+            items = self.character.equipment.select_related("template")
+        return EquipmentIndex(items)
+
+    def _resolve_equipment_aggregate(self, func_name, location, path):
+        """Сумма или максимум metadata по предметам слота и их вложениям."""
+        return self._equipment_index.aggregate(func_name, location, path)
+
+
+class PreviewEvaluator(RuleEvaluator):
+    """
+    Вычислитель для предлагаемого состояния листа ("что будет, если").
+    Черты и экипировка заданы ID из каталога правил системы (снапшот или
+    DatabaseRules из реестра), а не связями листа в БД, поэтому формулы
+    вычисляются без запросов.
+    """
+
+    def __init__(self, character_sheet, trait_ids, equipment):
+        """
+        ``trait_ids`` - ID черт, ``equipment`` - пары (location, template_id)
+        в порядке предметов листа.
+        """
+        super().__init__(character_sheet)
+        self.trait_ids = list(trait_ids)
+        self.equipment = list(equipment)
+
+    def _resolve_trait_meta(self, category_name, path):
+        if self.rules is None:
+            return 0
+        category = self.rules.categories.get(category_name.lower())
+        if not category:
+            return 0
+        for trait_id in self.trait_ids:
+            trait = self.rules.trait(trait_id)
+            if trait is not None and trait["category_id"] == category["id"]:
+                return metadata_value(trait["metadata"], path)
+        return 0
+
+    def _resolve_equipment_meta(self, location, path):
+        if self.rules is None:
             return 0
+        for item_location, template_id in self.equipment:
+            if item_location == location:
+                template = self.rules.equipment_template(template_id)
+                if template is None:
+                    return 0
+                return metadata_value(template["metadata"], path)
+        return 0
+
+    def _resolve_equipment_aggregate(self, func_name, location, path):
+        # Вложений у предлагаемой экипировки нет: агрегат по предметам слота
+        values = []
+        for item_location, template_id in self.equipment:
+            template = self.rules and self.rules.equipment_template(template_id)
+            if item_location == location and template is not None:
+                values.append(metadata_value(template["metadata"], path))
+        return AGGREGATES[func_name](values)
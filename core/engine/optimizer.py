@@ -0,0 +1,584 @@
+"""
+Оптимизатор билдов: какая комбинация черт и экипировки дает максимум
+(или минимум) вычисляемого стата.
+
+Перебираются только "измерения", от которых зависит цель: категории черт
+из trait_meta() и слоты экипировки из equipment_meta(), equipment_sum()
+и equipment_max() в ее формуле и в формулах вычисляемых статов, которые
+она читает через stat().
+Остальные категории и слоты на результат не влияют.
+
+Каталог читается из БД один раз (и живет в процессе до смены
+catalog_version), дальше все считается в numpy без обращений к БД:
+
+* измерения делятся на внешние (префиксы) и внутренний блок размером
+  до ``BLOCK_SIZE``; для префикса формулы вычисляются над всем блоком сразу;
+* для всех префиксов заранее считаются интервальные оценки цели; префиксы
+  обходятся от лучшей оценки, и как только оценка не лучше k-го найденного
+  билда, остальные уже не считаются;
+* префиксы делятся между процессами (``workers``), каждый возвращает свой
+  top-k, результаты сливаются.
+
+Черта-потомок (подкласс) совместима только со своим предком, если категория
+предка тоже перебирается.
+"""
+
+import multiprocessing
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from math import prod
+
+import numpy as np
+
+from . import vector
+from .equipment import AGGREGATES
+from .parser import (
+    FormulaError,
+    compile_formula,
+    evaluate_ast,
+    iter_calls,
+    metadata_value,
+    stat_references,
+)
+
+# Сколько комбинаций внутреннего блока вычисляется одним набором операций
+BLOCK_SIZE = 1 << 16
+DIRECTIONS = ("max", "min")
+# Предок черты не входит в варианты своей категории: вариант недопустим
+_EXCLUDED = -2
+
+_lock = threading.Lock()
+# system_id -> Catalog
+_catalogs = {}
+
+
+class OptimizerError(ValueError):
+    """Цель не описана схемой системы или выбор черт/экипировки некорректен."""
+
+
+class Catalog:
+    """Формулы, черты и шаблоны экипировки системы в памяти процесса."""
+
+    def __init__(self, system):
+        from core.models import CharacterTrait, EquipmentTemplate
+
+        self.system_id = system.pk
+        self.catalog_version = system.catalog_version
+        schema = (system.metadata or {}).get("character_sheet_schema", {})
+        self.computed_stats = {
+            name: rule["formula"]
+            for name, rule in schema.get("computed_stats", {}).items()
+            if rule.get("formula")
+        }
+
+        # id -> (name, category, parent_id, metadata)
+        self.traits = {}
+        self.traits_by_category = defaultdict(list)
+        for pk, name, category, parent_id, metadata in (
+            CharacterTrait.objects.filter(system=system)
+            .order_by("pk")
+            .values_list("pk", "name", "category__name", "parent_id", "metadata")
+        ):
+            self.traits[pk] = (name, category, parent_id, metadata or {})
+            self.traits_by_category[category.lower()].append(pk)
+
+        # id -> (name, location, metadata)
+        self.templates = {}
+        self.templates_by_location = defaultdict(list)
+        for pk, name, metadata in (
+            EquipmentTemplate.objects.filter(system=system)
+            .order_by("pk")
+            .values_list("pk", "name", "metadata")
+        ):
+            metadata = metadata or {}
+            location = metadata.get("location")
+            self.templates[pk] = (name, location, metadata)
+            if location:
+                self.templates_by_location[location].append(pk)
+
+
+def get_catalog(system):
+    """Каталог системы; перечитывается при изменении версии каталога."""
+    catalog = _catalogs.get(system.pk)
+    if catalog is not None and catalog.catalog_version == system.catalog_version:
+        return catalog
+    with _lock:
+        catalog = _catalogs.get(system.pk)
+        if catalog is None or catalog.catalog_version != system.catalog_version:
+            catalog = Catalog(system)
+            _catalogs[system.pk] = catalog
+    return catalog
+
+
+def clear():
+    """Сбрасывает кэш каталогов (для тестов и бенчмарков)."""
+    with _lock:
+        _catalogs.clear()
+
+
+class Dimension:
+    """Один выбор билда: черта категории или предмет слота экипировки."""
+
+    def __init__(self, kind, key, ids):
+        self.kind = kind
+        self.key = key
+        # None - выбирать не из чего, функции вернут 0 (как у пустого листа)
+        self.ids = ids or [None]
+        self.columns = {}
+        # [(индекс измерения предка, позиция предка у каждого варианта или -1)]
+        self.parents = []
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def _bounds(node, lookup):
+    """Интервальная оценка AST: (нижняя, верхняя) граница, поэлементно."""
+    kind = node[0]
+    if kind == "num":
+        return float(node[1]), float(node[1])
+    if kind == "call":
+        return lookup(node)
+    if kind == "neg":
+        low, high = _bounds(node[1], lookup)
+        return -high, -low
+
+    left_low, left_high = _bounds(node[2], lookup)
+    right_low, right_high = _bounds(node[3], lookup)
+    operator = node[1]
+    if operator == "+":
+        return left_low + right_low, left_high + right_high
+    if operator == "-":
+        return left_low - right_high, left_high - right_low
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if operator == "*":
+            corners = [
+                a * b for a in (left_low, left_high) for b in (right_low, right_high)
+            ]
+        else:
+            corners = [
+                np.floor(np.divide(a, b))
+                for a in (left_low, left_high)
+                for b in (right_low, right_high)
+            ]
+    low = np.minimum.reduce(np.broadcast_arrays(*corners))
+    high = np.maximum.reduce(np.broadcast_arrays(*corners))
+    if operator == "/":
+        # Делитель может быть нулем: оценка неизвестна
+        unknown = (np.asarray(right_low) <= 0) & (np.asarray(right_high) >= 0)
+        low = np.where(unknown, -np.inf, low)
+        high = np.where(unknown, np.inf, high)
+    # inf * 0 и подобное: тоже неизвестно
+    return np.where(np.isnan(low), -np.inf, low), np.where(np.isnan(high), np.inf, high)
+
+
+class Problem:
+    """
+    Пространство поиска для одной цели. Содержит только числа и массивы
+    numpy, поэтому передается в процессы пула без обращений к БД.
+    """
+
+    def __init__(
+        self, catalog, target, direction="max", stats=None, traits=(), equipment=()
+    ):
+        if target not in catalog.computed_stats:
+            raise OptimizerError(f"Unknown computed stat: {target}")
+        if direction not in DIRECTIONS:
+            raise OptimizerError(f"Direction must be one of {', '.join(DIRECTIONS)}")
+        self.target = target
+        self.direction = direction
+        self.sign = 1 if direction == "max" else -1
+        self.stats = {name: int(value) for name, value in (stats or {}).items()}
+
+        order = list(catalog.computed_stats)
+        position = {name: index for index, name in enumerate(order)}
+        compiled = {}
+        pending = [target]
+        while pending:
+            name = pending.pop()
+            if name in compiled:
+                continue
+            try:
+                compiled[name] = compile_formula(catalog.computed_stats[name])
+            except FormulaError as e:
+                raise OptimizerError(f"{name}: {e}")
+            # Как при пересчете: вычисляемый стат, идущий в схеме раньше,
+            # уже пересчитан, а более поздний берется из stats как есть
+            pending.extend(
+                ref
+                for ref in stat_references(compiled[name])
+                if ref in position and position[ref] < position[name]
+            )
+        self.formulas = [(name, compiled[name]) for name in order if name in compiled]
+
+        fixed = self._fixed_choices(catalog, traits, equipment)
+        self.dims = []
+        # узел вызова -> (индекс измерения, путь в metadata)
+        self.slots = {}
+        dim_index = {}
+        for _, node in self.formulas:
+            for call in iter_calls(node):
+                _, func, args = call
+                if func == "trait_meta":
+                    key = ("trait", str(args[0]).lower())
+                elif func in ("equipment_meta", *AGGREGATES):
+                    # В билде по одному предмету на слот и без вложений:
+                    # сумма и максимум по слоту равны значению этого предмета
+                    key = ("equipment", str(args[0]))
+                else:
+                    continue
+                if key not in dim_index:
+                    dim_index[key] = len(self.dims)
+                    self.dims.append(self._dimension(catalog, *key, fixed))
+                dim = self.dims[dim_index[key]]
+                path = str(args[1])
+                if path not in dim.columns:
+                    dim.columns[path] = np.array(
+                        [self._meta(catalog, dim, option, path) for option in dim.ids],
+                        dtype=np.int64,
+                    )
+                self.slots[call] = (dim_index[key], path)
+        self._link_parents(catalog, dim_index)
+
+        self.groups = self._group_dims()
+        group_of = {
+            member: (group_index, column)
+            for group_index, (members, _) in enumerate(self.groups)
+            for column, member in enumerate(members)
+        }
+        # узел вызова -> (индекс группы, значения по вариантам группы)
+        self.calls = {}
+        for call, (index, path) in self.slots.items():
+            group_index, column = group_of[index]
+            options = self.groups[group_index][1]
+            self.calls[call] = (
+                group_index,
+                self.dims[index].columns[path][options[:, column]],
+            )
+
+        sizes = [len(options) for _, options in self.groups]
+        self.candidates = prod(sizes)
+        # Во внутренний блок - самые большие группы, пока он не превысит BLOCK_SIZE
+        self.inner = []
+        block = 1
+        for index in sorted(range(len(sizes)), key=lambda index: -sizes[index]):
+            if not self.inner or block * sizes[index] <= BLOCK_SIZE:
+                self.inner.append(index)
+                block *= sizes[index]
+        self.outer = [index for index in range(len(sizes)) if index not in self.inner]
+        self.inner_shape = tuple(sizes[index] for index in self.inner)
+        self.outer_shape = tuple(sizes[index] for index in self.outer)
+        self.block = block
+
+    @staticmethod
+    def _fixed_choices(catalog, traits, equipment):
+        fixed = {}
+        for trait_id in traits:
+            if trait_id not in catalog.traits:
+                raise OptimizerError(f"Unknown trait: {trait_id}")
+            fixed[("trait", catalog.traits[trait_id][1].lower())] = trait_id
+        for template_id in equipment:
+            if template_id not in catalog.templates:
+                raise OptimizerError(f"Unknown equipment template: {template_id}")
+            location = catalog.templates[template_id][1]
+            if not location:
+                raise OptimizerError(
+                    f"Equipment template {template_id} has no metadata.location"
+                )
+            fixed[("equipment", location)] = template_id
+        return fixed
+
+    @staticmethod
+    def _dimension(catalog, kind, key, fixed):
+        if (kind, key) in fixed:
+            return Dimension(kind, key, [fixed[(kind, key)]])
+        if kind == "trait":
+            return Dimension(kind, key, list(catalog.traits_by_category.get(key, ())))
+        return Dimension(kind, key, list(catalog.templates_by_location.get(key, ())))
+
+    @staticmethod
+    def _meta(catalog, dim, option, path):
+        if option is None:
+            return 0
+        if dim.kind == "trait":
+            return metadata_value(catalog.traits[option][3], path)
+        return metadata_value(catalog.templates[option][2], path)
+
+    def _link_parents(self, catalog, dim_index):
+        positions = {
+            index: {option: position for position, option in enumerate(dim.ids)}
+            for index, dim in enumerate(self.dims)
+            if dim.kind == "trait"
+        }
+        for index, dim in enumerate(self.dims):
+            if dim.kind != "trait":
+                continue
+            links = {}
+            for position, option in enumerate(dim.ids):
+                parent = catalog.traits[option][2] if option is not None else None
+                # Ближайший предок из перебираемой категории
+                while parent is not None:
+                    _, category, grandparent, _ = catalog.traits[parent]
+                    parent_index = dim_index.get(("trait", category.lower()))
+                    if parent_index is not None and parent_index != index:
+                        if parent_index not in links:
+                            links[parent_index] = np.full(len(dim), -1, dtype=np.int64)
+                        links[parent_index][position] = positions[parent_index].get(
+                            parent, _EXCLUDED
+                        )
+                        break
+                    parent = grandparent
+            dim.parents = sorted(links.items())
+
+    def _group_dims(self):
+        """
+        Объединяет измерения, связанные предком и потомком, в группы.
+        Вариант группы - допустимый набор позиций (класс и его подкласс),
+        поэтому несовместимые комбинации не перебираются вовсе.
+        Возвращает список (индексы измерений, массив вариантов).
+        """
+        neighbours = defaultdict(set)
+        for index, dim in enumerate(self.dims):
+            for parent_index, _ in dim.parents:
+                neighbours[index].add(parent_index)
+                neighbours[parent_index].add(index)
+
+        groups = []
+        seen = set()
+        for start in range(len(self.dims)):
+            if start in seen:
+                continue
+            seen.add(start)
+            members = [start]
+            options = np.arange(len(self.dims[start]), dtype=np.int64)[:, None]
+            # Присоединяем соседей по одному и сразу отбрасываем несовместимое
+            for member in members:
+                for other in sorted(neighbours[member] - seen):
+                    seen.add(other)
+                    size = len(self.dims[other])
+                    options = np.hstack(
+                        [
+                            np.repeat(options, size, axis=0),
+                            np.tile(np.arange(size, dtype=np.int64), len(options))[
+                                :, None
+                            ],
+                        ]
+                    )
+                    members.append(other)
+                    options = options[self._consistent(members, options)]
+            groups.append((members, options))
+        return groups
+
+    def _consistent(self, members, options):
+        columns = {member: options[:, column] for column, member in enumerate(members)}
+        valid = np.ones(len(options), dtype=bool)
+        for member in members:
+            for parent_index, links in self.dims[member].parents:
+                if parent_index in columns:
+                    linked = links[columns[member]]
+                    valid &= (linked == -1) | (linked == columns[parent_index])
+        return valid
+
+    # --- Поиск ---
+
+    def prefix_bounds(self):
+        """
+        Префиксы (номера комбинаций внешних групп) и верхние оценки цели
+        для них, по убыванию оценки.
+        """
+        count = prod(self.outer_shape)
+        prefixes = np.arange(count, dtype=np.int64)
+        digits = {}
+        if self.outer:
+            digits = dict(zip(self.outer, np.unravel_index(prefixes, self.outer_shape)))
+        intervals = {}
+
+        def lookup(call):
+            _, func, args = call
+            if func == "stat":
+                if args[0] in intervals:
+                    return intervals[args[0]]
+                value = float(self.stats.get(args[0], 0))
+                return value, value
+            group_index, column = self.calls[call]
+            if group_index in digits:
+                values = column[digits[group_index]].astype(np.float64)
+                return values, values
+            return float(column.min()), float(column.max())
+
+        for name, node in self.formulas:
+            intervals[name] = _bounds(node, lookup)
+        low, high = intervals[self.target]
+        upper = high if self.sign > 0 else -np.asarray(low)
+        upper = np.broadcast_to(np.asarray(upper, dtype=np.float64), (count,))
+        order = np.argsort(-upper, kind="stable")
+        return prefixes[order], upper[order]
+
+    def search(self, prefixes, upper, top):
+        """
+        Вычисляет блоки префиксов (по убыванию оценки) и возвращает
+        (очки, ключи комбинаций, сколько комбинаций вычислено).
+        """
+        inner_digits = dict(
+            zip(self.inner, np.unravel_index(np.arange(self.block), self.inner_shape))
+        )
+        inner_columns = {
+            call: column[inner_digits[group_index]]
+            for call, (group_index, column) in self.calls.items()
+            if group_index in inner_digits
+        }
+        inner_keys = np.arange(self.block, dtype=np.int64)
+
+        best_scores = np.empty(0, dtype=np.int64)
+        best_keys = np.empty(0, dtype=np.int64)
+        threshold = None
+        evaluated = 0
+        for prefix, bound in zip(prefixes.tolist(), upper.tolist()):
+            if threshold is not None and bound <= threshold:
+                # Префиксы отсортированы: дальше оценки только хуже
+                break
+            outer_digits = {}
+            if self.outer:
+                outer_digits = dict(
+                    zip(self.outer, np.unravel_index(prefix, self.outer_shape))
+                )
+            values = {}
+
+            def lookup(call):
+                _, func, args = call
+                if func == "stat":
+                    if args[0] in values:
+                        return values[args[0]]
+                    return self.stats.get(args[0], 0)
+                if call in inner_columns:
+                    return inner_columns[call]
+                group_index, column = self.calls[call]
+                return int(column[outer_digits[group_index]])
+
+            invalid = np.zeros(self.block, dtype=bool)
+            for name, node in self.formulas:
+                values[name] = vector.evaluate(node, lookup, invalid)
+            scores = self.sign * np.broadcast_to(
+                np.asarray(values[self.target], dtype=np.int64), (self.block,)
+            )
+            evaluated += self.block
+
+            keep = ~invalid
+            if threshold is not None:
+                keep &= scores > threshold
+            if not keep.any():
+                continue
+            best_scores = np.concatenate([best_scores, scores[keep]])
+            best_keys = np.concatenate(
+                [best_keys, prefix * self.block + inner_keys[keep]]
+            )
+            if len(best_scores) >= top:
+                chosen = np.argpartition(-best_scores, top - 1)[:top]
+                best_scores = best_scores[chosen]
+                best_keys = best_keys[chosen]
+                threshold = int(best_scores.min())
+        return best_scores, best_keys, evaluated
+
+    def choices(self, key):
+        """Позиции вариантов по измерениям для ключа комбинации."""
+        prefix, inner = divmod(int(key), self.block)
+        digits = {}
+        if self.outer:
+            digits.update(zip(self.outer, np.unravel_index(prefix, self.outer_shape)))
+        digits.update(zip(self.inner, np.unravel_index(inner, self.inner_shape)))
+        positions = [0] * len(self.dims)
+        for group_index, (members, options) in enumerate(self.groups):
+            for member, position in zip(members, options[digits[group_index]]):
+                positions[member] = int(position)
+        return positions
+
+    def evaluate_build(self, positions):
+        """Статы одного билда обычным вычислителем AST (как при пересчете листа)."""
+        values = {}
+
+        def call(func, args):
+            if func == "stat":
+                return values.get(args[0], self.stats.get(args[0], 0))
+            index, path = self.slots[("call", func, args)]
+            return int(self.dims[index].columns[path][positions[index]])
+
+        for name, node in self.formulas:
+            values[name] = evaluate_ast(node, call)
+        return values
+
+
+def _search_part(problem, prefixes, upper, top):
+    return problem.search(prefixes, upper, top)
+
+
+def optimize(problem, catalog, top=5, workers=1):
+    """
+    Ищет ``top`` лучших билдов. ``workers`` > 1 - префиксы делятся между
+    процессами пула (spawn: воркерам не нужен Django, только numpy и парсер).
+    """
+    start = time.perf_counter()
+    nothing = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0)
+    if not problem.candidates:
+        results = [nothing]
+    else:
+        prefixes, upper = problem.prefix_bounds()
+        if workers > 1 and len(prefixes) >= 2 * workers:
+            # Префиксы раздаются по кругу, чтобы каждому процессу достались
+            # и самые перспективные
+            with ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn")
+            ) as pool:
+                results = list(
+                    pool.map(
+                        _search_part,
+                        [problem] * workers,
+                        [prefixes[worker::workers] for worker in range(workers)],
+                        [upper[worker::workers] for worker in range(workers)],
+                        [top] * workers,
+                    )
+                )
+        else:
+            results = [problem.search(prefixes, upper, top)]
+
+    scores = np.concatenate([result[0] for result in results])
+    keys = np.concatenate([result[1] for result in results])
+    # Лучшие первыми; при равенстве - меньший ключ (порядок каталога)
+    order = np.lexsort((keys, -scores))[:top]
+
+    builds = []
+    for key in keys[order].tolist():
+        positions = problem.choices(key)
+        stats = problem.evaluate_build(positions)
+        build = {
+            "value": stats[problem.target],
+            "stats": stats,
+            "traits": [],
+            "equipment": [],
+        }
+        for dim, position in zip(problem.dims, positions):
+            option = dim.ids[position]
+            if option is None:
+                continue
+            if dim.kind == "trait":
+                name, category, _, _ = catalog.traits[option]
+                build["traits"].append(
+                    {"id": option, "name": name, "category": category}
+                )
+            else:
+                name, location, _ = catalog.templates[option]
+                build["equipment"].append(
+                    {"id": option, "name": name, "location": location}
+                )
+        builds.append(build)
+
+    return {
+        "target": problem.target,
+        "direction": problem.direction,
+        "candidates": problem.candidates,
+        "evaluated": sum(result[2] for result in results),
+        "seconds": round(time.perf_counter() - start, 4),
+        "builds": builds,
+    }
@@ -0,0 +1,254 @@
+"""
+Безопасный парсер формул правил.
+
+Формула превращается в дерево (AST) из кортежей, без использования ``eval()``.
+Дерево состоит только из чисел, строк и кортежей, поэтому его можно хранить
+в JSON (например, в снапшоте системы) и восстанавливать без повторного разбора.
+
+Грамматика::
+
+    expr  := term (("+" | "-") term)*
+    term  := unary (("*" | "/") unary)*
+    unary := "-" unary | atom
+    atom  := NUMBER | call | "(" expr ")"
+    call  := NAME "(" [arg ("," arg)*] ")"
+    arg   := STRING | NUMBER
+
+Узлы дерева::
+
+    ("num", 5)
+    ("call", "trait_meta", ("Class", "base_hp"))
+    ("op", "+", left, right)
+    ("neg", node)
+"""
+
+import re
+from functools import lru_cache
+
+# "Белый список" функций формул и количество их аргументов
+FUNCTIONS = {
+    "stat": 1,
+    "trait_meta": 2,
+    "equipment_meta": 2,
+    "equipment_sum": 2,
+    "equipment_max": 2,
+}
+
+# Какой источник данных персонажа читает каждая функция.
+# Совпадает с названиями в depends_on схемы вычисляемых статов.
+FUNCTION_SOURCES = {
+    "stat": "stats",
+    "trait_meta": "traits",
+    "equipment_meta": "equipment",
+    "equipment_sum": "equipment",
+    "equipment_max": "equipment",
+}
+
+TOKEN_RE = re.compile(
+    r"""
+    \s*(?:
+        (?P<number>\d+)
+      | (?P<name>[A-Za-z_]\w*)
+      | '(?P<squote>[^']*)'
+      | "(?P<dquote>[^"]*)"
+      | (?P<punct>[-+*/(),])
+    )
+    """,
+    re.VERBOSE,
+)
+
+
+class FormulaError(ValueError):
+    """Формула не соответствует грамматике или использует неизвестную функцию."""
+
+
+def tokenize(formula):
+    tokens = []
+    position = 0
+    formula = formula.rstrip()
+    while position < len(formula):
+        match = TOKEN_RE.match(formula, position)
+        if not match:
+            raise FormulaError(
+                f"Unexpected character at position {position} in formula: {formula}"
+            )
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "number":
+            tokens.append(("number", int(value)))
+        elif kind in ("squote", "dquote"):
+            tokens.append(("string", value))
+        else:
+            tokens.append((kind, value))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, formula):
+        self.formula = formula
+        self.tokens = tokenize(formula)
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def take(self, kind=None, value=None):
+        token = self.peek()
+        if (
+            token[0] is None
+            or (kind and token[0] != kind)
+            or (value and token[1] != value)
+        ):
+            expected = value or kind or "a token"
+            raise FormulaError(f"Expected {expected} in formula: {self.formula}")
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise FormulaError("Empty formula")
+        node = self.expr()
+        if self.position != len(self.tokens):
+            raise FormulaError(f"Unexpected token in formula: {self.formula}")
+        return node
+
+    def expr(self):
+        node = self.term()
+        while self.peek() in (("punct", "+"), ("punct", "-")):
+            operator = self.take()[1]
+            node = ("op", operator, node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek() in (("punct", "*"), ("punct", "/")):
+            operator = self.take()[1]
+            node = ("op", operator, node, self.unary())
+        return node
+
+    def unary(self):
+        if self.peek() == ("punct", "-"):
+            self.take()
+            operand = self.unary()
+            if operand[0] == "num":
+                return ("num", -operand[1])
+            return ("neg", operand)
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.peek()
+        if kind == "number":
+            self.take()
+            return ("num", value)
+        if kind == "name":
+            return self.call()
+        if (kind, value) == ("punct", "("):
+            self.take()
+            node = self.expr()
+            self.take("punct", ")")
+            return node
+        raise FormulaError(f"Invalid value or function format: {self.formula}")
+
+    def call(self):
+        name = self.take("name")[1]
+        if name not in FUNCTIONS:
+            raise FormulaError(f"Unknown function: {name}")
+        self.take("punct", "(")
+        args = []
+        if self.peek() != ("punct", ")"):
+            while True:
+                kind, value = self.peek()
+                if kind not in ("string", "number"):
+                    raise FormulaError(
+                        f"Function arguments must be literals in formula: {self.formula}"
+                    )
+                self.take()
+                args.append(value)
+                if self.peek() != ("punct", ","):
+                    break
+                self.take()
+        self.take("punct", ")")
+        if len(args) != FUNCTIONS[name]:
+            raise FormulaError(
+                f"Function {name} expects {FUNCTIONS[name]} arguments, got {len(args)}"
+            )
+        return ("call", name, tuple(args))
+
+
+@lru_cache(maxsize=4096)
+def compile_formula(formula):
+    """Разбирает формулу в AST. Результат кэшируется на уровне процесса."""
+    return _Parser(formula).parse()
+
+
+def evaluate_ast(node, call):
+    """
+    Вычисляет AST. ``call(name, args)`` возвращает значение функции-хелпера.
+    Деление целочисленное, с округлением вниз (как в большинстве НРИ).
+    """
+    kind = node[0]
+    if kind == "num":
+        return node[1]
+    if kind == "call":
+        return call(node[1], node[2])
+    if kind == "neg":
+        return -evaluate_ast(node[1], call)
+
+    left = evaluate_ast(node[2], call)
+    right = evaluate_ast(node[3], call)
+    operator = node[1]
+    if operator == "+":
+        return left + right
+    if operator == "-":
+        return left - right
+    if operator == "*":
+        return left * right
+    if right == 0:
+        raise FormulaError("Division by zero")
+    return left // right
+
+
+def metadata_value(metadata, path):
+    """
+    Число из metadata черты или предмета по пути вида 'base_thresholds.major'.
+    Отсутствующий ключ или нечисловое значение дают 0.
+    """
+    value = metadata
+    try:
+        for key in path.split("."):
+            value = value[key]
+        return int(value)
+    except (KeyError, ValueError, TypeError):
+        return 0
+
+
+def iter_calls(node):
+    """Перебирает все вызовы функций в AST."""
+    kind = node[0]
+    if kind == "call":
+        yield node
+    elif kind == "neg":
+        yield from iter_calls(node[1])
+    elif kind == "op":
+        yield from iter_calls(node[2])
+        yield from iter_calls(node[3])
+
+
+def formula_sources(node):
+    """Источники данных персонажа (stats/traits/equipment), от которых зависит формула."""
+    return {FUNCTION_SOURCES[call[1]] for call in iter_calls(node)}
+
+
+def stat_references(node):
+    """Имена статов, которые формула читает через stat()."""
+    return {call[2][0] for call in iter_calls(node) if call[1] == "stat"}
+
+
+def ast_from_json(data):
+    """Восстанавливает AST из JSON-представления (списки вместо кортежей)."""
+    if isinstance(data, list):
+        return tuple(ast_from_json(item) for item in data)
+    return data
@@ -0,0 +1,201 @@
+"""
+Реестр правил игровых систем на уровне процесса.
+
+Для каждой системы хранит объект правил: снапшот, отображенный в память
+(если он собран и соответствует текущей версии правил), или правила,
+собранные из БД. Объект переиспользуется всеми запросами воркера, пока
+не изменится GameSystem.rules_version (правки особенностей его не меняют).
+"""
+
+import glob
+import os
+import threading
+
+from django.conf import settings
+
+from core.metrics import RULES_REGISTRY_LOOKUPS
+
+from .parser import compile_formula
+from .snapshot import SnapshotError, SystemSnapshot, snapshot_path
+
+_lock = threading.Lock()
+# system_id -> объект правил (SystemSnapshot или DatabaseRules)
+_rules = {}
+# slug -> SystemSnapshot, открытые заранее или при первом обращении
+_snapshots = {}
+
+_lookup_hit = RULES_REGISTRY_LOOKUPS.labels("hit")
+_lookup_snapshot = RULES_REGISTRY_LOOKUPS.labels("snapshot")
+_lookup_database = RULES_REGISTRY_LOOKUPS.labels("database")
+
+
+class DatabaseRules:
+    """
+    Правила и каталог системы, собранные из БД.
+    Используются, когда снапшота нет или он устарел. Каталог читается
+    лениво и целиком, по одному запросу на набор.
+    """
+
+    def __init__(self, system):
+        self.system_id = system.pk
+        self.slug = system.slug
+        self.catalog_version = system.catalog_version
+        self.rules_version = system.rules_version
+        self.metadata = system.metadata or {}
+        self._system = system
+        self._traits = None
+        self._categories = None
+        self._equipment = None
+
+    def compiled_formula(self, formula):
+        return compile_formula(formula)
+
+    def _load_traits(self):
+        from core.models import CharacterTrait, TraitCategory
+
+        traits = {
+            row["id"]: {**row, "children": [], "feature_ids": []}
+            for row in CharacterTrait.objects.filter(system=self._system).values(
+                "id", "name", "category_id", "parent_id", "metadata"
+            )
+        }
+        categories = {
+            category_id: {"id": category_id, "name": name, "trait_ids": []}
+            for category_id, name in TraitCategory.objects.filter(
+                system=self._system
+            ).values_list("id", "name")
+        }
+        for trait_id in sorted(traits):
+            trait = traits[trait_id]
+            categories[trait["category_id"]]["trait_ids"].append(trait_id)
+            if trait["parent_id"] in traits:
+                traits[trait["parent_id"]]["children"].append(trait_id)
+        for trait_id, feature_id in CharacterTrait.features.through.objects.filter(
+            charactertrait__system=self._system
+        ).values_list("charactertrait_id", "feature_id"):
+            traits[trait_id]["feature_ids"].append(feature_id)
+
+        self._traits = traits
+        self._categories = {
+            category["name"].lower(): category for category in categories.values()
+        }
+
+    @property
+    def categories(self):
+        if self._categories is None:
+            self._load_traits()
+        return self._categories
+
+    def trait(self, trait_id):
+        if self._traits is None:
+            self._load_traits()
+        return self._traits.get(trait_id)
+
+    def traits_in_category(self, category_name):
+        category = self.categories.get(category_name.lower())
+        if not category:
+            return []
+        return [self.trait(trait_id) for trait_id in category["trait_ids"]]
+
+    def equipment_template(self, template_id):
+        if self._equipment is None:
+            from core.models import EquipmentTemplate
+
+            self._equipment = {
+                row["id"]: row
+                for row in EquipmentTemplate.objects.filter(system=self._system).values(
+                    "id", "name", "metadata"
+                )
+            }
+        return self._equipment.get(template_id)
+
+
+def snapshot_dir():
+    return getattr(settings, "RULES_SNAPSHOT_DIR", None)
+
+
+def _open_snapshot(slug, rules_version=None):
+    """Возвращает снапшот системы, переоткрывая файл, если он был пересобран."""
+    snapshot = _snapshots.get(slug)
+    if snapshot is not None and (
+        rules_version is None or snapshot.rules_version == rules_version
+    ):
+        return snapshot
+
+    directory = snapshot_dir()
+    if not directory:
+        return None
+    path = snapshot_path(directory, slug)
+    if not os.path.exists(path):
+        return None
+    try:
+        fresh = SystemSnapshot(path)
+    except (OSError, SnapshotError):
+        return None
+    _snapshots[slug] = fresh
+    return fresh
+
+
+def get_rules(system):
+    """
+    Возвращает правила системы. Снапшот используется, только если он собран
+    для этой же системы и той же версии правил; иначе правила читаются из БД.
+    """
+    rules = _rules.get(system.pk)
+    if rules is not None and rules.rules_version == system.rules_version:
+        _lookup_hit.inc()
+        return rules
+
+    with _lock:
+        rules = _rules.get(system.pk)
+        if rules is not None and rules.rules_version == system.rules_version:
+            _lookup_hit.inc()
+            return rules
+
+        snapshot = _open_snapshot(system.slug, system.rules_version)
+        if (
+            snapshot is not None
+            and snapshot.system_id == system.pk
+            and snapshot.rules_version == system.rules_version
+        ):
+            rules = snapshot
+            _lookup_snapshot.inc()
+        else:
+            rules = DatabaseRules(system)
+            _lookup_database.inc()
+        _rules[system.pk] = rules
+    return rules
+
+
+def preload_snapshots():
+    """
+    Отображает в память все снапшоты из RULES_SNAPSHOT_DIR при старте процесса,
+    если включен RULES_SNAPSHOT_PRELOAD. Обращений к БД здесь нет: соответствие
+    версии правил проверяется при первом вызове get_rules().
+    """
+    directory = snapshot_dir()
+    if not directory or not getattr(settings, "RULES_SNAPSHOT_PRELOAD", False):
+        return 0
+    with _lock:
+        for path in glob.glob(os.path.join(directory, "*.snapshot")):
+            slug = os.path.splitext(os.path.basename(path))[0]
+            _open_snapshot(slug)
+    return len(_snapshots)
+
+
+def status():
+    """Сколько систем и снапшотов сейчас загружено в процесс."""
+    return {
+        "systems": len(_rules),
+        "snapshots": len(_snapshots),
+        "snapshot_systems": sum(
+            isinstance(rules, SystemSnapshot) for rules in _rules.values()
+        ),
+    }
+
+
+def clear():
+    """Сбрасывает реестр (для тестов и бенчмарков)."""
+    with _lock:
+        _rules.clear()
+        _snapshots.clear()
@@ -0,0 +1,321 @@
+"""
+Бинарный снапшот скомпилированных правил и каталога игровой системы.
+
+Снапшот собирается отдельным шагом (``manage.py build_system_snapshot``)
+и отображается воркерами в память через ``mmap`` только для чтения.
+Страницы файла делятся между всеми процессами через page cache ОС,
+а записи каталога декодируются лениво, только при обращении к ним.
+
+Формат файла (все числа little-endian)::
+
+    HEAD    magic (8 байт) | версия формата (u16) | резерв (u16) | резерв (u32)
+    ...     секции, каждая выровнена по 8 байт
+    FOOTER  JSON с заголовком и таблицей секций {имя: [смещение, длина]}
+    TAIL    длина футера (u64) | magic (8 байт)
+
+Секции:
+
+* ``rules`` - JSON: metadata системы и AST всех формул;
+* ``categories`` - JSON: индекс категорий {имя в нижнем регистре: {...}};
+* ``<набор>_ids`` - отсортированный массив ID (int64);
+* ``<набор>_offsets`` - массив смещений записей в ``<набор>_data`` (uint64, n+1);
+* ``<набор>_data`` - склеенные JSON-записи.
+
+Наборы записей: ``traits`` (дерево черт) и ``equipment`` (шаблоны предметов).
+"""
+
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+
+from django.utils import timezone
+
+from .parser import FormulaError, ast_from_json, compile_formula
+
+MAGIC = b"TTRPGSNP"
+FORMAT_VERSION = 1
+HEAD = struct.Struct("<8sHHI")
+TAIL = struct.Struct("<Q8s")
+ALIGNMENT = 8
+
+
+class SnapshotError(Exception):
+    """Файл не является снапшотом или собран несовместимой версией формата."""
+
+
+def snapshot_path(directory, slug):
+    return os.path.join(directory, f"{slug}.snapshot")
+
+
+def iter_schema_formulas(metadata):
+    """Перебирает все строки-формулы из схемы правил системы."""
+    metadata = metadata or {}
+    schema = metadata.get("character_sheet_schema", {})
+    for rule in schema.get("computed_stats", {}).values():
+        if rule.get("formula"):
+            yield rule["formula"]
+    # Условия и эффекты игровых действий (броски кубиков - не формулы)
+    for action in metadata.get("available_actions", {}).values():
+        if action.get("requires"):
+            yield action["requires"]
+        for effect in action.get("effects", []):
+            for key in ("formula", "min", "max"):
+                if effect.get(key):
+                    yield effect[key]
+
+
+# --- Сборка ---
+
+
+class _SnapshotWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.sections = {}
+        stream.write(HEAD.pack(MAGIC, FORMAT_VERSION, 0, 0))
+
+    def _align(self):
+        padding = -self.stream.tell() % ALIGNMENT
+        if padding:
+            self.stream.write(b"\0" * padding)
+
+    def add_bytes(self, name, payload):
+        self._align()
+        self.sections[name] = [self.stream.tell(), len(payload)]
+        self.stream.write(payload)
+
+    def add_json(self, name, data):
+        self.add_bytes(name, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    def add_records(self, name, records):
+        """
+        Пишет набор записей ``(id, dict)``, отсортированных по ID.
+        В памяти копятся только массивы ID и смещений, сами записи - нет.
+        """
+        ids = array("q")
+        offsets = array("Q")
+
+        self._align()
+        data_start = self.stream.tell()
+        for record_id, record in records:
+            ids.append(record_id)
+            offsets.append(self.stream.tell() - data_start)
+            self.stream.write(json.dumps(record, ensure_ascii=False).encode("utf-8"))
+        offsets.append(self.stream.tell() - data_start)
+        self.sections[f"{name}_data"] = [data_start, offsets[-1]]
+
+        self.add_bytes(f"{name}_ids", ids.tobytes())
+        self.add_bytes(f"{name}_offsets", offsets.tobytes())
+
+    def finish(self, header):
+        footer = json.dumps({**header, "sections": self.sections}).encode("utf-8")
+        self.stream.write(footer)
+        self.stream.write(TAIL.pack(len(footer), MAGIC))
+
+
+def build_snapshot(system, path):
+    """
+    Собирает снапшот системы и атомарно заменяет им файл ``path``.
+    Воркеры, которые уже отобразили старый файл, продолжают работать с ним.
+    """
+    from core.models import CharacterTrait, EquipmentTemplate, TraitCategory
+
+    formulas = {}
+    for formula in iter_schema_formulas(system.metadata):
+        try:
+            formulas[formula] = compile_formula(formula)
+        except FormulaError:
+            # Ошибочную формулу сообщит движок при вычислении, как и без снапшота
+            continue
+
+    traits = CharacterTrait.objects.filter(system=system)
+    categories = {
+        category_id: {"id": category_id, "name": name, "trait_ids": []}
+        for category_id, name in TraitCategory.objects.filter(
+            system=system
+        ).values_list("id", "name")
+    }
+    children = {}
+    for trait_id, parent_id, category_id in traits.order_by("id").values_list(
+        "id", "parent_id", "category_id"
+    ):
+        categories[category_id]["trait_ids"].append(trait_id)
+        if parent_id:
+            children.setdefault(parent_id, []).append(trait_id)
+    feature_ids = {}
+    for trait_id, feature_id in CharacterTrait.features.through.objects.filter(
+        charactertrait__system=system
+    ).values_list("charactertrait_id", "feature_id"):
+        feature_ids.setdefault(trait_id, []).append(feature_id)
+
+    def trait_records():
+        for row in (
+            traits.order_by("id")
+            .values("id", "name", "category_id", "parent_id", "metadata")
+            .iterator()
+        ):
+            row["children"] = children.get(row["id"], [])
+            row["feature_ids"] = feature_ids.get(row["id"], [])
+            yield row["id"], row
+
+    def equipment_records():
+        for row in (
+            EquipmentTemplate.objects.filter(system=system)
+            .order_by("id")
+            .values("id", "name", "metadata")
+            .iterator()
+        ):
+            yield row["id"], row
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as stream:
+        writer = _SnapshotWriter(stream)
+        writer.add_json(
+            "rules",
+            {"metadata": system.metadata, "formulas": formulas},
+        )
+        writer.add_json(
+            "categories",
+            {category["name"].lower(): category for category in categories.values()},
+        )
+        writer.add_records("traits", trait_records())
+        writer.add_records("equipment", equipment_records())
+        writer.finish(
+            {
+                "system_id": system.pk,
+                "slug": system.slug,
+                "name": system.name,
+                "catalog_version": system.catalog_version,
+                "rules_version": system.rules_version,
+                "built_at": timezone.now().isoformat(),
+            }
+        )
+    os.replace(temporary_path, path)
+
+
+# --- Чтение ---
+
+
+class _RecordSet:
+    """Ленивый доступ к набору записей снапшота по ID через бинарный поиск."""
+
+    def __init__(self, snapshot, name):
+        self._data = snapshot.section(f"{name}_data")
+        self._ids = snapshot.section(f"{name}_ids").cast("q")
+        self._offsets = snapshot.section(f"{name}_offsets").cast("Q")
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, record_id):
+        index = bisect_left(self._ids, record_id)
+        if index == len(self._ids) or self._ids[index] != record_id:
+            return None
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return json.loads(bytes(self._data[start:end]))
+
+    def ids(self):
+        return self._ids.tolist()
+
+
+class SystemSnapshot:
+    """
+    Правила и каталог одной системы, отображенные в память из файла снапшота.
+    Реализует тот же интерфейс, что и ``core.engine.registry.DatabaseRules``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError(f"{path} is empty")
+        self._view = memoryview(self._mmap)
+
+        if len(self._mmap) < HEAD.size + TAIL.size:
+            raise SnapshotError(f"{path} is not a rules snapshot")
+        magic, version, _, _ = HEAD.unpack_from(self._mmap, 0)
+        footer_length, tail_magic = TAIL.unpack_from(
+            self._mmap, len(self._mmap) - TAIL.size
+        )
+        if magic != MAGIC or tail_magic != MAGIC:
+            raise SnapshotError(f"{path} is not a rules snapshot")
+        if version != FORMAT_VERSION:
+            raise SnapshotError(
+                f"{path} has format version {version}, expected {FORMAT_VERSION}"
+            )
+
+        footer_start = len(self._mmap) - TAIL.size - footer_length
+        self.header = json.loads(
+            bytes(self._view[footer_start : footer_start + footer_length])
+        )
+        self.sections = self.header.pop("sections")
+
+        rules = json.loads(bytes(self.section("rules")))
+        self.metadata = rules["metadata"]
+        self.formulas = {
+            formula: ast_from_json(ast) for formula, ast in rules["formulas"].items()
+        }
+        self._categories = None
+        self._traits = None
+        self._equipment = None
+
+    @property
+    def system_id(self):
+        return self.header["system_id"]
+
+    @property
+    def slug(self):
+        return self.header["slug"]
+
+    @property
+    def catalog_version(self):
+        return self.header["catalog_version"]
+
+    @property
+    def rules_version(self):
+        # В снапшотах старой сборки версии правил нет: такие не совпадут
+        # ни с одной системой и будут пересобраны
+        return self.header.get("rules_version")
+
+    def section(self, name):
+        offset, length = self.sections[name]
+        return self._view[offset : offset + length]
+
+    def compiled_formula(self, formula):
+        compiled = self.formulas.get(formula)
+        if compiled is None:
+            compiled = compile_formula(formula)
+        return compiled
+
+    @property
+    def categories(self):
+        if self._categories is None:
+            self._categories = json.loads(bytes(self.section("categories")))
+        return self._categories
+
+    def trait(self, trait_id):
+        if self._traits is None:
+            self._traits = _RecordSet(self, "traits")
+        return self._traits.get(trait_id)
+
+    def traits_in_category(self, category_name):
+        category = self.categories.get(category_name.lower())
+        if not category:
+            return []
+        return [self.trait(trait_id) for trait_id in category["trait_ids"]]
+
+    def equipment_template(self, template_id):
+        if self._equipment is None:
+            self._equipment = _RecordSet(self, "equipment")
+        return self._equipment.get(template_id)
+
+    def close(self):
+        # Представления нужно освободить до закрытия mmap
+        self._traits = self._equipment = None
+        self._view.release()
+        self._mmap.close()
@@ -0,0 +1,39 @@
+"""
+Вычисление AST формулы над массивами numpy.
+
+Вызовы функций (``lookup``) могут возвращать числа или массивы: результат
+получается по правилам broadcasting, поэтому одна формула считается сразу
+для многих вариантов (уровней, предметов, комбинаций черт). Семантика та же,
+что у ``parser.evaluate_ast``: деление целочисленное с округлением вниз.
+Деление на ноль не прерывает вычисление, а помечает элементы в ``invalid``.
+"""
+
+import numpy as np
+
+
+def evaluate(node, lookup, invalid):
+    """
+    Вычисляет AST. ``lookup(call_node)`` возвращает значение вызова функции,
+    ``invalid`` - булев массив формы результата, куда отмечаются элементы
+    с делением на ноль.
+    """
+    kind = node[0]
+    if kind == "num":
+        return node[1]
+    if kind == "call":
+        return lookup(node)
+    if kind == "neg":
+        return -evaluate(node[1], lookup, invalid)
+
+    left = evaluate(node[2], lookup, invalid)
+    right = evaluate(node[3], lookup, invalid)
+    operator = node[1]
+    if operator == "+":
+        return left + right
+    if operator == "-":
+        return left - right
+    if operator == "*":
+        return left * right
+    zero = np.equal(right, 0)
+    np.logical_or(invalid, zero, out=invalid)
+    return np.floor_divide(left, np.where(zero, 1, right))
@@ -0,0 +1,74 @@
+"""
+Эндпоинты проверки состояния для оркестратора и балансировщика.
+
+* ``/health/live/`` - процесс жив и отвечает (без обращений к БД);
+* ``/health/ready/`` - воркер готов принимать трафик: основная БД отвечает,
+  а снапшоты правил (если включена их предзагрузка) отображены в память.
+
+Это обычные Django-вью без DRF: им не нужны сессии, аутентификация
+и пагинация, и они не должны зависеть от их настроек.
+"""
+
+import glob
+import os
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.http import JsonResponse
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_GET
+
+from .engine import registry
+
+
+def check_database(alias="default"):
+    start = time.perf_counter()
+    try:
+        with connections[alias].cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+    except DatabaseError as e:
+        return {"ok": False, "error": str(e)}
+    return {"ok": True, "ms": round((time.perf_counter() - start) * 1000, 2)}
+
+
+def check_rules_registry():
+    """
+    Правила "прогреты", если все собранные снапшоты уже отображены в память.
+    Без предзагрузки снапшотов правила читаются лениво, и проверять нечего.
+    """
+    status = registry.status()
+    directory = registry.snapshot_dir()
+    if not directory or not getattr(settings, "RULES_SNAPSHOT_PRELOAD", False):
+        return {"ok": True, **status}
+    available = len(glob.glob(os.path.join(directory, "*.snapshot")))
+    if status["snapshots"] < available:
+        # Снапшот мог появиться после старта воркера
+        registry.preload_snapshots()
+        status = registry.status()
+    return {
+        "ok": status["snapshots"] >= available,
+        "available_snapshots": available,
+        **status,
+    }
+
+
+@never_cache
+@require_GET
+def live(request):
+    return JsonResponse({"status": "ok"})
+
+
+@never_cache
+@require_GET
+def ready(request):
+    checks = {
+        "database": check_database(),
+        "rules": check_rules_registry(),
+    }
+    ok = all(check["ok"] for check in checks.values())
+    return JsonResponse(
+        {"status": "ok" if ok else "unavailable", "checks": checks},
+        status=200 if ok else 503,
+    )
@@ -0,0 +1,530 @@
+from collections import defaultdict
+
+from core.loader.records import RECORD_TYPES, SeedFormatError, record_hash
+from core.models import (
+    GameSystem,
+    TraitCategory,
+    DamageType,
+    FeatureSet,
+    Feature,
+    CharacterTrait,
+    EquipmentTemplate,
+)
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Какие буферы нужно сбросить в БД перед сбросом буфера данного типа,
+# чтобы все ссылки по имени уже имели ID.
+FLUSH_DEPENDENCIES = {
+    "feature": ("feature_set",),
+    "character_trait": ("trait_category", "feature"),
+}
+
+# Порядок удаления устаревших строк: сначала те, кто ссылается на остальных.
+PRUNE_ORDER = (
+    "character_trait",
+    "feature",
+    "equipment_template",
+    "feature_set",
+    "damage_type",
+    "trait_category",
+)
+
+# Сущности, которые входят в снапшот правил (см. core.engine.snapshot).
+# Особенности в него не попадают, но их удаление меняет связи черт.
+RULES_RECORD_TYPES = ("trait_category", "character_trait", "equipment_template")
+RULES_DELETE_TYPES = RULES_RECORD_TYPES + ("feature", "feature_set")
+
+ENTITY_NAMES = {
+    "trait_category": "Trait Categories",
+    "damage_type": "Damage Types",
+    "feature_set": "Feature Sets",
+    "equipment_template": "Equipment Templates",
+    "feature": "Features",
+    "character_trait": "Character Traits",
+}
+
+
+class LoadReport:
+    """
+    Итог загрузки: сколько строк каждого типа создано, изменено, осталось
+    без изменений и удалено, а также точные ID измененных строк.
+    """
+
+    def __init__(self):
+        self.system = None
+        # Весь сид совпал с последним загруженным - загрузка пропущена
+        self.skipped = False
+        self.system_created = False
+        self.rules_changed = False
+        self.stats = {
+            record_type: {
+                "created": 0,
+                "updated": 0,
+                "unchanged": 0,
+                "deleted": 0,
+                "stale": 0,
+            }
+            for record_type in ENTITY_NAMES
+        }
+        # ID созданных и измененных строк, по типам
+        self.changed_ids = {record_type: set() for record_type in ENTITY_NAMES}
+        # ID строк, которых больше нет в сиде (удаляются только с prune=True)
+        self.deleted_ids = {record_type: set() for record_type in ENTITY_NAMES}
+
+    @property
+    def has_changes(self):
+        return (
+            self.system_created
+            or self.rules_changed
+            or any(self.changed_ids.values())
+            or any(self.deleted_ids.values())
+        )
+
+    @property
+    def has_rule_changes(self):
+        """Затронуты ли данные снапшота правил (а не только особенности)."""
+        return (
+            self.system_created
+            or self.rules_changed
+            or any(self.changed_ids[record_type] for record_type in RULES_RECORD_TYPES)
+            or any(self.deleted_ids[record_type] for record_type in RULES_DELETE_TYPES)
+        )
+
+    def summary(self):
+        """Человекочитаемая сводка изменений, по строке на тип сущности."""
+        if self.skipped:
+            return [f"{self.system.name}: seed is unchanged, nothing to do."]
+
+        lines = []
+        if self.rules_changed:
+            lines.append(f"{self.system.name}: system rules changed.")
+        for record_type, name in ENTITY_NAMES.items():
+            stats = self.stats[record_type]
+            line = (
+                f"{name}: {stats['created']} created, {stats['updated']} updated, "
+                f"{stats['unchanged']} unchanged, {stats['deleted']} deleted"
+            )
+            if stats["stale"]:
+                line += f", {stats['stale']} stale (use --prune to delete)"
+            lines.append(line)
+        return lines
+
+
+class SystemLoader:
+    """
+    Потоковый загрузчик игровой системы.
+    Принимает поток записей (см. ``core.loader.records``) и пишет их в БД
+    пакетами фиксированного размера. В памяти хранятся только текущие пакеты
+    и словари "имя -> ID", но не ORM-объекты всей системы.
+
+    Загрузка инкрементальная: для каждой записи считается хэш содержимого,
+    и в БД пишутся только новые и изменившиеся строки. Строки, которых нет
+    в сиде, удаляются только при ``prune=True``.
+    Должен вызываться внутри ``transaction.atomic()``.
+    """
+
+    def __init__(
+        self,
+        batch_size=DEFAULT_BATCH_SIZE,
+        log=None,
+        force=False,
+        prune=False,
+        on_prune=None,
+    ):
+        self.batch_size = batch_size
+        self.log = log or (lambda message: None)
+        # force: перезаписать все строки, даже если хэши совпадают
+        self.force = force
+        self.prune = prune
+        # Вызывается с отчетом перед удалением устаревших строк,
+        # пока связи с ними еще существуют.
+        self.on_prune = on_prune
+
+        self.report = LoadReport()
+        self.system = None
+        self.buffers = {record_type: [] for record_type in RECORD_TYPES}
+
+        # Словари "имя -> ID" для установки связей без повторных запросов.
+        # Имена черт уникальны только внутри категории: trait_ids -
+        # "(категория, имя) -> ID", trait_ids_by_name - "имя -> [ID, ...]".
+        self.category_ids = {}
+        self.feature_set_ids = {}
+        self.feature_ids = {}
+        self.trait_ids = {}
+        self.trait_ids_by_name = defaultdict(list)
+        # ID всех строк, встреченных в сиде (для поиска устаревших)
+        self.seen_ids = {record_type: set() for record_type in ENTITY_NAMES}
+        # Ключи записей, уже встреченных в сиде (для поиска повторов)
+        self.seen_keys = {record_type: set() for record_type in ENTITY_NAMES}
+        # Связи "подкласс -> родитель" откладываем до конца потока:
+        # родитель может встретиться позже ребенка.
+        self.pending_parents = []
+
+    def load(self, records, seed_hash=None):
+        """
+        Загружает поток записей и возвращает ``LoadReport``.
+        Если передан ``seed_hash`` и он совпадает с хэшем последней загрузки
+        системы, остальной поток не читается вовсе - кроме загрузки с prune:
+        устаревшие строки ищутся по всем записям сида.
+        """
+        records = iter(records)
+        first = next(records, None)
+        if first is None or first.get("type") != "system":
+            raise SeedFormatError("The first record of a seed must be 'system'")
+        self.load_system(first)
+
+        if (
+            seed_hash
+            and seed_hash == self.system.content_hash
+            and not self.force
+            and not self.prune
+        ):
+            self.report.skipped = True
+            return self.report
+
+        for record in records:
+            record_type = record["type"]
+            if record_type == "system":
+                raise SeedFormatError("A seed must contain exactly one 'system' record")
+            self.buffers[record_type].append(record)
+            if len(self.buffers[record_type]) >= self.batch_size:
+                self.flush(record_type)
+
+        for record_type in RECORD_TYPES[1:]:
+            self.flush(record_type)
+        self.link_parents()
+        self.remove_stale()
+
+        if self.report.has_changes:
+            GameSystem.bump_catalog_version(
+                self.system.pk, rules=self.report.has_rule_changes
+            )
+        if seed_hash:
+            self.system.content_hash = seed_hash
+            self.system.save(update_fields=["content_hash"])
+        return self.report
+
+    def load_system(self, record):
+        missing = [key for key in ("slug", "name", "version") if key not in record]
+        if missing:
+            raise SeedFormatError(
+                f"The 'system' record is missing required fields: {', '.join(missing)}"
+            )
+        fields = {
+            "name": record["name"],
+            "version": record["version"],
+            "metadata": record.get("metadata", {}),
+        }
+        self.system, created = GameSystem.objects.get_or_create(
+            slug=record["slug"], defaults=fields
+        )
+        self.report.system = self.system
+        self.report.system_created = created
+        self.log(f'{"Created" if created else "Found"} Game System: {self.system.name}')
+
+        if created:
+            self.report.rules_changed = True
+            return
+        changed = [
+            field
+            for field, value in fields.items()
+            if getattr(self.system, field) != value
+        ]
+        if changed:
+            self.report.rules_changed = "metadata" in changed
+            for field in changed:
+                setattr(self.system, field, fields[field])
+            self.system.save(update_fields=changed)
+
+    def flush(self, record_type):
+        for dependency in FLUSH_DEPENDENCIES.get(record_type, ()):
+            self.flush(dependency)
+
+        batch = self.buffers[record_type]
+        if not batch:
+            return
+        self.buffers[record_type] = []
+        getattr(self, f"flush_{record_type}")(batch)
+
+    def keyed(self, record_type, batch, key, label=None):
+        """
+        Раскладывает пакет записей в словарь {key(record): запись}. Повтор
+        ключа в сиде (в том же или в предыдущем пакете) - ошибка формата:
+        иначе одна строка молча перезаписала бы другую.
+        """
+        records = {}
+        seen = self.seen_keys[record_type]
+        for record in batch:
+            record_key = key(record)
+            if record_key in seen:
+                name = label(record) if label else record["name"]
+                raise SeedFormatError(
+                    f"{ENTITY_NAMES[record_type]}: '{name}' is defined more than once"
+                )
+            seen.add(record_key)
+            records[record_key] = record
+        return records
+
+    def sync(self, record_type, queryset, records, build, fields):
+        """
+        Сравнивает пакет записей с БД по хэшам и применяет только разницу.
+
+        ``records`` - словарь {ключ: запись}, где ключ - это значения полей
+        ``key_fields`` модели (последнее из них всегда ``name``).
+        ``build(key, record)`` возвращает несохраненный объект с полями из записи.
+        Возвращает словарь {ключ: ID} и множество ключей созданных/измененных строк.
+        """
+        stats = self.report.stats[record_type]
+        key_fields = (
+            ("category_id", "name") if record_type == "character_trait" else ("name",)
+        )
+
+        def fetch(keys):
+            rows = queryset.filter(name__in=[key[-1] for key in keys]).values_list(
+                *key_fields, "id", "content_hash"
+            )
+            return {
+                tuple(row[:-2]): row[-2:] for row in rows if tuple(row[:-2]) in keys
+            }
+
+        existing = fetch(records)
+        ids = {}
+        to_create = []
+        to_update = []
+        for key, record in records.items():
+            obj = build(key, record)
+            obj.content_hash = record_hash(record)
+            if key not in existing:
+                to_create.append((key, obj))
+                continue
+            pk, current_hash = existing[key]
+            ids[key] = pk
+            if current_hash == obj.content_hash and not self.force:
+                stats["unchanged"] += 1
+                continue
+            obj.pk = pk
+            to_update.append(obj)
+
+        queryset.model.objects.bulk_create([obj for _, obj in to_create])
+        queryset.model.objects.bulk_update(to_update, [*fields, "content_hash"])
+        if any(obj.pk is None for _, obj in to_create):
+            # БД не вернула ID вставленных строк - дочитываем их отдельно
+            created_ids = fetch({key for key, _ in to_create})
+            for key, obj in to_create:
+                obj.pk = created_ids[key][0]
+
+        ids.update((key, obj.pk) for key, obj in to_create)
+        stats["created"] += len(to_create)
+        stats["updated"] += len(to_update)
+        self.seen_ids[record_type].update(ids.values())
+        self.report.changed_ids[record_type].update(obj.pk for _, obj in to_create)
+        self.report.changed_ids[record_type].update(obj.pk for obj in to_update)
+        updated_ids = {obj.pk for obj in to_update}
+        changed = {key for key, _ in to_create}
+        changed.update(key for key, pk in ids.items() if pk in updated_ids)
+        return ids, changed
+
+    # --- Сброс пакетов по типам ---
+
+    def flush_named(self, record_type, model, batch):
+        """Категории и типы урона: у них нет ничего, кроме имени."""
+        stats = self.report.stats[record_type]
+        queryset = model.objects.filter(system=self.system)
+        names = list(dict.fromkeys(record["name"] for record in batch))
+
+        existing = set(queryset.filter(name__in=names).values_list("name", flat=True))
+        missing = [name for name in names if name not in existing]
+        model.objects.bulk_create(
+            [model(name=name, system=self.system) for name in missing],
+            ignore_conflicts=True,
+        )
+        stats["created"] += len(missing)
+        stats["unchanged"] += len(existing)
+
+        ids = dict(queryset.filter(name__in=names).values_list("name", "id"))
+        self.seen_ids[record_type].update(ids.values())
+        self.report.changed_ids[record_type].update(ids[name] for name in missing)
+        return ids
+
+    def flush_trait_category(self, batch):
+        self.category_ids.update(
+            self.flush_named("trait_category", TraitCategory, batch)
+        )
+
+    def flush_damage_type(self, batch):
+        self.flush_named("damage_type", DamageType, batch)
+
+    def flush_feature_set(self, batch):
+        ids, _ = self.sync(
+            "feature_set",
+            FeatureSet.objects.filter(system=self.system),
+            self.keyed("feature_set", batch, lambda record: (record["name"],)),
+            lambda key, record: FeatureSet(
+                name=record["name"],
+                system=self.system,
+                description=record.get("description", ""),
+                set_type=record.get("set_type", ""),
+            ),
+            ["description", "set_type"],
+        )
+        self.feature_set_ids.update((key[0], pk) for key, pk in ids.items())
+
+    def flush_equipment_template(self, batch):
+        self.sync(
+            "equipment_template",
+            EquipmentTemplate.objects.filter(system=self.system),
+            self.keyed("equipment_template", batch, lambda record: (record["name"],)),
+            lambda key, record: EquipmentTemplate(
+                name=record["name"],
+                system=self.system,
+                description=record.get("description", ""),
+                metadata=record.get("metadata", {}),
+            ),
+            ["description", "metadata"],
+        )
+
+    def flush_feature(self, batch):
+        # У Feature нет ограничения уникальности, поэтому сравниваем только
+        # с официальными (не homebrew) особенностями системы.
+        ids, _ = self.sync(
+            "feature",
+            Feature.objects.filter(system=self.system, created_by__isnull=True),
+            self.keyed("feature", batch, lambda record: (record["name"],)),
+            lambda key, record: Feature(
+                name=record["name"],
+                system=self.system,
+                description=record.get("description", ""),
+                metadata=record.get("metadata", {}),
+                feature_set_id=self.resolve(
+                    self.feature_set_ids, record.get("feature_set"), "Feature Set"
+                ),
+            ),
+            ["description", "metadata", "feature_set"],
+        )
+        self.feature_ids.update((key[0], pk) for key, pk in ids.items())
+
+    def flush_character_trait(self, batch):
+        records = self.keyed(
+            "character_trait",
+            batch,
+            lambda record: (
+                self.resolve(self.category_ids, record["category"], "Trait Category"),
+                record["name"],
+            ),
+            lambda record: f"{record['category']}/{record['name']}",
+        )
+
+        trait_ids, changed = self.sync(
+            "character_trait",
+            CharacterTrait.objects.filter(system=self.system),
+            records,
+            lambda key, record: CharacterTrait(
+                name=record["name"],
+                system=self.system,
+                category_id=key[0],
+                description=record.get("description", ""),
+                metadata=record.get("metadata", {}),
+            ),
+            ["description", "metadata"],
+        )
+        for key, record in records.items():
+            self.trait_ids[(record["category"], record["name"])] = trait_ids[key]
+            self.trait_ids_by_name[record["name"]].append(trait_ids[key])
+
+        # Связи трогаем только у новых и измененных черт: хэш записи
+        # учитывает и родителя, и список особенностей.
+        through = CharacterTrait.features.through
+        changed_ids = [trait_ids[key] for key in changed]
+        through.objects.filter(charactertrait_id__in=changed_ids).delete()
+        links = []
+        for key in changed:
+            record = records[key]
+            trait_id = trait_ids[key]
+            self.pending_parents.append(
+                (trait_id, record.get("parent"), record.get("parent_category"))
+            )
+            for feature_name in record.get("features", []):
+                feature_id = self.resolve(self.feature_ids, feature_name, "Feature")
+                links.append(through(charactertrait_id=trait_id, feature_id=feature_id))
+        through.objects.bulk_create(links, ignore_conflicts=True)
+
+    def link_parents(self):
+        """Второй проход: связи подклассов с родителями."""
+        updates = [
+            CharacterTrait(
+                pk=trait_id, parent_id=self.resolve_parent(parent_name, category)
+            )
+            for trait_id, parent_name, category in self.pending_parents
+        ]
+        CharacterTrait.objects.bulk_update(
+            updates, ["parent"], batch_size=self.batch_size
+        )
+        self.pending_parents = []
+
+    def remove_stale(self):
+        """Находит строки, которых больше нет в сиде, и удаляет их при prune=True."""
+        querysets = {
+            "character_trait": CharacterTrait.objects.filter(system=self.system),
+            "feature": Feature.objects.filter(
+                system=self.system, created_by__isnull=True
+            ),
+            "equipment_template": EquipmentTemplate.objects.filter(system=self.system),
+            "feature_set": FeatureSet.objects.filter(system=self.system),
+            "damage_type": DamageType.objects.filter(system=self.system),
+            "trait_category": TraitCategory.objects.filter(system=self.system),
+        }
+        for record_type in PRUNE_ORDER:
+            all_ids = set(querysets[record_type].values_list("id", flat=True))
+            stale = all_ids - self.seen_ids[record_type]
+            if self.prune:
+                self.report.deleted_ids[record_type] = stale
+                self.report.stats[record_type]["deleted"] = len(stale)
+            else:
+                self.report.stats[record_type]["stale"] = len(stale)
+
+        if not self.prune or not any(self.report.deleted_ids.values()):
+            return
+        if self.on_prune:
+            self.on_prune(self.report)
+        for record_type in PRUNE_ORDER:
+            stale = list(self.report.deleted_ids[record_type])
+            for start in range(0, len(stale), self.batch_size):
+                querysets[record_type].filter(
+                    pk__in=stale[start : start + self.batch_size]
+                ).delete()
+
+    def resolve_parent(self, name, category=None):
+        """
+        ID родительской черты. Имя без ``parent_category`` должно быть
+        однозначным: черты с тем же именем могут быть в разных категориях.
+        """
+        if not name:
+            return None
+        key = (category, name)
+        if category:
+            candidates = [self.trait_ids[key]] if key in self.trait_ids else []
+        else:
+            candidates = self.trait_ids_by_name.get(name, ())
+        if len(candidates) > 1:
+            raise SeedFormatError(
+                f"Parent trait '{name}' exists in several categories, "
+                "set parent_category"
+            )
+        if not candidates:
+            label = f"{category}/{name}" if category else name
+            raise SeedFormatError(
+                f"Character Trait '{label}' is referenced before it is defined"
+            )
+        return candidates[0]
+
+    @staticmethod
+    def resolve(ids, name, entity):
+        if not name:
+            return None
+        try:
+            return ids[name]
+        except KeyError:
+            raise SeedFormatError(
+                f"{entity} '{name}' is referenced before it is defined"
+            )
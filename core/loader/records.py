@@ -0,0 +1,133 @@
+"""
+Чтение и запись сид-файлов игровых систем в виде потока записей.
+
+Поддерживаются два формата:
+
+* NDJSON (``.ndjson`` / ``.jsonl``) - одна JSON-запись на строку, каждая запись
+  помечена типом сущности в поле ``type``. Файл читается построчно, поэтому
+  в памяти одновременно находится только одна запись.
+* Классический единый JSON (``daggerheart_1_0.json``) - документ целиком
+  конвертируется "на лету" в тот же поток записей.
+
+Первой записью потока всегда идет ``system``.
+
+Имена наборов, шаблонов предметов и особенностей уникальны в пределах сида,
+имена черт - в пределах категории. Родитель черты задается именем
+(``parent``); если такое имя есть в нескольких категориях, нужна еще
+``parent_category``.
+"""
+
+import hashlib
+import json
+import os
+
+# Порядок типов важен: каждая следующая сущность может ссылаться только на предыдущие.
+RECORD_TYPES = (
+    "system",
+    "trait_category",
+    "damage_type",
+    "feature_set",
+    "equipment_template",
+    "feature",
+    "character_trait",
+)
+
+NDJSON_EXTENSIONS = (".ndjson", ".jsonl")
+
+
+class SeedFormatError(ValueError):
+    """Сид-файл не удалось разобрать или он нарушает формат потока записей."""
+
+
+def is_ndjson(path):
+    return os.path.splitext(path)[1].lower() in NDJSON_EXTENSIONS
+
+
+def iter_seed_records(path):
+    """
+    Возвращает генератор записей сид-файла, независимо от его формата.
+    Каждая запись - словарь с обязательным полем ``type``.
+    """
+    if is_ndjson(path):
+        return iter_ndjson_records(path)
+    return iter_legacy_records(path)
+
+
+def iter_ndjson_records(path):
+    """Построчно читает NDJSON-файл, не загружая его в память целиком."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise SeedFormatError(
+                    f"Error decoding JSON on line {line_number} of {path}: {e}"
+                )
+            if not isinstance(record, dict) or record.get("type") not in RECORD_TYPES:
+                raise SeedFormatError(
+                    f"Line {line_number} of {path} is not a known record type"
+                )
+            yield record
+
+
+def iter_legacy_records(path):
+    """Конвертирует классический единый JSON-файл в поток записей."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except json.JSONDecodeError:
+        raise SeedFormatError(f"Error decoding JSON from: {path}")
+
+    yield from legacy_data_to_records(data)
+
+
+def legacy_data_to_records(data):
+    """Раскладывает словарь классического формата на записи в порядке зависимостей."""
+    yield {"type": "system", **data.get("system", {})}
+
+    for name in data.get("trait_categories", []):
+        yield {"type": "trait_category", "name": name}
+    for name in data.get("damage_types", []):
+        yield {"type": "damage_type", "name": name}
+    for feature_set in data.get("feature_sets", []):
+        yield {"type": "feature_set", **feature_set}
+    for template in data.get("equipment_templates", []):
+        yield {"type": "equipment_template", **template}
+    for feature in data.get("features", []):
+        yield {"type": "feature", **feature}
+    for trait in data.get("character_traits", []):
+        yield {"type": "character_trait", **trait}
+
+
+def record_hash(record):
+    """
+    Хэш содержимого записи. Не зависит от порядка ключей и от поля ``type``,
+    поэтому одинаков для NDJSON и классического формата.
+    """
+    payload = {key: value for key, value in record.items() if key != "type"}
+    canonical = json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """Хэш сид-файла целиком, читается кусками фиксированного размера."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_ndjson_records(records, stream):
+    """Записывает поток записей в открытый текстовый поток, по одной на строку."""
+    count = 0
+    for record in records:
+        stream.write(json.dumps(record, ensure_ascii=False))
+        stream.write("\n")
+        count += 1
+    return count
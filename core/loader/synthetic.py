@@ -0,0 +1,119 @@
+"""
+Генератор синтетических игровых систем произвольного размера.
+Нужен, чтобы видеть, как загрузчик, каталог и движок правил ведут себя
+на системах масштаба большого homebrew, а не на крошечном сиде Daggerheart.
+"""
+
+import random
+
+# Первая категория всегда "Class": на нее ссылаются сгенерированные формулы
+BASE_CATEGORIES = ("Class", "Subclass", "Ancestry", "Community")
+EQUIPMENT_LOCATIONS = ("armor", "primary_weapon", "secondary_weapon", "trinket")
+TRAIT_META_KEYS = 8
+EQUIPMENT_META_KEYS = 6
+
+
+def generate_system_records(
+    slug="synthetic",
+    features=50000,
+    traits=10000,
+    trait_depth=5,
+    equipment=5000,
+    formulas=100,
+    feature_sets=200,
+    categories=8,
+    features_per_trait=3,
+    seed=0,
+):
+    """
+    Возвращает генератор записей сида (см. ``core.loader.records``).
+    Черты выстраиваются в цепочки родителей глубиной ``trait_depth``.
+    Результат детерминирован для одинаковых параметров и ``seed``.
+    """
+    rnd = random.Random(seed)
+
+    computed_stats = {}
+    for index in range(formulas):
+        left = f"trait_meta('Class', 'stat_{index % TRAIT_META_KEYS}')"
+        location = EQUIPMENT_LOCATIONS[index % len(EQUIPMENT_LOCATIONS)]
+        if index % 3 == 0:
+            right = (
+                f"equipment_meta('{location}', 'bonus.{index % EQUIPMENT_META_KEYS}')"
+            )
+            depends_on = ["traits", "equipment"]
+        elif index % 3 == 1:
+            right = "stat('level')"
+            depends_on = ["traits", "stats"]
+        else:
+            right = str(rnd.randint(1, 20))
+            depends_on = ["traits"]
+        computed_stats[f"computed_{index}"] = {
+            "formula": f"{left} + {right}",
+            "depends_on": depends_on,
+        }
+
+    yield {
+        "type": "system",
+        "name": f"Synthetic {slug}",
+        "version": "1.0",
+        "slug": slug,
+        "metadata": {"character_sheet_schema": {"computed_stats": computed_stats}},
+    }
+
+    category_names = list(BASE_CATEGORIES[:categories])
+    category_names += [
+        f"Category {index}" for index in range(len(category_names), categories)
+    ]
+    for name in category_names:
+        yield {"type": "trait_category", "name": name}
+    for name in ("Physical", "Magical"):
+        yield {"type": "damage_type", "name": name}
+
+    set_names = [f"Set {index:05d}" for index in range(feature_sets)]
+    for name in set_names:
+        yield {"type": "feature_set", "name": name, "set_type": "Domain"}
+
+    for index in range(equipment):
+        location = EQUIPMENT_LOCATIONS[index % len(EQUIPMENT_LOCATIONS)]
+        yield {
+            "type": "equipment_template",
+            "name": f"Item {index:06d}",
+            "description": f"Synthetic {location} item.",
+            "metadata": {
+                "type": location,
+                "location": location,
+                "bonus": {
+                    str(key): rnd.randint(-2, 5) for key in range(EQUIPMENT_META_KEYS)
+                },
+            },
+        }
+
+    feature_names = [f"Feature {index:06d}" for index in range(features)]
+    for name in feature_names:
+        yield {
+            "type": "feature",
+            "name": name,
+            "description": f"Synthetic feature {name}.",
+            "feature_set": (
+                rnd.choice(set_names) if set_names and rnd.random() < 0.7 else None
+            ),
+            "metadata": {"type": "synthetic", "level_requirement": rnd.randint(1, 10)},
+        }
+
+    for index in range(traits):
+        depth = index % max(trait_depth, 1)
+        record = {
+            "type": "character_trait",
+            "category": category_names[depth % len(category_names)],
+            "name": f"Trait {index:06d}",
+            "description": f"Synthetic trait at depth {depth}.",
+            "features": (
+                rnd.sample(feature_names, min(features_per_trait, len(feature_names)))
+            ),
+            "metadata": {
+                f"stat_{key}": rnd.randint(1, 20) for key in range(TRAIT_META_KEYS)
+            },
+        }
+        if depth:
+            record["parent"] = f"Trait {index - 1:06d}"
+        yield record
@@ -0,0 +1,285 @@
+"""
+Нагрузочный тест API: виртуальные игроки за одним столом.
+
+Каждый поток - отдельный игрок со своей сессией (логин через ``/api-auth/``)
+и keep-alive соединением ``http.client``. Игрок в цикле выбирает сценарий
+по весам и делает паузу "на раздумья" между сценариями:
+
+* ``browse`` - сборка персонажа: системы, черты по категориям, особенности,
+  экипировка;
+* ``poll`` - лист персонажа, который клиент периодически перечитывает;
+* ``patch`` - серия правок статов листа подряд (каждая - пересчет и документ);
+* ``gm`` - мастер открывает список своих листов и каждый из них.
+
+Игроки и листы создает команда ``provision_loadtest``, нагрузку дает
+``run_loadtest``. Тестировать лучше не ``runserver``, а gunicorn
+(``gunicorn.conf.py``) с теми же настройками, что и в продакшене.
+"""
+
+import http.client
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+API = "/api/v1"
+LOGIN_PATH = "/api-auth/login/"
+
+# Запросов в серии правок статов
+PATCH_BURST = 3
+DEFAULT_MIX = {"browse": 3, "poll": 5, "patch": 1, "gm": 1}
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по рангу (без интерполяции) из отсортированного списка."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+class LatencyStats:
+    """Время ответа и ошибки по эндпоинтам; общий для всех потоков."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def summary(self, elapsed):
+        rows = []
+        for endpoint in sorted(self.latencies):
+            values = sorted(self.latencies[endpoint])
+            rows.append(
+                {
+                    "endpoint": endpoint,
+                    "requests": len(values),
+                    "errors": self.errors[endpoint],
+                    "rps": round(len(values) / elapsed, 2),
+                    "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                    "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+                    "max_ms": round(values[-1] * 1000, 1),
+                }
+            )
+        total = sum(row["requests"] for row in rows)
+        return {
+            "seconds": round(elapsed, 2),
+            "requests": total,
+            "errors": sum(row["errors"] for row in rows),
+            "rps": round(total / elapsed, 2),
+            "endpoints": rows,
+        }
+
+
+class PlayerSession:
+    """HTTP-сессия одного игрока: keep-alive соединение, cookies и CSRF."""
+
+    def __init__(self, base_url, stats, timeout=30):
+        parts = urlsplit(base_url)
+        self.connection_class = (
+            http.client.HTTPSConnection
+            if parts.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        self.netloc = parts.netloc
+        self.origin = f"{parts.scheme}://{parts.netloc}"
+        self.stats = stats
+        self.timeout = timeout
+        self.cookies = {}
+        self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def request(self, endpoint, method, path, body=None, form=False, record=True):
+        """
+        Выполняет запрос и возвращает (статус, разобранный JSON или None).
+        ``endpoint`` - имя для статистики (путь без конкретных ID).
+        """
+        headers = {"Accept": "application/json"}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        if method not in ("GET", "HEAD"):
+            headers["X-CSRFToken"] = self.cookies.get("csrftoken", "")
+            headers["Referer"] = self.origin + path
+        if body is not None:
+            if form:
+                body = urlencode(body)
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+            else:
+                body = json.dumps(body)
+                headers["Content-Type"] = "application/json"
+
+        start = time.perf_counter()
+        try:
+            if self.connection is None:
+                self.connection = self.connection_class(
+                    self.netloc, timeout=self.timeout
+                )
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            content = response.read()
+        except (OSError, http.client.HTTPException):
+            # Сервер закрыл соединение или не ответил: переподключимся
+            self.close()
+            if record:
+                self.stats.record(endpoint, time.perf_counter() - start, ok=False)
+            return None, None
+        elapsed = time.perf_counter() - start
+
+        for header in response.headers.get_all("Set-Cookie") or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+        if record:
+            self.stats.record(endpoint, elapsed, ok=response.status < 400)
+
+        data = None
+        if content and "json" in response.getheader("Content-Type", ""):
+            data = json.loads(content)
+        return response.status, data
+
+    def login(self, username, password):
+        # GET выдает cookie csrftoken, без которого POST формы отклоняется
+        self.request("login", "GET", LOGIN_PATH, record=False)
+        status, _ = self.request(
+            "login",
+            "POST",
+            LOGIN_PATH,
+            body={
+                "username": username,
+                "password": password,
+                "csrfmiddlewaretoken": self.cookies.get("csrftoken", ""),
+                "next": f"{API}/",
+            },
+            form=True,
+            record=False,
+        )
+        if status != 302 or "sessionid" not in self.cookies:
+            raise RuntimeError(f"Login failed for {username} (HTTP {status})")
+
+
+# --- Сценарии ---
+
+
+def browse(session, player, manifest, rnd):
+    system = manifest["system"]
+    session.request("GET /systems/", "GET", f"{API}/systems/")
+    session.request("GET /systems/{id}/", "GET", f"{API}/systems/{system['id']}/")
+    category = rnd.choice(system["categories"])
+    session.request(
+        "GET /systems/{id}/traits/",
+        "GET",
+        f"{API}/systems/{system['id']}/traits/?{urlencode({'category': category})}",
+    )
+    page = rnd.randint(1, system["feature_pages"])
+    session.request("GET /features/", "GET", f"{API}/features/?page={page}")
+    page = rnd.randint(1, system["equipment_pages"])
+    session.request(
+        "GET /equipment-templates/", "GET", f"{API}/equipment-templates/?page={page}"
+    )
+
+
+def poll(session, player, manifest, rnd):
+    sheet = rnd.choice(player["sheets"])
+    session.request("GET /sheets/{id}/", "GET", f"{API}/sheets/{sheet}/")
+
+
+def patch(session, player, manifest, rnd):
+    sheet = rnd.choice(player["sheets"])
+    for _ in range(PATCH_BURST):
+        session.request(
+            "PATCH /sheets/{id}/",
+            "PATCH",
+            f"{API}/sheets/{sheet}/",
+            body={"stats": {"level": rnd.randint(1, 10)}},
+        )
+
+
+def gm(session, player, manifest, rnd):
+    _, page = session.request("GET /sheets/", "GET", f"{API}/sheets/")
+    for sheet in (page or {}).get("results", []):
+        session.request("GET /sheets/{id}/", "GET", f"{API}/sheets/{sheet['id']}/")
+
+
+SCENARIOS = {"browse": browse, "poll": poll, "patch": patch, "gm": gm}
+
+
+def parse_mix(value):
+    """'browse=3,poll=5' -> {'browse': 3, 'poll': 5}"""
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown scenario: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def run_player(base_url, player, manifest, stats, mix, deadline, think_time, seed):
+    rnd = random.Random(seed)
+    session = PlayerSession(base_url, stats)
+    try:
+        session.login(player["username"], manifest["password"])
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        while time.monotonic() < deadline:
+            scenario = rnd.choices(names, weights)[0]
+            SCENARIOS[scenario](session, player, manifest, rnd)
+            if think_time:
+                time.sleep(rnd.uniform(0, 2 * think_time))
+    finally:
+        session.close()
+
+
+def run(base_url, manifest, concurrency, duration, mix=None, think_time=1.0, seed=0):
+    """
+    Запускает ``concurrency`` игроков на ``duration`` секунд
+    и возвращает сводку (см. ``LatencyStats.summary``).
+    """
+    stats = LatencyStats()
+    players = manifest["players"]
+    failures = []
+
+    def target(index):
+        try:
+            run_player(
+                base_url,
+                players[index % len(players)],
+                manifest,
+                stats,
+                mix or DEFAULT_MIX,
+                deadline,
+                think_time,
+                seed + index,
+            )
+        except RuntimeError as e:
+            failures.append(str(e))
+
+    start = time.monotonic()
+    deadline = start + duration
+    threads = [
+        threading.Thread(target=target, args=(index,), daemon=True)
+        for index in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summary = stats.summary(time.monotonic() - start)
+    summary["concurrency"] = concurrency
+    summary["login_failures"] = failures
+    return summary
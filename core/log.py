@@ -0,0 +1,54 @@
+"""
+Фильтры и форматтеры для настройки LOGGING (см. settings.py).
+
+Трассировка движка правил пишется на уровне DEBUG и в продакшене по умолчанию
+выключена уровнем логгера: сообщения даже не форматируются. Если ее включить
+на нагруженном сервере, ``SamplingFilter`` пропустит только часть записей.
+"""
+
+import json
+import logging
+import random
+
+# Атрибуты, которые есть у любой LogRecord; все остальное пришло через extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает долю ``rate`` (от 0 до 1) записей ниже уровня ``min_level``.
+    Предупреждения и ошибки проходят всегда.
+    """
+
+    def __init__(self, rate=1.0, min_level=logging.WARNING):
+        super().__init__()
+        self.rate = float(rate)
+        if isinstance(min_level, str):
+            min_level = logging.getLevelName(min_level)
+        self.min_level = min_level
+
+    def filter(self, record):
+        if record.levelno >= self.min_level or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна JSON-строка на запись: время, уровень, логгер, сообщение
+    и поля, переданные через ``extra=`` (stat, formula, character_id...).
+    """
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str, ensure_ascii=False)
@@ -0,0 +1,80 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.loader.loader import DEFAULT_BATCH_SIZE, SystemLoader
+from core.loader.records import iter_seed_records
+from core.profiling import measure
+
+
+class RollbackBenchmark(Exception):
+    """Откатывает транзакцию бенчмарка, чтобы не оставлять данные в БД."""
+
+
+class Command(BaseCommand):
+    help = (
+        "Loads a seed file and reports load time, SQL statement count and "
+        "memory growth. Changes are rolled back unless --keep is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("seed_file", type=str, help="JSON or NDJSON seed to load.")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            "--reload",
+            action="store_true",
+            help="Also measure a second, incremental load of the same seed.",
+        )
+        parser.add_argument(
+            "--trace-memory",
+            action="store_true",
+            help="Measure the exact Python heap peak with tracemalloc (slower).",
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="Commit the loaded data."
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Print results as JSON."
+        )
+
+    def handle(self, *args, **options):
+        seed_file = options["seed_file"]
+        if not os.path.isfile(seed_file):
+            raise CommandError(f"File not found at: {seed_file}")
+
+        def run_load():
+            loader = SystemLoader(batch_size=options["batch_size"])
+            return loader.load(iter_seed_records(seed_file))
+
+        results = []
+        try:
+            with transaction.atomic():
+                _, metrics = measure(run_load, trace_memory=options["trace_memory"])
+                results.append({"run": "initial load", **metrics})
+                if options["reload"]:
+                    # Без seed_hash загрузчик сравнивает все записи по хэшам
+                    _, metrics = measure(run_load, trace_memory=options["trace_memory"])
+                    results.append({"run": "incremental reload", **metrics})
+                if not options["keep"]:
+                    raise RollbackBenchmark()
+        except RollbackBenchmark:
+            pass
+
+        if options["json"]:
+            self.stdout.write(
+                json.dumps({"seed": seed_file, "runs": results}, indent=2)
+            )
+            return
+
+        for result in results:
+            line = (
+                f"{result['run']}: {result['seconds']:.3f}s, "
+                f"{result['queries']} queries ({result['sql_seconds']:.3f}s in SQL), "
+                f"RSS peak +{result['rss_growth_mb']} MB "
+                f"(process peak {result['process_peak_rss_mb']} MB)"
+            )
+            if "peak_traced_mb" in result:
+                line += f", Python heap peak {result['peak_traced_mb']} MB"
+            self.stdout.write(line)
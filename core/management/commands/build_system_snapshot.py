@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.engine.snapshot import SystemSnapshot, build_snapshot, snapshot_path
+from core.models import GameSystem
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds versioned binary snapshots of compiled rules and catalog data "
+        "that workers memory-map instead of rebuilding them from the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "slugs",
+            nargs="*",
+            type=str,
+            help="Slugs of the game systems to build. Defaults to all systems.",
+        )
+        parser.add_argument(
+            "--output-dir",
+            type=str,
+            default=None,
+            help="Where to write snapshots. Defaults to settings.RULES_SNAPSHOT_DIR.",
+        )
+
+    def handle(self, *args, **options):
+        output_dir = options["output_dir"] or settings.RULES_SNAPSHOT_DIR
+        if not output_dir:
+            raise CommandError("RULES_SNAPSHOT_DIR is not configured")
+
+        systems = GameSystem.objects.all()
+        if options["slugs"]:
+            systems = systems.filter(slug__in=options["slugs"])
+            missing = set(options["slugs"]) - set(
+                systems.values_list("slug", flat=True)
+            )
+            if missing:
+                raise CommandError(
+                    f"Unknown game systems: {', '.join(sorted(missing))}"
+                )
+
+        for system in systems:
+            path = snapshot_path(output_dir, system.slug)
+            build_snapshot(system, path)
+            # Сразу проверяем, что файл читается
+            snapshot = SystemSnapshot(path)
+            self.stdout.write(
+                f"{system.name}: rules version {system.rules_version}, "
+                f"{len(snapshot.formulas)} formulas -> {path}"
+            )
+            snapshot.close()
+
+        self.stdout.write(self.style.SUCCESS("Snapshots are ready."))
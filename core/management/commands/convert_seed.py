@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.loader.records import (
+    SeedFormatError,
+    is_ndjson,
+    iter_legacy_records,
+    write_ndjson_records,
+)
+
+
+class Command(BaseCommand):
+    help = "Converts a single-document JSON seed into the streaming NDJSON format"
+
+    def add_arguments(self, parser):
+        parser.add_argument("json_file", type=str, help="The JSON seed to convert.")
+        parser.add_argument(
+            "output",
+            type=str,
+            nargs="?",
+            help="Where to write the NDJSON seed. Defaults to <json_file>.ndjson.",
+        )
+
+    def handle(self, *args, **options):
+        json_file_path = options["json_file"]
+        output_path = (
+            options["output"] or os.path.splitext(json_file_path)[0] + ".ndjson"
+        )
+
+        if not os.path.isfile(json_file_path):
+            raise CommandError(f"File not found at: {json_file_path}")
+        if is_ndjson(json_file_path):
+            raise CommandError(f"{json_file_path} is already an NDJSON seed")
+
+        try:
+            with open(output_path, "w", encoding="utf-8") as out:
+                count = write_ndjson_records(iter_legacy_records(json_file_path), out)
+        except SeedFormatError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} records to {output_path}"))
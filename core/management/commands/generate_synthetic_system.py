@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from core.loader.records import write_ndjson_records
+from core.loader.synthetic import generate_system_records
+
+
+class Command(BaseCommand):
+    help = "Generates an NDJSON seed for a synthetic game system of configurable size"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", type=str, help="Where to write the NDJSON seed.")
+        parser.add_argument("--slug", type=str, default="synthetic")
+        parser.add_argument("--features", type=int, default=50000)
+        parser.add_argument("--traits", type=int, default=10000)
+        parser.add_argument(
+            "--trait-depth",
+            type=int,
+            default=5,
+            help="Length of parent chains between traits (class -> subclass -> ...).",
+        )
+        parser.add_argument("--equipment", type=int, default=5000)
+        parser.add_argument(
+            "--formulas", type=int, default=100, help="Number of computed stats."
+        )
+        parser.add_argument("--feature-sets", type=int, default=200)
+        parser.add_argument("--categories", type=int, default=8)
+        parser.add_argument("--features-per-trait", type=int, default=3)
+        parser.add_argument(
+            "--seed", type=int, default=0, help="Random seed for reproducible output."
+        )
+
+    def handle(self, *args, **options):
+        records = generate_system_records(
+            slug=options["slug"],
+            features=options["features"],
+            traits=options["traits"],
+            trait_depth=options["trait_depth"],
+            equipment=options["equipment"],
+            formulas=options["formulas"],
+            feature_sets=options["feature_sets"],
+            categories=options["categories"],
+            features_per_trait=options["features_per_trait"],
+            seed=options["seed"],
+        )
+        with open(options["output"], "w", encoding="utf-8") as out:
+            count = write_ndjson_records(records, out)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Wrote {count} records to {options['output']}")
+        )
@@ -1,170 +1,258 @@
-import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
-
-# Импортируем все наши модели из core
-from core.models import (
-    GameSystem,
-    TraitCategory,
-    DamageType,
-    FeatureSet,
-    Feature,
-    CharacterTrait,
-    EquipmentTemplate,
+from django.db import connections, transaction
+
+from core.loader.loader import DEFAULT_BATCH_SIZE, SystemLoader
+from core.metrics import observe_load
+from core.loader.records import (
+    NDJSON_EXTENSIONS,
+    SeedFormatError,
+    file_hash,
+    iter_seed_records,
 )
 
+SEED_EXTENSIONS = (".json",) + NDJSON_EXTENSIONS
+
+
+def load_seed_file(path, options):
+    """
+    Загружает один сид-файл в собственной транзакции.
+    Никогда не бросает исключений: ошибка возвращается в результате,
+    чтобы сбой одной системы не прерывал загрузку остальных.
+    """
+    result = {
+        "path": path,
+        "ok": False,
+        "log": [],
+        "recalculated": 0,
+        "documents": 0,
+    }
+    start = time.perf_counter()
+
+    # Импортируем здесь: приложение characters зависит от core, а не наоборот
+    from characters.services import CharacterStateService, SheetDocumentService
+
+    affected_sheet_ids = set()
+    stale_document_ids = set()
+    rebuilt = {}
+    state_service = CharacterStateService() if options["recalculate"] else None
+    document_service = SheetDocumentService()
+
+    def collect_affected(report):
+        stale_document_ids.update(document_service.sheets_affected_by_load(report))
+        if state_service:
+            affected_sheet_ids.update(
+                state_service.sheets_affected_by_catalog_changes(report)
+            )
+
+    # Файл читается потоком прямо во время загрузки, поэтому ошибки формата
+    # могут возникнуть уже внутри транзакции.
+    loader = SystemLoader(
+        batch_size=options["batch_size"],
+        log=result["log"].append,
+        force=options["force"],
+        prune=options["prune"],
+        on_prune=collect_affected,
+    )
+
+    # Используем transaction.atomic, чтобы все операции были выполнены как одна.
+    # Если где-то произойдет ошибка, все изменения откатятся.
+    try:
+        with transaction.atomic():
+            report = loader.load(iter_seed_records(path), seed_hash=file_hash(path))
+            if report.has_changes:
+                collect_affected(report)
+                if state_service:
+                    state_service.recalculate_sheets(affected_sheet_ids)
+                # Документы листов перестраиваются в той же транзакции
+                rebuilt.update(
+                    document_service.rebuild(stale_document_ids | affected_sheet_ids)
+                )
+    except SeedFormatError as e:
+        result["error"] = str(e)
+    except Exception as e:
+        result["error"] = f"An error occurred during data loading: {e}"
+    else:
+        result["ok"] = True
+        result["log"].extend(report.summary())
+        result["recalculated"] = len(affected_sheet_ids)
+        result["documents"] = len(rebuilt)
+
+    result["seconds"] = time.perf_counter() - start
+    observe_load(result, loader.report)
+    return result
+
+
+def load_seed_group(paths, options):
+    """
+    Точка входа процесса-воркера: последовательно загружает файлы одной
+    системы. Каждый воркер открывает собственное подключение к БД.
+    """
+    if not apps.ready:
+        # Процесс запущен не через fork - настраиваем Django заново
+        django.setup()
+    try:
+        return [load_seed_file(path, options) for path in paths]
+    finally:
+        connections.close_all()
+
+
+def peek_system_slug(path):
+    """Читает только первую запись сида, чтобы узнать, какую систему он описывает."""
+    try:
+        return next(iter_seed_records(path)).get("slug")
+    except (SeedFormatError, StopIteration, AttributeError):
+        return None
+
 
 class Command(BaseCommand):
-    help = "Loads data for a new game system from a JSON file"
+    help = (
+        "Loads data for game systems from JSON files or streaming NDJSON "
+        "(.ndjson/.jsonl) seeds. Accepts several files or directories and loads "
+        "different systems in parallel. Only rows whose content changed since "
+        "the last load are written."
+    )
 
     def add_arguments(self, parser):
-        # Мы определяем один обязательный аргумент - путь к файлу
         parser.add_argument(
-            "json_file", type=str, help="The path to the JSON file to load."
+            "json_files",
+            nargs="+",
+            type=str,
+            help="Seed files or directories with seed files to load.",
         )
-
-    def handle(self, *args, **options):
-        # Получаем путь к файлу из аргументов
-        json_file_path = options["json_file"]
-        self.stdout.write(self.style.SUCCESS(f"Processing {json_file_path}..."))
-
-        try:
-            with open(json_file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            raise CommandError(f"File not found at: {json_file_path}")
-        except json.JSONDecodeError:
-            raise CommandError(f"Error decoding JSON from: {json_file_path}")
-
-        # Используем transaction.atomic, чтобы все операции были выполнены как одна.
-        # Если где-то произойдет ошибка, все изменения откатятся.
-        try:
-            with transaction.atomic():
-                self.load_data(data)
-        except Exception as e:
-            raise CommandError(f"An error occurred during data loading: {e}")
-
-        self.stdout.write(self.style.SUCCESS("Successfully loaded all data!"))
-
-    def load_data(self, data):
-        # --- 1. Создаем или получаем GameSystem ---
-        system_data = data.get("system")
-        system, created = GameSystem.objects.get_or_create(
-            slug=system_data["slug"],
-            defaults={"name": system_data["name"], "version": system_data["version"]},
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help=(
+                "How many systems to load at once. "
+                "Defaults to the number of CPUs, but no more than the number of systems."
+            ),
         )
-        self.stdout.write(
-            f'{"Created" if created else "Found"} Game System: {system.name}'
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="How many records of one type are written to the database at once.",
         )
-
-        # --- 2. Создаем категории, типы урона, наборы фич ---
-        # Мы используем bulk_create для эффективности.
-        # ignore_conflicts=True значит, что если запись уже существует, она будет проигнорирована.
-        TraitCategory.objects.bulk_create(
-            [
-                TraitCategory(name=cat_name, system=system)
-                for cat_name in data.get("trait_categories", [])
-            ],
-            ignore_conflicts=True,
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rewrite every row even if its content hash did not change.",
         )
-        DamageType.objects.bulk_create(
-            [
-                DamageType(name=dt_name, system=system)
-                for dt_name in data.get("damage_types", [])
-            ],
-            ignore_conflicts=True,
+        parser.add_argument(
+            "--prune",
+            action="store_true",
+            help=(
+                "Delete catalog rows that are no longer present in the seed. "
+                "Deleting equipment templates also deletes characters' items."
+            ),
         )
-        FeatureSet.objects.bulk_create(
-            [
-                FeatureSet(name=fs["name"], set_type=fs["set_type"], system=system)
-                for fs in data.get("feature_sets", [])
-            ],
-            ignore_conflicts=True,
+        parser.add_argument(
+            "--recalculate",
+            action="store_true",
+            help="Recalculate character sheets affected by the changed rows.",
         )
-        self.stdout.write("Loaded Trait Categories, Damage Types, and Feature Sets.")
-
-        equipment_templates_data = data.get("equipment_templates", [])
-        equipment_templates_to_create = []
-        for eq_data in equipment_templates_data:
-            equipment_templates_to_create.append(
-                EquipmentTemplate(
-                    name=eq_data["name"],
-                    system=system,
-                    description=eq_data.get("description", ""),
-                    metadata=eq_data.get("metadata", {}),
-                )
-            )
 
-        EquipmentTemplate.objects.bulk_create(
-            equipment_templates_to_create, ignore_conflicts=True
-        )
-        self.stdout.write(
-            f"Loaded {len(equipment_templates_to_create)} Equipment Templates."
-        )
+    def handle(self, *args, **options):
+        paths = self.collect_paths(options["json_files"])
 
-        # --- 3. Создаем Features (без связей) ---
-        # Мы не можем использовать bulk_create здесь, так как нам нужно будет связывать их.
-        # Вместо этого, будем создавать их по одному, проверяя существование.
-        feature_map = {}
-        for feature_data in data.get("features", []):
-            feature, created = Feature.objects.get_or_create(
-                name=feature_data["name"],
-                system=system,
-                defaults={
-                    "description": feature_data.get("description", ""),
-                    "metadata": feature_data.get("metadata", {}),
-                },
-            )
-            feature_map[feature.name] = feature  # Сохраняем для будущих связей
+        # Файлы одной системы загружаются строго по порядку в одном воркере,
+        # разные системы независимы и загружаются параллельно.
+        groups = {}
+        for path in paths:
+            slug = peek_system_slug(path)
+            groups.setdefault(slug or path, []).append(path)
 
-        self.stdout.write("Loaded Features.")
+        workers = options["workers"] or os.cpu_count() or 1
+        workers = max(1, min(workers, len(groups)))
+        load_options = {
+            key: options[key] for key in ("batch_size", "force", "prune", "recalculate")
+        }
 
-        # --- 4. Создаем Character Traits (без связей) ---
-        trait_map = {}
-        for trait_data in data.get("character_traits", []):
-            # Находим категорию по имени
-            category = TraitCategory.objects.get(
-                name=trait_data["category"], system=system
-            )
-            trait, created = CharacterTrait.objects.get_or_create(
-                name=trait_data["name"],
-                system=system,
-                category=category,
-                defaults={
-                    "description": trait_data.get("description", ""),
-                    "metadata": trait_data.get("metadata", {}),
-                },
+        results = {}
+        if workers == 1:
+            for group in groups.values():
+                for path in group:
+                    self.stdout.write(self.style.SUCCESS(f"Processing {path}..."))
+                    results[path] = load_seed_file(path, load_options)
+                    self.write_result(results[path])
+        else:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Processing {len(paths)} seeds for {len(groups)} systems "
+                    f"with {workers} workers..."
+                )
             )
-            trait_map[trait.name] = trait
-
-        self.stdout.write("Loaded Character Traits.")
+            # Дочерние процессы не должны наследовать открытые подключения
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(load_seed_group, group, load_options): group
+                    for group in groups.values()
+                }
+                for future in as_completed(futures):
+                    try:
+                        group_results = future.result()
+                    except Exception as e:
+                        # Упал сам процесс-воркер
+                        group_results = [
+                            {"path": path, "ok": False, "log": [], "error": str(e)}
+                            for path in futures[future]
+                        ]
+                    for result in group_results:
+                        results[result["path"]] = result
+                        self.write_result(result)
 
-        # --- 5. Устанавливаем связи (второй проход) ---
-        # Теперь, когда все объекты созданы, мы можем установить связи ManyToMany и ForeignKey
+        self.write_report([results[path] for path in paths])
 
-        # Связи для Features -> FeatureSet
-        for feature_data in data.get("features", []):
-            if feature_data.get("feature_set"):
-                feature = feature_map[feature_data["name"]]
-                feature_set = FeatureSet.objects.get(
-                    name=feature_data["feature_set"], system=system
+    def collect_paths(self, inputs):
+        paths = []
+        for item in inputs:
+            if os.path.isdir(item):
+                paths.extend(
+                    os.path.join(item, name)
+                    for name in sorted(os.listdir(item))
+                    if os.path.splitext(name)[1].lower() in SEED_EXTENSIONS
                 )
-                feature.feature_set = feature_set
-                feature.save()
-
-        # Связи для Character Traits -> Parent и Features
-        for trait_data in data.get("character_traits", []):
-            trait = trait_map[trait_data["name"]]
+            elif os.path.isfile(item):
+                paths.append(item)
+            else:
+                raise CommandError(f"File not found at: {item}")
+        if not paths:
+            raise CommandError("No seed files found")
+        return paths
 
-            # Связь с родителем (для подклассов)
-            if trait_data.get("parent"):
-                parent_trait = trait_map[trait_data["parent"]]
-                trait.parent = parent_trait
-                trait.save()
+    def write_result(self, result):
+        for line in result["log"]:
+            self.stdout.write(line)
+        if not result["ok"]:
+            self.stderr.write(f"{result['path']}: {result['error']}")
+            return
+        if result.get("recalculated"):
+            self.stdout.write(
+                f"Recalculated {result['recalculated']} character sheets."
+            )
+        if result.get("documents"):
+            self.stdout.write(f"Rebuilt {result['documents']} sheet documents.")
 
-            # Связь с особенностями (ManyToMany)
-            feature_names = trait_data.get("features", [])
-            features_to_add = [feature_map[name] for name in feature_names]
-            trait.features.set(features_to_add)
+    def write_report(self, results):
+        failed = [result for result in results if not result["ok"]]
+        if len(results) > 1:
+            self.stdout.write("Summary:")
+            for result in results:
+                status = "OK" if result["ok"] else "FAILED"
+                seconds = result.get("seconds")
+                timing = f" ({seconds:.2f}s)" if seconds is not None else ""
+                self.stdout.write(f"  {status:<6} {result['path']}{timing}")
 
-        self.stdout.write("Established all relationships.")
+        if failed:
+            if len(results) == 1:
+                raise CommandError(failed[0]["error"])
+            raise CommandError(f"{len(failed)} of {len(results)} seeds failed to load")
+        self.stdout.write(self.style.SUCCESS("Successfully loaded all data!"))
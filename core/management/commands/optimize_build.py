@@ -0,0 +1,94 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.engine import optimizer
+from core.models import GameSystem
+
+
+def stat_assignment(value):
+    name, _, number = value.partition("=")
+    try:
+        return name.strip(), int(number)
+    except ValueError:
+        raise CommandError(f"Expected name=value, got {value!r}")
+
+
+class Command(BaseCommand):
+    help = (
+        "Searches trait and equipment combinations of a game system for the "
+        "top builds by a computed stat, without creating sheets."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("system", type=str, help="Game system slug.")
+        parser.add_argument("target", type=str, help="Computed stat to optimize.")
+        parser.add_argument("--direction", choices=optimizer.DIRECTIONS, default="max")
+        parser.add_argument("--top", type=int, default=5)
+        parser.add_argument(
+            "--stat",
+            action="append",
+            default=[],
+            type=stat_assignment,
+            help="Plain stat value for formulas, e.g. --stat level=5 (repeatable).",
+        )
+        parser.add_argument(
+            "--trait",
+            action="append",
+            default=[],
+            type=int,
+            help="Trait ID to keep fixed (repeatable).",
+        )
+        parser.add_argument(
+            "--equipment",
+            action="append",
+            default=[],
+            type=int,
+            help="Equipment template ID to keep fixed (repeatable).",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Processes to search in parallel.",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Print the result as JSON."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            system = GameSystem.objects.get(slug=options["system"])
+        except GameSystem.DoesNotExist:
+            raise CommandError(f"Unknown game system: {options['system']}")
+
+        catalog = optimizer.get_catalog(system)
+        try:
+            problem = optimizer.Problem(
+                catalog,
+                options["target"],
+                direction=options["direction"],
+                stats=dict(options["stat"]),
+                traits=options["trait"],
+                equipment=options["equipment"],
+            )
+        except optimizer.OptimizerError as e:
+            raise CommandError(str(e))
+        result = optimizer.optimize(
+            problem, catalog, top=options["top"], workers=options["workers"]
+        )
+
+        if options["json"]:
+            self.stdout.write(json.dumps(result, indent=2, ensure_ascii=False))
+            return
+        self.stdout.write(
+            f"{result['direction']} {result['target']}: "
+            f"{result['candidates']} combinations, {result['evaluated']} evaluated "
+            f"in {result['seconds']}s"
+        )
+        for rank, build in enumerate(result["builds"], 1):
+            choices = [
+                f"{trait['category']}={trait['name']}" for trait in build["traits"]
+            ] + [f"{item['location']}={item['name']}" for item in build["equipment"]]
+            self.stdout.write(f"{rank:>3}. {build['value']:>6}  {', '.join(choices)}")
@@ -0,0 +1,106 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.benchmarks import SCENARIOS, compare, run_suite
+
+
+class RollbackBenchmark(Exception):
+    """Откатывает транзакцию бенчмарка, чтобы не оставлять данные в БД."""
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the performance benchmark suite (rule engine, recalculation, "
+        "serialization, catalog endpoints, seed loading) on generated data that "
+        "is rolled back afterwards, and optionally compares it with a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            choices=SCENARIOS,
+            help="Scenario to run; repeat for several. Default: all.",
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=20, help="Timed runs per benchmark."
+        )
+        parser.add_argument(
+            "--scale",
+            type=float,
+            default=1.0,
+            help="Multiplier for the size of the generated game system.",
+        )
+        parser.add_argument("--output", type=str, help="Write results as JSON here.")
+        parser.add_argument(
+            "--save-baseline",
+            type=str,
+            metavar="PATH",
+            help="Write results as the new baseline to PATH.",
+        )
+        parser.add_argument(
+            "--baseline",
+            type=str,
+            metavar="PATH",
+            help="Compare with a baseline and fail on regressions.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Allowed relative slowdown of the median (default 0.2 = 20%%).",
+        )
+        parser.add_argument(
+            "--json", action="store_true", help="Print results as JSON."
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            try:
+                with open(options["baseline"], encoding="utf-8") as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Cannot read baseline: {e}")
+
+        try:
+            with transaction.atomic():
+                results = run_suite(
+                    scenarios=options["scenario"] or SCENARIOS,
+                    repeat=options["repeat"],
+                    scale=options["scale"],
+                )
+                raise RollbackBenchmark()
+        except RollbackBenchmark:
+            pass
+
+        for path in (options["output"], options["save_baseline"]):
+            if path:
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(results, f, indent=2)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            for result in results["results"]:
+                self.stdout.write(
+                    f"{result['name']:<28} median {result['median_ms']:>10.3f}ms  "
+                    f"p95 {result['p95_ms']:>10.3f}ms  "
+                    f"{result['queries']:g} queries"
+                )
+
+        if baseline is None:
+            return
+        if baseline["meta"].get("database") != results["meta"]["database"]:
+            self.stderr.write(
+                f"Baseline was recorded on {baseline['meta'].get('database')}, "
+                f"this run uses {results['meta']['database']}."
+            )
+        regressions = compare(results, baseline, tolerance=options["tolerance"])
+        if regressions:
+            for name, description in regressions:
+                self.stderr.write(f"REGRESSION {name}: {description}")
+            raise CommandError(f"{len(regressions)} performance regressions.")
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline."))
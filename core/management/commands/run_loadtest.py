@@ -0,0 +1,91 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import loadtest
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulates concurrent players against a running server using a manifest "
+        "from provision_loadtest and reports throughput and p50/p95/p99 latency "
+        "per endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "manifest", type=str, help="Manifest written by provision_loadtest."
+        )
+        parser.add_argument("--url", type=str, default="http://127.0.0.1:8000")
+        parser.add_argument(
+            "--concurrency", type=int, default=20, help="Simultaneous players."
+        )
+        parser.add_argument(
+            "--duration", type=float, default=60, help="Test length in seconds."
+        )
+        parser.add_argument(
+            "--mix",
+            type=str,
+            default=",".join(f"{k}={v}" for k, v in loadtest.DEFAULT_MIX.items()),
+            help="Scenario weights, e.g. browse=3,poll=5,patch=1,gm=1.",
+        )
+        parser.add_argument(
+            "--think-time",
+            type=float,
+            default=1.0,
+            help="Mean pause between a player's scenarios, in seconds (0 = none).",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", type=str, help="Write the report as JSON.")
+        parser.add_argument(
+            "--json", action="store_true", help="Print the report as JSON."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["manifest"], encoding="utf-8") as f:
+                manifest = json.load(f)
+            mix = loadtest.parse_mix(options["mix"])
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+
+        report = loadtest.run(
+            options["url"],
+            manifest,
+            concurrency=options["concurrency"],
+            duration=options["duration"],
+            mix=mix,
+            think_time=options["think_time"],
+            seed=options["seed"],
+        )
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_report(report)
+
+        if report["login_failures"]:
+            raise CommandError(
+                f"{len(report['login_failures'])} players could not log in: "
+                f"{report['login_failures'][0]}"
+            )
+
+    def write_report(self, report):
+        self.stdout.write(
+            f"{report['concurrency']} players, {report['seconds']}s: "
+            f"{report['requests']} requests ({report['rps']} req/s), "
+            f"{report['errors']} errors"
+        )
+        self.stdout.write(
+            f"{'endpoint':<28}{'requests':>9}{'errors':>8}{'req/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        )
+        for row in report["endpoints"]:
+            self.stdout.write(
+                f"{row['endpoint']:<28}{row['requests']:>9}{row['errors']:>8}"
+                f"{row['rps']:>9}{row['p50_ms']:>9}{row['p95_ms']:>9}"
+                f"{row['p99_ms']:>9}"
+            )
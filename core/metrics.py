@@ -0,0 +1,130 @@
+"""
+Метрики в формате Prometheus.
+
+В продакшене несколько воркеров gunicorn пишут метрики в общий каталог
+``PROMETHEUS_MULTIPROC_DIR`` (переменная окружения должна быть задана до
+старта процессов), а эндпоинт ``/metrics/`` собирает их со всех воркеров.
+Без этой переменной отдаются метрики только текущего процесса.
+"""
+
+import hmac
+import os
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_GET
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Короткие запросы API: основная масса укладывается в десятки миллисекунд
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Вычисление одной формулы - микросекунды
+EVALUATION_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.05)
+
+# --- API ---
+
+REQUEST_LATENCY = Histogram(
+    "ttrpg_http_request_duration_seconds",
+    "Request latency by view and DRF action",
+    ["view", "action", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "ttrpg_http_requests_total",
+    "Requests by view, DRF action and status class",
+    ["view", "action", "method", "status"],
+)
+
+# --- Движок правил ---
+
+RULE_EVALUATIONS = Counter(
+    "ttrpg_rule_evaluations_total",
+    "Formula evaluations by system, computed stat and outcome",
+    ["system", "stat", "outcome"],
+)
+RULE_EVALUATION_DURATION = Histogram(
+    "ttrpg_rule_evaluation_duration_seconds",
+    "Formula evaluation time by system and computed stat",
+    ["system", "stat"],
+    buckets=EVALUATION_BUCKETS,
+)
+RECALCULATIONS = Counter(
+    "ttrpg_recalculations_total",
+    "Sheet recalculations: written, or skipped because stats did not change",
+    ["system", "result"],
+)
+
+# --- Кэши ---
+
+RULES_REGISTRY_LOOKUPS = Counter(
+    "ttrpg_rules_registry_lookups_total",
+    "Rules registry lookups: hit, or miss served from a snapshot or the database",
+    ["result"],
+)
+SHEET_DOCUMENT_READS = Counter(
+    "ttrpg_sheet_document_reads_total",
+    "Sheet reads served from a stored document (hit) or built on read (miss)",
+    ["result"],
+)
+
+# --- Загрузчик сидов ---
+
+LOADER_DURATION = Histogram(
+    "ttrpg_loader_duration_seconds",
+    "Seed load time by system and outcome",
+    ["system", "outcome"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+LOADER_ROWS = Counter(
+    "ttrpg_loader_rows_total",
+    "Catalog rows processed by the seed loader",
+    ["system", "type", "change"],
+)
+
+
+def observe_load(result, report):
+    """Записывает метрики одной загрузки сида (см. load_system_data)."""
+    system = report.system.slug if report.system else "unknown"
+    outcome = "ok" if result["ok"] else "failed"
+    if result["ok"] and report.skipped:
+        outcome = "skipped"
+    LOADER_DURATION.labels(system, outcome).observe(result["seconds"])
+    if not result["ok"]:
+        return
+    for record_type, stats in report.stats.items():
+        for change in ("created", "updated", "unchanged", "deleted"):
+            if stats[change]:
+                LOADER_ROWS.labels(system, record_type, change).inc(stats[change])
+
+
+def get_registry():
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+@never_cache
+@require_GET
+def metrics_view(request):
+    """
+    Текстовый формат Prometheus. Если задан METRICS_TOKEN, требуется
+    заголовок ``Authorization: Bearer <токен>``.
+    """
+    token = getattr(settings, "METRICS_TOKEN", "")
+    if token:
+        provided = request.META.get("HTTP_AUTHORIZATION", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(provided.encode(), token.encode()):
+            return HttpResponseForbidden()
+    return HttpResponse(
+        generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST
+    )
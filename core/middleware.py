@@ -0,0 +1,157 @@
+"""
+Измерение производительности каждого запроса.
+
+``PerformanceMiddleware`` считает SQL-запросы и их время, находит повторяющиеся
+запросы (N+1), собирает время этапов, отмеченных ``core.profiling.timed``
+(сериализация, пересчет статов, сборка документа листа), и отдает все это
+в заголовке ``Server-Timing`` - его показывают DevTools браузера.
+
+Если в запросе есть заголовок ``X-Profile`` со значением
+``settings.PERFORMANCE_PROFILE_TOKEN``, запрос дополнительно профилируется
+(pyinstrument, если установлен, иначе cProfile), а результат сохраняется
+в ``settings.PERFORMANCE_PROFILE_DIR``. Имя файла возвращается в ``X-Profile-File``.
+"""
+
+import cProfile
+import hmac
+import logging
+import os
+import re
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils import timezone
+
+from .metrics import REQUEST_LATENCY, REQUESTS
+from .profiling import QueryCounter, collect_timings, duplicate_queries
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # pragma: no cover - pyinstrument не обязателен
+    Profiler = None
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+
+
+def server_timing(metrics):
+    """Форматирует метрики [(имя, мс, описание)] для заголовка Server-Timing."""
+    parts = []
+    for name, milliseconds, description in metrics:
+        part = name
+        if description:
+            part += f';desc="{description}"'
+        if milliseconds is not None:
+            part += f";dur={milliseconds:.1f}"
+        parts.append(part)
+    return ", ".join(parts)
+
+
+class PerformanceMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, "PERFORMANCE_METRICS", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if self.profile_requested(request):
+            return self.profile(request)
+
+        start = time.perf_counter()
+        with QueryCounter(collect_sql=True) as queries, collect_timings() as timings:
+            response = self.get_response(request)
+        total = time.perf_counter() - start
+
+        duplicates, most_common = duplicate_queries(queries.statements)
+        if duplicates >= getattr(settings, "PERFORMANCE_DUPLICATE_QUERY_WARNING", 10):
+            logger.warning(
+                "%s %s: %d duplicate queries, most repeated (%d times): %s",
+                request.method,
+                request.path,
+                duplicates,
+                most_common[1],
+                most_common[0][:200],
+            )
+
+        metrics = [
+            ("sql", queries.duration * 1000, f"{queries.count} queries"),
+        ]
+        if duplicates:
+            metrics.append(("sqldup", None, f"{duplicates} duplicate queries"))
+        for name, seconds in timings.durations.items():
+            metrics.append((name, seconds * 1000, None))
+        metrics.append(("total", total * 1000, None))
+        response["Server-Timing"] = server_timing(metrics)
+        return response
+
+    def profile_requested(self, request):
+        expected = getattr(settings, "PERFORMANCE_PROFILE_TOKEN", "")
+        token = request.META.get(PROFILE_HEADER)
+        return bool(
+            expected
+            and token
+            and hmac.compare_digest(token.encode(), expected.encode())
+        )
+
+    def profile(self, request):
+        directory = getattr(settings, "PERFORMANCE_PROFILE_DIR", None)
+        os.makedirs(directory, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", request.path).strip("-") or "root"
+        name = f"{timezone.now():%Y%m%d-%H%M%S-%f}-{request.method}-{slug}"
+
+        if Profiler is not None:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.stop()
+            name += ".html"
+            with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+                f.write(profiler.output_html())
+        else:
+            profiler = cProfile.Profile()
+            try:
+                response = profiler.runcall(self.get_response, request)
+            finally:
+                name += ".prof"
+                profiler.dump_stats(os.path.join(directory, name))
+
+        logger.info("Saved profile of %s %s to %s", request.method, request.path, name)
+        response["X-Profile-File"] = name
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Гистограмма времени ответа и счетчик запросов по вью и действию DRF
+    (list, retrieve, create...) для Prometheus (см. ``core.metrics``).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        view, action = self.view_labels(request)
+        method = request.method
+        REQUEST_LATENCY.labels(view, action, method).observe(duration)
+        REQUESTS.labels(view, action, method, f"{response.status_code // 100}xx").inc()
+        return response
+
+    @staticmethod
+    def view_labels(request):
+        match = getattr(request, "resolver_match", None)
+        if match is None:
+            # Не нашлось маршрута: не плодим метки из произвольных URL
+            return "unresolved", ""
+        # У ViewSet'ов as_view() сохраняет соответствие "метод -> действие"
+        actions = getattr(match.func, "actions", None) or {}
+        return match.view_name or match._func_path, actions.get(
+            request.method.lower(), ""
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_content_hashes_and_system_metadata"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gamesystem",
+            name="catalog_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:58
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0003_gamesystem_catalog_version"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="traitcategory",
+            index=models.Index(
+                django.db.models.functions.text.Upper("name"),
+                models.F("system"),
+                name="core_traitcat_upper_name_idx",
+            ),
+        ),
+    ]
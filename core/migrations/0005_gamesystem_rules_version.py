@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_traitcategory_upper_name_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gamesystem",
+            name="rules_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.functions import Upper
 from django.contrib.auth.models import User
 
 # --- Фундаментальные модели ---
@@ -22,9 +23,40 @@ class GameSystem(models.Model):
         unique=True, help_text="Короткое имя для URL, например, 'daggerheart'"
     )
 
+    # RulebookSchema: формулы вычисляемых статов, действия, состояния и т.д.
+    metadata = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Правила системы (RulebookSchema), например, character_sheet_schema",
+    )
+
+    # Хэш всего сид-файла, из которого система загружена последний раз.
+    # Позволяет мгновенно пропускать повторную загрузку неизменного сида.
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    # Версия каталога: увеличивается при любом изменении правил, черт,
+    # особенностей или предметов системы. По ней воркеры понимают,
+    # что закэшированные в памяти индексы каталога устарели.
+    catalog_version = models.PositiveIntegerField(default=0, editable=False)
+    # Версия правил: только изменения того, что входит в снапшот правил
+    # (metadata системы, категории, черты со связями, шаблоны предметов).
+    # Правка особенности не должна выключать отображенный в память снапшот.
+    rules_version = models.PositiveIntegerField(default=0, editable=False)
+
     def __str__(self):
         return f"{self.name} {self.version}"
 
+    @classmethod
+    def bump_catalog_version(cls, system_id, rules=True):
+        """
+        Отмечает, что каталог системы изменился; ``rules=False`` - изменение
+        не затрагивает данные снапшота правил (например, правка особенности).
+        """
+        fields = {"catalog_version": models.F("catalog_version") + 1}
+        if rules:
+            fields["rules_version"] = models.F("rules_version") + 1
+        cls.objects.filter(pk=system_id).update(**fields)
+
 
 class FeatureSet(models.Model):
     """
@@ -41,6 +73,9 @@ class FeatureSet(models.Model):
         max_length=50, blank=True, help_text="Тип набора, например 'Domain'"
     )
 
+    # Хэш записи сида, из которой загружена строка (для инкрементальной перезагрузки)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+
     class Meta:
         unique_together = ("system", "name")
         verbose_name = "Feature Set"
@@ -82,6 +117,9 @@ class Feature(models.Model):
     # Системно-специфичные данные: требования, стоимость, ресурсы и т.д.
     metadata = models.JSONField(default=dict, blank=True)
 
+    # Хэш записи сида, из которой загружена строка (для инкрементальной перезагрузки)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+
     class Meta:
         pass
 
@@ -108,6 +146,12 @@ class TraitCategory(models.Model):
         # Имя категории должно быть уникальным в рамках одной игровой системы.
         # Не может быть двух категорий "Класс" для Daggerheart.
         unique_together = ("name", "system")
+        indexes = [
+            # Для поиска категории без учета регистра (name__iexact).
+            # Django строит такие условия через UPPER(), поэтому индекс
+            # функциональный по UPPER(name), а не LOWER(name).
+            models.Index(Upper("name"), "system", name="core_traitcat_upper_name_idx"),
+        ]
         # Для корректного отображения в админке
         verbose_name = "Trait Category"
         verbose_name_plural = "Trait Categories"
@@ -156,6 +200,9 @@ class CharacterTrait(models.Model):
         help_text="Системно-специфичные данные, например, hit_die для D&D или base_evasion для Daggerheart",
     )
 
+    # Хэш записи сида, из которой загружена строка (для инкрементальной перезагрузки)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+
     class Meta:
         unique_together = ("system", "category", "name")
         verbose_name = "Character Trait"
@@ -201,6 +248,9 @@ class EquipmentTemplate(models.Model):
     # Вместо жестких полей, у нас есть поле для всего
     metadata = models.JSONField(default=dict, blank=True)
 
+    # Хэш записи сида, из которой загружена строка (для инкрементальной перезагрузки)
+    content_hash = models.CharField(max_length=64, blank=True, editable=False)
+
     class Meta:
         unique_together = ("system", "name")
         verbose_name = "Equipment Template"
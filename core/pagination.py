@@ -0,0 +1,133 @@
+"""
+Пагинация для больших таблиц: вместо точного COUNT(*) по всей выборке
+используется оценка числа строк от планировщика PostgreSQL.
+
+Точное число строк считается, только пока оно не превышает порог
+(COUNT по выборке, ограниченной LIMIT, стоит не больше порога строк).
+Выше порога берется оценка: pg_class.reltuples для нефильтрованной
+таблицы или "Plan Rows" из EXPLAIN для отфильтрованной выборки.
+"""
+
+import json
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+
+# Ниже этого порога оценке не доверяем и считаем строки точно
+EXACT_COUNT_THRESHOLD = 10000
+
+
+def estimate_table_rows(model, using="default"):
+    """
+    Оценка числа строк таблицы модели из pg_class.reltuples.
+    Возвращает None, если БД не PostgreSQL или статистика еще не собрана.
+    """
+    connection = connections[using]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [connection.ops.quote_name(model._meta.db_table)],
+        )
+        row = cursor.fetchone()
+    # reltuples = -1 (PostgreSQL 14+) или 0, если таблицу еще не анализировали
+    if not row or row[0] is None or row[0] <= 0:
+        return None
+    return row[0]
+
+
+def estimate_query_rows(queryset):
+    """
+    Оценка числа строк выборки по плану запроса (EXPLAIN, без выполнения).
+    Возвращает None, если БД не PostgreSQL.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+        plan = cursor.fetchone()[0]
+    # psycopg обычно сам декодирует json, но на всякий случай
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator, который считает строки точно только до порога.
+    Для больших выборок ``count`` - оценка планировщика, а
+    ``count_is_estimate`` равен True. Оценка может расходиться с реальным
+    числом строк, поэтому последние страницы могут оказаться пустыми или,
+    наоборот, не попасть в ``num_pages``.
+    """
+
+    exact_count_threshold = EXACT_COUNT_THRESHOLD
+
+    def __init__(self, *args, exact_count_threshold=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if exact_count_threshold is not None:
+            self.exact_count_threshold = exact_count_threshold
+        self.count_is_estimate = False
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, "query", None)
+        if query is None:
+            return super().count
+
+        # Нефильтрованная таблица: статистика есть уже готовая
+        if not query.where and not query.distinct:
+            estimate = estimate_table_rows(queryset.model, queryset.db)
+            if estimate is not None and estimate > self.exact_count_threshold:
+                self.count_is_estimate = True
+                return estimate
+
+        # COUNT по выборке с LIMIT: не дороже порога строк
+        threshold = self.exact_count_threshold
+        bounded = queryset.order_by()[: threshold + 1].count()
+        if bounded <= threshold:
+            return bounded
+
+        estimate = estimate_query_rows(queryset)
+        if estimate is None:
+            # Оценить нечем (не PostgreSQL): считаем точно
+            return queryset.count()
+        self.count_is_estimate = True
+        # План может занизить оценку, но строк точно больше порога
+        return max(estimate, bounded)
+
+
+class EstimatedCountPagination(PageNumberPagination):
+    """
+    Пагинация API со счетчиком, который для больших выборок берется
+    из оценки планировщика. Поле ``count_is_estimate`` в ответе сообщает,
+    что ``count`` приблизительный.
+    """
+
+    django_paginator_class = EstimatedCountPaginator
+
+    def get_paginated_response(self, data):
+        return Response(
+            {
+                "count": self.page.paginator.count,
+                "count_is_estimate": self.page.paginator.count_is_estimate,
+                "next": self.get_next_link(),
+                "previous": self.get_previous_link(),
+                "results": data,
+            }
+        )
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count_is_estimate"] = {
+            "type": "boolean",
+            "example": False,
+        }
+        return response_schema
@@ -0,0 +1,198 @@
+"""
+Утилиты для измерения производительности: подсчет SQL-запросов и их времени.
+Работают без DEBUG=True, через ``connection.execute_wrapper``.
+"""
+
+import json
+import resource
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.db import connections
+
+
+class QueryCounter:
+    """
+    Контекстный менеджер, считающий SQL-запросы и суммарное время их выполнения
+    на всех (или только указанных) подключениях к БД.
+
+    Пример::
+
+        with QueryCounter() as queries:
+            do_something()
+        print(queries.count, queries.duration)
+    """
+
+    def __init__(self, using=None, collect_sql=False):
+        self.using = using
+        # Сохранять ли тексты запросов (нужно для поиска дубликатов)
+        self.collect_sql = collect_sql
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+        self._stack = None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+            if self.collect_sql:
+                self.statements.append(sql)
+
+    def __enter__(self):
+        aliases = [self.using] if self.using else list(connections)
+        self._stack = ExitStack()
+        for alias in aliases:
+            self._stack.enter_context(connections[alias].execute_wrapper(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stack.close()
+        self._stack = None
+        return False
+
+
+def duplicate_queries(statements):
+    """
+    Повторяющиеся запросы (одинаковый SQL с разными параметрами - типичный N+1).
+    Возвращает число лишних выполнений и самый частый повторяющийся запрос.
+    """
+    counts = Counter(statements)
+    extra = sum(count - 1 for count in counts.values() if count > 1)
+    most_common = counts.most_common(1)
+    if not extra:
+        return 0, None
+    return extra, most_common[0]
+
+
+class RequestTimings:
+    """Суммарное время по именованным этапам обработки одного запроса."""
+
+    def __init__(self):
+        self.durations = {}
+        self._active = set()
+
+
+_request_timings = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def collect_timings():
+    """Включает сбор времени этапов (``timed``) внутри блока."""
+    timings = RequestTimings()
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+@contextmanager
+def timed(name):
+    """
+    Добавляет время выполнения блока к этапу ``name`` текущего запроса.
+    Вне ``collect_timings`` ничего не делает. Вложенные блоки с тем же именем
+    (например, рекурсивная сериализация) не учитываются дважды.
+    """
+    timings = _request_timings.get()
+    if timings is None or name in timings._active:
+        yield
+        return
+    timings._active.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings._active.discard(name)
+        timings.durations[name] = (
+            timings.durations.get(name, 0.0) + time.perf_counter() - start
+        )
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса за все время его работы, в МБ."""
+    # ru_maxrss в Linux - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(func, trace_memory=False):
+    """
+    Выполняет ``func()`` и возвращает ее результат вместе с метриками:
+    время выполнения, число SQL-запросов, время в БД и память.
+
+    ``rss_growth_mb`` - на сколько шаг поднял пиковый RSS процесса (0, если
+    шаг уложился в память, уже занятую раньше), ``process_peak_rss_mb`` -
+    пик RSS за всю жизнь процесса, включая предыдущие шаги. ``trace_memory``
+    включает tracemalloc (точный пик Python-кучи самого шага, но заметно
+    замедляет выполнение).
+    """
+    rss_before = peak_rss_mb()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with QueryCounter() as queries:
+            result = func()
+        duration = time.perf_counter() - start
+        peak_traced = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    rss_after = peak_rss_mb()
+    metrics = {
+        "seconds": round(duration, 4),
+        "queries": queries.count,
+        "sql_seconds": round(queries.duration, 4),
+        "rss_growth_mb": round(rss_after - rss_before, 1),
+        "process_peak_rss_mb": round(rss_after, 1),
+    }
+    if peak_traced is not None:
+        metrics["peak_traced_mb"] = round(peak_traced / 1024 / 1024, 1)
+    return result, metrics
+
+
+def explain_plan(queryset):
+    """
+    План запроса PostgreSQL (EXPLAIN (FORMAT JSON), без выполнения)
+    в виде дерева словарей. Для других БД возвращает None.
+    """
+    if connections[queryset.db].vendor != "postgresql":
+        return None
+    plan = json.loads(queryset.explain(format="json"))
+    return plan[0]["Plan"]
+
+
+def iter_plan_nodes(plan):
+    """Перебирает все узлы плана запроса."""
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from iter_plan_nodes(child)
+
+
+def sequential_scans(queryset):
+    """Таблицы, которые PostgreSQL читает последовательным сканированием."""
+    plan = explain_plan(queryset)
+    if plan is None:
+        return []
+    return [
+        node.get("Relation Name")
+        for node in iter_plan_nodes(plan)
+        if node["Node Type"] == "Seq Scan"
+    ]
+
+
+def used_indexes(queryset):
+    """Имена индексов, которые PostgreSQL использует в плане запроса."""
+    plan = explain_plan(queryset)
+    if plan is None:
+        return []
+    return [
+        node["Index Name"] for node in iter_plan_nodes(plan) if "Index Name" in node
+    ]
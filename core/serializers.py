@@ -8,13 +8,37 @@ from .models import (
     EquipmentTemplate,
     DamageType,
 )
+from .profiling import timed
+
+# --- Учет времени сериализации (Server-Timing: serialize) ---
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with timed("serialize"):
+            return super().data
+
+
+class TimedSerializerMixin:
+    """
+    Учитывает время сериализации в метриках запроса.
+    Для списков в Meta нужно указать list_serializer_class = TimedListSerializer.
+    """
+
+    @property
+    def data(self):
+        with timed("serialize"):
+            return super().data
+
 
 # --- Базовые сериализаторы ---
 
 
-class GameSystemSerializer(serializers.ModelSerializer):
+class GameSystemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = GameSystem
+        list_serializer_class = TimedListSerializer
         fields = ["id", "name", "version", "slug"]
 
 
@@ -33,12 +57,13 @@ class FeatureSetSerializer(serializers.ModelSerializer):
 # --- Сериализаторы с вложенностью ---
 
 
-class FeatureSerializer(serializers.ModelSerializer):
+class FeatureSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     # Показываем не просто ID, а вложенный объект FeatureSet
     feature_set = FeatureSetSerializer(read_only=True)
 
     class Meta:
         model = Feature
+        list_serializer_class = TimedListSerializer
         # Мы не показываем created_by, так как это внутренняя информация
         fields = ["id", "name", "description", "feature_set", "metadata"]
 
@@ -49,7 +74,7 @@ class TraitCategorySerializer(serializers.ModelSerializer):
         fields = ["id", "name"]
 
 
-class CharacterTraitSerializer(serializers.ModelSerializer):
+class CharacterTraitSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Основной сериализатор для "строительных блоков".
     Он будет рекурсивно показывать своих "детей" (подклассы).
@@ -64,6 +89,7 @@ class CharacterTraitSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = CharacterTrait
+        list_serializer_class = TimedListSerializer
         fields = [
             "id",
             "name",
@@ -83,7 +109,87 @@ class CharacterTraitSerializer(serializers.ModelSerializer):
         return serializer.data
 
 
-class EquipmentTemplateSerializer(serializers.ModelSerializer):
+class EquipmentTemplateSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = EquipmentTemplate
+        list_serializer_class = TimedListSerializer
         fields = ["id", "name", "description", "metadata"]
+
+
+# --- Оптимизатор билдов ---
+
+# Сколько лучших билдов можно запросить за раз
+OPTIMIZER_TOP_LIMIT = 50
+# Сколько статов и уже выбранных черт и предметов можно передать
+OPTIMIZER_ITEM_LIMIT = 200
+
+
+class OptimizeBuildRequestSerializer(serializers.Serializer):
+    target = serializers.CharField(
+        max_length=100, help_text="Вычисляемый стат из схемы системы, например evasion"
+    )
+    direction = serializers.ChoiceField(
+        choices=["max", "min"],
+        default="max",
+        help_text="Максимизировать или минимизировать",
+    )
+    top = serializers.IntegerField(
+        min_value=1, max_value=OPTIMIZER_TOP_LIMIT, default=5
+    )
+    stats = serializers.DictField(
+        child=serializers.IntegerField(),
+        default=dict,
+        help_text='Значения обычных статов для формул, например {"level": 5}',
+    )
+    traits = serializers.ListField(
+        child=serializers.IntegerField(),
+        default=list,
+        max_length=OPTIMIZER_ITEM_LIMIT,
+        help_text="ID черт, которые уже выбраны (их категории не перебираются)",
+    )
+    equipment = serializers.ListField(
+        child=serializers.IntegerField(),
+        default=list,
+        max_length=OPTIMIZER_ITEM_LIMIT,
+        help_text="ID шаблонов экипировки, которые уже выбраны (по слоту metadata.location)",
+    )
+
+    def validate_stats(self, value):
+        if len(value) > OPTIMIZER_ITEM_LIMIT:
+            raise serializers.ValidationError(
+                f"At most {OPTIMIZER_ITEM_LIMIT} stats per request"
+            )
+        return value
+
+
+class BuildTraitSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    category = serializers.CharField()
+
+
+class BuildEquipmentSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    location = serializers.CharField()
+
+
+class BuildSerializer(serializers.Serializer):
+    value = serializers.IntegerField(help_text="Значение целевого стата")
+    stats = serializers.DictField(
+        child=serializers.IntegerField(),
+        help_text="Цель и вычисляемые статы, от которых она зависит",
+    )
+    traits = BuildTraitSerializer(many=True)
+    equipment = BuildEquipmentSerializer(many=True)
+
+
+class OptimizeBuildSerializer(serializers.Serializer):
+    target = serializers.CharField()
+    direction = serializers.CharField()
+    candidates = serializers.IntegerField(help_text="Допустимых комбинаций всего")
+    evaluated = serializers.IntegerField(
+        help_text="Сколько комбинаций вычислено после отсечения по оценкам"
+    )
+    seconds = serializers.FloatField()
+    builds = BuildSerializer(many=True)
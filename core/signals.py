@@ -0,0 +1,71 @@
+"""
+Сигналы, поддерживающие GameSystem.catalog_version и rules_version в актуальном
+состоянии при правках каталога через админку или API. Загрузчик сидов пишет
+пакетами (bulk-операции сигналов не вызывают) и увеличивает версии сам.
+"""
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import (
+    GameSystem,
+    TraitCategory,
+    CharacterTrait,
+    DamageType,
+    FeatureSet,
+    Feature,
+    EquipmentTemplate,
+)
+
+CATALOG_MODELS = (
+    TraitCategory,
+    CharacterTrait,
+    DamageType,
+    FeatureSet,
+    Feature,
+    EquipmentTemplate,
+)
+
+# Модели, строки которых входят в снапшот правил: их изменение увеличивает
+# и rules_version. Особенности в снапшот не попадают, но удаление особенности
+# (или набора вместе с особенностями) убирает ее из feature_ids черт.
+RULES_MODELS = (TraitCategory, CharacterTrait, EquipmentTemplate)
+RULES_DELETE_MODELS = RULES_MODELS + (FeatureSet, Feature)
+
+
+def catalog_changed(sender, instance, **kwargs):
+    if kwargs.get("raw"):
+        # Загрузка фикстур: системы может еще не быть
+        return
+    if kwargs["signal"] is post_delete:
+        rules = sender in RULES_DELETE_MODELS
+    else:
+        rules = sender in RULES_MODELS
+    GameSystem.bump_catalog_version(instance.system_id, rules=rules)
+
+
+for model in CATALOG_MODELS:
+    post_save.connect(
+        catalog_changed, sender=model, dispatch_uid=f"catalog-save-{model.__name__}"
+    )
+    post_delete.connect(
+        catalog_changed, sender=model, dispatch_uid=f"catalog-delete-{model.__name__}"
+    )
+
+
+@receiver(m2m_changed, sender=CharacterTrait.features.through)
+def trait_features_changed(sender, instance, action, **kwargs):
+    # instance - это черта или особенность (при изменении с обратной стороны),
+    # у обеих есть system_id
+    if action in ("post_add", "post_remove", "post_clear"):
+        GameSystem.bump_catalog_version(instance.system_id)
+
+
+@receiver(post_save, sender=GameSystem)
+def system_rules_changed(sender, instance, created, update_fields, raw, **kwargs):
+    if created or raw:
+        return
+    if update_fields is None or "metadata" in update_fields:
+        GameSystem.bump_catalog_version(instance.pk)
+        instance.catalog_version += 1
+        instance.rules_version += 1
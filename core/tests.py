@@ -1,3 +1,980 @@
-# from django.test import TestCase
+import copy
+import io
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import Counter
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from rest_framework.views import APIView
+
+from core import db_router, loadtest
+from core.admin import HighVolumeAdmin
+from core.benchmarks import compare
+from core.engine import dice, optimizer, registry
+from core.engine.parser import FormulaError, compile_formula, evaluate_ast
+from core.engine.snapshot import SystemSnapshot, build_snapshot, snapshot_path
+from core.loader.loader import SystemLoader
+from core.loader.records import (
+    SeedFormatError,
+    is_ndjson,
+    legacy_data_to_records,
+    write_ndjson_records,
+)
+from core.loader.synthetic import generate_system_records
+from core.log import SamplingFilter
+from core.models import (
+    CharacterTrait,
+    EquipmentTemplate,
+    Feature,
+    GameSystem,
+    TraitCategory,
+)
+from core import pagination
+from core.pagination import EstimatedCountPaginator
+from core.profiling import measure, peak_rss_mb, sequential_scans, used_indexes
+
+
+def load_synthetic_system(slug, **options):
+    """Загружает сгенерированную систему через обычный загрузчик сидов."""
+    params = {"features": 500, "traits": 600, "equipment": 200, "formulas": 10}
+    params.update(options)
+    with transaction.atomic():
+        report = SystemLoader().load(generate_system_records(slug=slug, **params))
+    return report.system
+
+
+SEED = {
+    "system": {"name": "Seed", "version": "1.0", "slug": "seed", "metadata": {}},
+    "trait_categories": ["Class", "Subclass"],
+    "damage_types": ["Physical"],
+    "feature_sets": [{"name": "Blade", "set_type": "domain"}],
+    "equipment_templates": [
+        {"name": "Leather", "metadata": {"location": "armor", "score": 3}},
+        {"name": "Chainmail", "metadata": {"location": "armor", "score": 4}},
+    ],
+    "features": [
+        {"name": "Get Back Up", "feature_set": "Blade"},
+        {"name": "Not Good Enough", "feature_set": "Blade"},
+    ],
+    "character_traits": [
+        {
+            "name": "Guardian",
+            "category": "Class",
+            "metadata": {"base_hp": 7},
+            "features": ["Get Back Up"],
+        },
+        {"name": "Stalwart", "category": "Subclass", "parent": "Guardian"},
+    ],
+}
+
+
+def catalog_rows(slug):
+    """Содержимое каталога системы без ID: для сравнения двух загрузок."""
+    system = GameSystem.objects.get(slug=slug)
+    return {
+        "system": (system.version, system.metadata),
+        "categories": sorted(system.trait_categories.values_list("name", flat=True)),
+        "damage_types": sorted(system.damage_types.values_list("name", flat=True)),
+        "feature_sets": sorted(
+            system.feature_sets.values_list("name", "set_type", "description")
+        ),
+        "features": sorted(
+            system.features.values_list(
+                "name", "feature_set__name", "description", "metadata"
+            ),
+            key=repr,
+        ),
+        "traits": sorted(
+            (
+                trait.name,
+                trait.category.name,
+                trait.parent.name if trait.parent else None,
+                sorted(feature.name for feature in trait.features.all()),
+                trait.metadata,
+            )
+            for trait in system.character_traits.select_related(
+                "category", "parent"
+            ).prefetch_related("features")
+        ),
+        "equipment": sorted(
+            system.equipment_templates.values_list("name", "metadata"), key=repr
+        ),
+    }
+
+
+class LoaderTestMixin:
+    """Сиды во временном каталоге и их загрузка командой load_system_data."""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write_seed(self, name, data=SEED):
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            if is_ndjson(path):
+                write_ndjson_records(legacy_data_to_records(data), f)
+            else:
+                json.dump(data, f)
+        return path
+
+    def load(self, *paths, **options):
+        out = io.StringIO()
+        call_command(
+            "load_system_data", *paths, workers=1, stdout=out, stderr=out, **options
+        )
+        return out.getvalue()
+
+
+class LoaderTests(LoaderTestMixin, TestCase):
+    def test_ndjson_and_legacy_json_load_the_same_rows(self):
+        ndjson = copy.deepcopy(SEED)
+        ndjson["system"].update(name="Seed NDJSON", slug="seed-ndjson")
+        self.load(self.write_seed("seed.json"), self.write_seed("seed.ndjson", ndjson))
+
+        legacy = catalog_rows("seed")
+        self.assertEqual(catalog_rows("seed-ndjson"), legacy)
+        self.assertEqual(len(legacy["traits"]), 2)
+        self.assertEqual(legacy["traits"][0][3], ["Get Back Up"])
+
+    def test_reload_reports_only_changed_rows(self):
+        self.load(self.write_seed("seed.json"))
+        changed = copy.deepcopy(SEED)
+        changed["features"][1]["description"] = "Reroll a die."
+        changed["equipment_templates"].append(
+            {"name": "Full Plate", "metadata": {"location": "armor", "score": 6}}
+        )
+        changed["character_traits"][0]["metadata"] = {"base_hp": 8}
+
+        output = self.load(self.write_seed("seed.json", changed))
+        for line in (
+            "Trait Categories: 0 created, 0 updated, 2 unchanged, 0 deleted",
+            "Features: 0 created, 1 updated, 1 unchanged, 0 deleted",
+            "Equipment Templates: 1 created, 0 updated, 2 unchanged, 0 deleted",
+            "Character Traits: 0 created, 1 updated, 1 unchanged, 0 deleted",
+        ):
+            self.assertIn(line, output)
+        guardian = CharacterTrait.objects.get(name="Guardian")
+        self.assertEqual(guardian.metadata, {"base_hp": 8})
+        # Связи измененной черты пересобраны, у неизменной - сохранены
+        self.assertEqual(
+            list(guardian.features.values_list("name", flat=True)), ["Get Back Up"]
+        )
+        self.assertEqual(CharacterTrait.objects.get(name="Stalwart").parent, guardian)
+        self.assertIn(
+            "seed is unchanged", self.load(self.write_seed("seed.json", changed))
+        )
+
+    def test_failed_seed_does_not_roll_back_the_others(self):
+        broken = copy.deepcopy(SEED)
+        broken["system"].update(name="Broken", slug="broken")
+        broken["character_traits"][1]["category"] = "Ancestry"
+        paths = [
+            self.write_seed("a.json", broken),
+            self.write_seed("b.ndjson"),
+        ]
+        with self.assertRaisesMessage(CommandError, "1 of 2 seeds failed to load"):
+            self.load(*paths)
+
+        self.assertEqual(len(catalog_rows("seed")["traits"]), 2)
+        # Упавший сид откатился целиком, вместе с записью системы
+        self.assertFalse(GameSystem.objects.filter(slug="broken").exists())
+        self.assertFalse(Feature.objects.filter(system__slug="broken").exists())
+
+    def test_duplicate_names_are_rejected(self):
+        for section, item in (
+            ("features", {"name": "Get Back Up", "feature_set": "Blade"}),
+            ("equipment_templates", {"name": "Leather"}),
+            ("character_traits", {"name": "Stalwart", "category": "Subclass"}),
+        ):
+            with self.subTest(section=section):
+                seed = copy.deepcopy(SEED)
+                seed[section].append(item)
+                with self.assertRaises(SeedFormatError), transaction.atomic():
+                    SystemLoader().load(legacy_data_to_records(seed))
+
+    def test_trait_parent_is_resolved_within_category(self):
+        seed = copy.deepcopy(SEED)
+        seed["trait_categories"].append("Ancestry")
+        seed["character_traits"] += [
+            {"name": "Guardian", "category": "Ancestry"},
+            {"name": "Elder", "category": "Ancestry", "parent": "Guardian"},
+        ]
+        with self.assertRaisesMessage(
+            SeedFormatError, "set parent_category"
+        ), transaction.atomic():
+            SystemLoader().load(legacy_data_to_records(seed))
+
+        seed["character_traits"][1]["parent_category"] = "Class"
+        seed["character_traits"][-1]["parent_category"] = "Ancestry"
+        self.load(self.write_seed("seed.json", seed))
+        parents = dict(
+            CharacterTrait.objects.filter(system__slug="seed").values_list(
+                "name", "parent__category__name"
+            )
+        )
+        self.assertEqual(parents["Stalwart"], "Class")
+        self.assertEqual(parents["Elder"], "Ancestry")
+
+    def test_prune_runs_on_unchanged_seed(self):
+        self.load(self.write_seed("seed.json"))
+        smaller = copy.deepcopy(SEED)
+        smaller["features"].pop()
+        path = self.write_seed("seed.json", smaller)
+
+        self.assertIn("1 stale", self.load(path))
+        # Сид не изменился с прошлой загрузки, но prune все равно ищет
+        # устаревшие строки - и не переписывает остальные
+        output = self.load(path, prune=True)
+        self.assertIn("Features: 0 created, 0 updated, 1 unchanged, 1 deleted", output)
+        self.assertFalse(Feature.objects.filter(name="Not Good Enough").exists())
+        self.assertIn(
+            "Features: 0 created, 0 updated, 1 unchanged, 0 deleted",
+            self.load(path, prune=True),
+        )
+
+
+class RulesVersionTests(LoaderTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.load(self.write_seed("seed.json"))
+        self.system = GameSystem.objects.get(slug="seed")
+
+    def rules(self):
+        self.system.refresh_from_db()
+        return registry.get_rules(self.system)
+
+    def test_feature_edit_keeps_rules(self):
+        with override_settings(RULES_SNAPSHOT_DIR=self.directory):
+            build_snapshot(self.system, snapshot_path(self.directory, "seed"))
+            rules = self.rules()
+            self.assertIsInstance(rules, SystemSnapshot)
+
+            catalog_version = self.system.catalog_version
+            feature = Feature.objects.get(name="Not Good Enough")
+            feature.description = "Reroll a die."
+            feature.save()
+            self.assertIs(self.rules(), rules)
+            # Индексы каталога (доступные особенности) все равно пересобираются
+            self.assertEqual(self.system.catalog_version, catalog_version + 1)
+
+            trait = CharacterTrait.objects.get(name="Guardian")
+            trait.metadata = {"base_hp": 8}
+            trait.save()
+            self.assertIsNot(self.rules(), rules)
+
+    def test_feature_delete_changes_rules(self):
+        rules = self.rules()
+        Feature.objects.filter(name="Get Back Up").delete()
+        rules_after = self.rules()
+        self.assertIsNot(rules_after, rules)
+        guardian = CharacterTrait.objects.get(name="Guardian")
+        self.assertEqual(rules_after.trait(guardian.pk)["feature_ids"], [])
+
+    def test_loader_bumps_rules_only_for_rule_data(self):
+        rules_version = self.system.rules_version
+        changed = copy.deepcopy(SEED)
+        changed["features"][0]["description"] = "Clear a stress."
+        self.load(self.write_seed("seed.json", changed))
+        self.system.refresh_from_db()
+        self.assertEqual(self.system.rules_version, rules_version)
+
+        changed["equipment_templates"][0]["metadata"]["score"] = 2
+        self.load(self.write_seed("seed.json", changed))
+        self.system.refresh_from_db()
+        self.assertEqual(self.system.rules_version, rules_version + 1)
+
+
+class SnapshotTests(LoaderTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        registry.clear()
+        self.addCleanup(registry.clear)
+        seed = copy.deepcopy(SEED)
+        seed["system"]["metadata"] = {
+            "character_sheet_schema": {
+                "computed_stats": {
+                    "hp": {"formula": "trait_meta('Class', 'base_hp') + stat('level')"},
+                    "broken": {"formula": "stat("},
+                }
+            }
+        }
+        self.load(self.write_seed("seed.json", seed))
+        self.system = GameSystem.objects.get(slug="seed")
+        self.path = snapshot_path(self.directory, "seed")
+        build_snapshot(self.system, self.path)
+
+    def test_round_trip_matches_database_rules(self):
+        snapshot = SystemSnapshot(self.path)
+        self.addCleanup(snapshot.close)
+        rules = registry.DatabaseRules(self.system)
+
+        self.assertEqual(
+            (snapshot.system_id, snapshot.slug, snapshot.rules_version),
+            (self.system.pk, "seed", self.system.rules_version),
+        )
+        formula = "trait_meta('Class', 'base_hp') + stat('level')"
+        self.assertEqual(snapshot.formulas[formula], compile_formula(formula))
+        # Ошибочная формула не попадает в снапшот, ее сообщит движок
+        self.assertNotIn("stat(", snapshot.formulas)
+        self.assertEqual(snapshot.categories, rules.categories)
+        for category in ("Class", "subclass", "Ancestry"):
+            self.assertEqual(
+                snapshot.traits_in_category(category),
+                rules.traits_in_category(category),
+            )
+        for trait in CharacterTrait.objects.filter(system=self.system):
+            self.assertEqual(snapshot.trait(trait.pk), rules.trait(trait.pk))
+        for template in EquipmentTemplate.objects.filter(system=self.system):
+            self.assertEqual(
+                snapshot.equipment_template(template.pk),
+                rules.equipment_template(template.pk),
+            )
+        self.assertIsNone(snapshot.trait(0))
+
+    def test_registry_drops_stale_snapshot(self):
+        with override_settings(RULES_SNAPSHOT_DIR=self.directory):
+            self.assertIsInstance(registry.get_rules(self.system), SystemSnapshot)
+
+            TraitCategory.objects.create(system=self.system, name="Ancestry")
+            self.system.refresh_from_db()
+            rules = registry.get_rules(self.system)
+            self.assertIsInstance(rules, registry.DatabaseRules)
+            self.assertIn("ancestry", rules.categories)
+
+            # Пересобранный снапшот снова подхватывается
+            build_snapshot(self.system, self.path)
+            registry.clear()
+            self.assertIsInstance(registry.get_rules(self.system), SystemSnapshot)
+
+
+class HighVolumeAdminTests(LoaderTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.load(self.write_seed("seed.json"))
+        self.system = GameSystem.objects.get(slug="seed")
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@example.com", "password")
+        )
+
+    def changelist_url(self, model_admin):
+        opts = model_admin.model._meta
+        return f"/admin/{opts.app_label}/{opts.model_name}/"
+
+    def test_changelists_render(self):
+        high_volume = [
+            model_admin
+            for model_admin in admin.site._registry.values()
+            if isinstance(model_admin, HighVolumeAdmin)
+        ]
+        self.assertGreaterEqual(len(high_volume), 8)
+        for model_admin in high_volume:
+            url = self.changelist_url(model_admin)
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertIsInstance(
+                    response.context["cl"].paginator, EstimatedCountPaginator
+                )
+        response = self.client.get(
+            "/admin/core/charactertrait/", {"system__id__exact": self.system.pk}
+        )
+        self.assertContains(response, "Stalwart")
+
+    def test_trait_changelist_queries_do_not_grow_with_rows(self):
+        url = "/admin/core/charactertrait/"
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        category = TraitCategory.objects.get(system=self.system, name="Subclass")
+        guardian = CharacterTrait.objects.get(name="Guardian")
+        for index in range(20):
+            CharacterTrait.objects.create(
+                system=self.system,
+                category=category,
+                name=f"Subclass {index}",
+                parent=guardian,
+            )
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        self.assertContains(response, "Subclass 19")
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.system = GameSystem.objects.create(name="Paged", version="1", slug="paged")
+        TraitCategory.objects.bulk_create(
+            TraitCategory(system=cls.system, name=f"Category {index}")
+            for index in range(12)
+        )
+
+    def paginator(self, queryset, threshold=10):
+        return EstimatedCountPaginator(
+            queryset.order_by("id"), 5, exact_count_threshold=threshold
+        )
+
+    def test_exact_count_up_to_threshold(self):
+        queryset = TraitCategory.objects.filter(system=self.system)
+        with mock.patch.object(pagination, "estimate_query_rows") as estimate:
+            paginator = self.paginator(queryset, threshold=12)
+            self.assertEqual(paginator.count, 12)
+        estimate.assert_not_called()
+        self.assertFalse(paginator.count_is_estimate)
+        self.assertEqual(paginator.num_pages, 3)
+
+    def test_estimate_above_threshold(self):
+        queryset = TraitCategory.objects.filter(system=self.system)
+        with mock.patch.object(pagination, "estimate_query_rows", return_value=40):
+            paginator = self.paginator(queryset)
+            self.assertEqual(paginator.count, 40)
+        self.assertTrue(paginator.count_is_estimate)
+
+        # Заниженная оценка не опускает счетчик ниже уже подсчитанных строк
+        with mock.patch.object(pagination, "estimate_query_rows", return_value=3):
+            paginator = self.paginator(queryset)
+            self.assertEqual(paginator.count, 11)
+        self.assertTrue(paginator.count_is_estimate)
+
+    def test_exact_count_without_estimate(self):
+        # Не PostgreSQL: оценить нечем, строки считаются точно
+        paginator = self.paginator(TraitCategory.objects.filter(system=self.system))
+        self.assertEqual(paginator.count, 12)
+        self.assertFalse(paginator.count_is_estimate)
+
+    def test_unfiltered_table_uses_table_statistics(self):
+        with mock.patch.object(pagination, "estimate_table_rows", return_value=50000):
+            paginator = self.paginator(TraitCategory.objects.all())
+            self.assertEqual(paginator.count, 50000)
+        self.assertTrue(paginator.count_is_estimate)
+
+        # Маленькой оценке не доверяем
+        with mock.patch.object(pagination, "estimate_table_rows", return_value=5):
+            paginator = self.paginator(TraitCategory.objects.all(), threshold=20)
+            self.assertEqual(paginator.count, 12)
+        self.assertFalse(paginator.count_is_estimate)
+
+    def test_api_reports_count_is_estimate(self):
+        response = self.client.get("/api/v1/systems/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            (response.json()["count"], response.json()["count_is_estimate"]),
+            (1, False),
+        )
+        with mock.patch.object(
+            EstimatedCountPaginator, "exact_count_threshold", 0
+        ), mock.patch.object(pagination, "estimate_table_rows", return_value=1500):
+            data = self.client.get("/api/v1/systems/").json()
+        self.assertEqual((data["count"], data["count_is_estimate"]), (1500, True))
+
+
+@skipUnless(connection.vendor == "postgresql", "EXPLAIN-тесты требуют PostgreSQL")
+class QueryPlanTestCase(TestCase):
+    """
+    Базовый класс для проверки планов "горячих" запросов.
+    Последовательное сканирование запрещается планировщику (enable_seqscan=off):
+    если для запроса есть подходящий индекс, в плане не будет Seq Scan,
+    а если индекса нет - Seq Scan останется, и тест упадет.
+
+    Отсутствие Seq Scan ничего не говорит о том, какой индекс выбран: запрос
+    мог пойти и по индексу внешнего ключа. Для запросов, ради которых заведен
+    отдельный индекс, план проверяется на него по имени (``assertUsesIndex``).
+    """
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+            # SET LOCAL действует до конца транзакции теста
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertNoSeqScan(self, queryset):
+        scans = sequential_scans(queryset)
+        self.assertEqual(
+            scans,
+            [],
+            f"Sequential scan on {', '.join(map(str, scans))}:\n{queryset.explain()}",
+        )
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertNoSeqScan(queryset)
+        self.assertIn(
+            index_name,
+            used_indexes(queryset),
+            f"{index_name} is not used:\n{queryset.explain()}",
+        )
+
+
+class CatalogQueryPlanTests(QueryPlanTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.system = load_synthetic_system("plan-a")
+        load_synthetic_system("plan-b", seed=1)
+
+    def test_category_lookup_ignoring_case(self):
+        self.assertUsesIndex(
+            TraitCategory.objects.filter(system=self.system, name__iexact="class"),
+            "core_traitcat_upper_name_idx",
+        )
+
+    def test_root_traits_by_category(self):
+        # Запрос из CharacterTraitViewSet.get_queryset с ?category=
+        self.assertUsesIndex(
+            CharacterTrait.objects.filter(
+                system=self.system,
+                category__name__iexact="class",
+                parent__isnull=True,
+            ),
+            "core_traitcat_upper_name_idx",
+        )
+
+    def test_system_by_slug(self):
+        self.assertNoSeqScan(GameSystem.objects.filter(slug="plan-a"))
+
+
+class ReplicaProbeView(db_router.ReplicaReadMixin, APIView):
+    """Сообщает, разрешено ли чтение с реплик во время обработки запроса."""
+
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        return Response({"replica": db_router._read_from_replica.get()})
+
+    def post(self, request):
+        return Response({"replica": db_router._read_from_replica.get()})
+
+
+@override_settings(
+    REPLICA_DATABASES=["replica_0"],
+    REPLICA_MAX_LAG_SECONDS=None,
+    REPLICA_PIN_SECONDS=5,
+)
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = db_router.ReplicaRouter()
+        self.factory = APIRequestFactory()
+        db_router.clear_lag_checks()
+
+    def test_reads_use_primary_by_default(self):
+        self.assertIsNone(self.router.db_for_read(GameSystem))
+
+    def test_app_reads_use_replica_when_enabled(self):
+        with db_router.replica_reads():
+            self.assertEqual(self.router.db_for_read(GameSystem), "replica_0")
+            # Сессии и пользователи всегда читаются с основной БД
+            self.assertIsNone(self.router.db_for_read(User))
+
+    def test_writes_and_migrations_use_primary(self):
+        with db_router.replica_reads():
+            self.assertEqual(self.router.db_for_write(GameSystem), "default")
+        self.assertTrue(self.router.allow_migrate("default", "core"))
+        self.assertFalse(self.router.allow_migrate("replica_0", "core"))
+
+    @override_settings(REPLICA_MAX_LAG_SECONDS=2)
+    def test_lagging_replica_is_skipped(self):
+        with mock.patch.object(db_router, "replica_lag", return_value=10):
+            with db_router.replica_reads():
+                self.assertIsNone(self.router.db_for_read(GameSystem))
+
+    @override_settings(REPLICA_MAX_LAG_SECONDS=2)
+    def test_lag_check_is_cached(self):
+        with mock.patch.object(db_router, "replica_lag", return_value=0) as lag:
+            with db_router.replica_reads():
+                for _ in range(3):
+                    self.assertEqual(self.router.db_for_read(GameSystem), "replica_0")
+        self.assertEqual(lag.call_count, 1)
+
+    def test_safe_requests_read_from_replica(self):
+        response = ReplicaProbeView.as_view()(self.factory.get("/"))
+        self.assertTrue(response.data["replica"])
+
+    def test_write_pins_client_to_primary(self):
+        response = ReplicaProbeView.as_view()(self.factory.post("/"))
+        self.assertFalse(response.data["replica"])
+        self.assertIn(db_router.PIN_COOKIE, response.cookies)
+
+        request = self.factory.get("/")
+        request.COOKIES[db_router.PIN_COOKIE] = "1"
+        response = ReplicaProbeView.as_view()(request)
+        self.assertFalse(response.data["replica"])
+
+
+class HealthCheckTests(TestCase):
+    def test_live(self):
+        response = self.client.get("/health/live/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_ready_checks_database(self):
+        response = self.client.get("/health/ready/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["checks"]["database"]["ok"])
+
+    @override_settings(RULES_SNAPSHOT_PRELOAD=True, RULES_SNAPSHOT_DIR="/snapshots")
+    def test_not_ready_while_snapshots_are_not_loaded(self):
+        with mock.patch(
+            "core.health.glob.glob", return_value=["/snapshots/missing.snapshot"]
+        ):
+            response = self.client.get("/health/ready/")
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()["checks"]["rules"]["ok"])
+
+
+class PerformanceMiddlewareTests(TestCase):
+    def test_server_timing_header(self):
+        response = self.client.get("/api/v1/systems/")
+        self.assertIn('sql;desc="', response["Server-Timing"])
+        self.assertIn("serialize;dur=", response["Server-Timing"])
+
+    def test_profile_requires_token(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            PERFORMANCE_PROFILE_TOKEN="secret", PERFORMANCE_PROFILE_DIR=directory
+        ):
+            response = self.client.get("/api/v1/systems/", HTTP_X_PROFILE="wrong")
+            self.assertNotIn("X-Profile-File", response)
+
+            response = self.client.get("/api/v1/systems/", HTTP_X_PROFILE="secret")
+            self.assertTrue(
+                os.path.exists(os.path.join(directory, response["X-Profile-File"]))
+            )
+
+
+class MetricsEndpointTests(TestCase):
+    def test_request_metrics_labelled_by_action(self):
+        self.client.get("/api/v1/systems/")
+        response = self.client.get("/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            'ttrpg_http_requests_total{action="list",method="GET",status="2xx"',
+            response.content.decode(),
+        )
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token_required(self):
+        self.assertEqual(self.client.get("/metrics/").status_code, 403)
+        response = self.client.get("/metrics/", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+
+
+class SamplingFilterTests(SimpleTestCase):
+    def test_samples_only_below_min_level(self):
+        sampling = SamplingFilter(rate=0)
+        debug = logging.makeLogRecord({"levelno": logging.DEBUG})
+        warning = logging.makeLogRecord({"levelno": logging.WARNING})
+        self.assertFalse(sampling.filter(debug))
+        self.assertTrue(sampling.filter(warning))
+        self.assertTrue(SamplingFilter(rate=1).filter(debug))
+
+
+class BenchmarkTests(TestCase):
+    def test_suite_runs_and_rolls_back(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            call_command(
+                "run_benchmarks",
+                "--scenario=recalc",
+                "--repeat=1",
+                "--scale=0.05",
+                f"--output={output.name}",
+                stdout=io.StringIO(),
+            )
+            results = json.load(output)
+        self.assertEqual(
+            [result["name"] for result in results["results"]],
+            ["recalc.small", "recalc.medium", "recalc.large"],
+        )
+        self.assertFalse(GameSystem.objects.filter(slug="benchmark").exists())
+
+    def test_measure_reports_rss_growth_of_the_step(self):
+        # Пик процесса уже набран раньше: пустой шаг его не поднимает
+        result, metrics = measure(lambda: GameSystem.objects.count())
+        self.assertEqual(result, 0)
+        self.assertEqual(metrics["queries"], 1)
+        self.assertEqual(metrics["rss_growth_mb"], 0)
+        self.assertEqual(metrics["process_peak_rss_mb"], round(peak_rss_mb(), 1))
+
+    def test_compare_flags_slowdown_and_extra_queries(self):
+        baseline = {
+            "results": [
+                {"name": "fast", "median_ms": 1.0, "queries": 2},
+                {"name": "slow", "median_ms": 1.0, "queries": 2},
+            ]
+        }
+        results = {
+            "results": [
+                {"name": "fast", "median_ms": 1.1, "queries": 2},
+                {"name": "slow", "median_ms": 1.5, "queries": 3},
+                {"name": "new", "median_ms": 9.0, "queries": 9},
+            ]
+        }
+        regressions = compare(results, baseline, tolerance=0.2)
+        self.assertEqual([name for name, _ in regressions], ["slow", "slow"])
+
+
+class LoadTestReportTests(SimpleTestCase):
+    def test_percentiles_per_endpoint(self):
+        stats = loadtest.LatencyStats()
+        for index in range(100):
+            stats.record("GET /sheets/{id}/", (index + 1) / 1000, ok=index != 0)
+        (row,) = stats.summary(elapsed=10)["endpoints"]
+        self.assertEqual(row["requests"], 100)
+        self.assertEqual(row["errors"], 1)
+        self.assertEqual(row["rps"], 10)
+        self.assertEqual((row["p50_ms"], row["p95_ms"], row["p99_ms"]), (51, 96, 100))
+
+    def test_parse_mix(self):
+        self.assertEqual(
+            loadtest.parse_mix("poll=5,patch"), {"poll": 5.0, "patch": 1.0}
+        )
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix("dance=1")
+
+
+class FormulaParserTests(SimpleTestCase):
+    def evaluate(self, formula, **stats):
+        return evaluate_ast(compile_formula(formula), lambda name, args: stats[args[0]])
+
+    def test_precedence_and_associativity(self):
+        for formula, expected in (
+            ("2 + 3 * 4", 14),
+            ("(2 + 3) * 4", 20),
+            ("10 - 4 - 3", 3),
+            ("12 / 3 / 2", 2),
+            ("7 / 2 * 2", 6),
+            ("2 * (3 + stat('level')) - 1", 15),
+        ):
+            with self.subTest(formula=formula):
+                self.assertEqual(self.evaluate(formula, level=5), expected)
+
+    def test_unary_minus(self):
+        self.assertEqual(compile_formula("-3"), ("num", -3))
+        self.assertEqual(self.evaluate("--3"), 3)
+        self.assertEqual(self.evaluate("-(2 + 3) * 2"), -10)
+        self.assertEqual(self.evaluate("4 - -stat('level')", level=2), 6)
+        self.assertEqual(self.evaluate("2 * -stat('level')", level=4), -8)
+
+    def test_division(self):
+        # Деление целочисленное, с округлением вниз
+        self.assertEqual(self.evaluate("7 / 2"), 3)
+        self.assertEqual(self.evaluate("-7 / 2"), -4)
+        for formula in ("1 / 0", "5 / (stat('level') - 2)"):
+            with self.subTest(formula=formula):
+                with self.assertRaisesMessage(FormulaError, "Division by zero"):
+                    self.evaluate(formula, level=2)
+
+    def test_invalid_formulas(self):
+        for formula in ("", "2 +", "(1", "1 2", "eval(1)", "stat(level)", "stat()"):
+            with self.subTest(formula=formula):
+                with self.assertRaises(FormulaError):
+                    compile_formula(formula)
+
+
+class DiceTests(SimpleTestCase):
+    def test_keep_highest_matches_enumeration(self):
+        outcomes = Counter(
+            sum(sorted(rolled)[1:])
+            for rolled in itertools.product(range(1, 7), repeat=4)
+        )
+        expected = {total: ways / 6**4 for total, ways in outcomes.items()}
+        actual = dice.distribution(dice.compile_dice("4d6kh3")).as_dict()
+        self.assertEqual(expected.keys(), actual.keys())
+        for total, probability in expected.items():
+            self.assertAlmostEqual(actual[total], probability)
+
+    def test_bind_and_threshold(self):
+        node = dice.bind(
+            dice.compile_dice("2d12 + stat('agility') - 1"), lambda name, args: 3
+        )
+        self.assertEqual(dice.to_string(node), "2d12 + 3 - 1")
+        outcome = dice.distribution(node)
+        self.assertEqual((outcome.min, outcome.max), (4, 26))
+        self.assertAlmostEqual(outcome.at_least(26), 1 / 144)
+        self.assertEqual(outcome.at_least(4), 1.0)
+
+    def test_vectorized_rolls_stay_in_range(self):
+        rolls = dice.roll(
+            dice.compile_dice("2d20kl1 + 5"), 1000, np.random.default_rng(0)
+        )
+        self.assertEqual(rolls.shape, (1000,))
+        self.assertTrue(((rolls >= 6) & (rolls <= 25)).all())
+
+    def test_keep_work_is_limited(self):
+        # Самая дорогая допустимая группа kh/kl считается быстро
+        start = time.perf_counter()
+        dice.distribution(dice.compile_dice("12d62kh6"))
+        self.assertLess(time.perf_counter() - start, 2)
+        for expression in (
+            "12d63kh6",
+            "12d833kh6",
+            "12d40kh6 + 12d40kl6 + 12d40kh5",
+        ):
+            with self.subTest(expression=expression):
+                with self.assertRaises(dice.DiceError):
+                    dice.compile_dice(expression)
+
+    def test_expression_size_is_limited(self):
+        # Самое дорогое допустимое выражение считается быстро
+        start = time.perf_counter()
+        dice.distribution(dice.compile_dice("100d100 + 100d100 - 10"))
+        self.assertLess(time.perf_counter() - start, 2)
+        for expression in (
+            "+".join(["100d100"] * 24),
+            "100d100 + 100d100 + d2",
+            "+".join(["d6"] * 21),
+        ):
+            with self.subTest(expression=expression):
+                with self.assertRaises(dice.DiceError):
+                    dice.compile_dice(expression)
+
+    def test_invalid_expressions(self):
+        for expression in ("2d6 * 3", "d6kh2", "2d0", "roll(1)", "50d1000"):
+            with self.subTest(expression=expression):
+                with self.assertRaises(dice.DiceError):
+                    dice.compile_dice(expression)
+
+
+class OptimizerTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.system = GameSystem.objects.create(
+            name="Optimizer",
+            slug="optimizer",
+            metadata={
+                "character_sheet_schema": {
+                    "computed_stats": {
+                        "evasion": {
+                            "formula": "trait_meta('Class', 'evasion') "
+                            "+ trait_meta('Subclass', 'bonus') "
+                            "+ equipment_meta('armor', 'penalty')"
+                        },
+                        "max_hp": {
+                            "formula": "trait_meta('Class', 'hp') + stat('level')"
+                        },
+                    }
+                }
+            },
+        )
+        category = TraitCategory.objects.create(system=cls.system, name="Class")
+        subclass = TraitCategory.objects.create(system=cls.system, name="Subclass")
+        classes = {
+            name: CharacterTrait.objects.create(
+                system=cls.system, category=category, name=name, metadata=metadata
+            )
+            for name, metadata in (
+                ("Guardian", {"evasion": 8, "hp": 12}),
+                ("Rogue", {"evasion": 11, "hp": 6}),
+            )
+        }
+        for name, parent, bonus in (
+            ("Stalwart", "Guardian", 3),
+            ("Nightwalker", "Rogue", 1),
+            ("Syndicate", "Rogue", 0),
+        ):
+            CharacterTrait.objects.create(
+                system=cls.system,
+                category=subclass,
+                name=name,
+                parent=classes[parent],
+                metadata={"bonus": bonus},
+            )
+        for name, penalty in (("Leather", 0), ("Chainmail", -1), ("Gambeson", 1)):
+            EquipmentTemplate.objects.create(
+                system=cls.system,
+                name=name,
+                metadata={"location": "armor", "penalty": penalty},
+            )
+        cls.system.refresh_from_db()
+
+    def test_subclass_must_match_class(self):
+        catalog = optimizer.get_catalog(self.system)
+        problem = optimizer.Problem(catalog, "evasion")
+        # 3 пары класс-подкласс (а не 2 * 3) на 3 доспеха
+        self.assertEqual(problem.candidates, 9)
+
+        result = optimizer.optimize(problem, catalog, top=3)
+        self.assertEqual([build["value"] for build in result["builds"]], [13, 12, 12])
+        best = result["builds"][0]
+        self.assertEqual(
+            [trait["name"] for trait in best["traits"]], ["Rogue", "Nightwalker"]
+        )
+        self.assertEqual(best["equipment"][0]["name"], "Gambeson")
+
+        problem = optimizer.Problem(catalog, "max_hp", stats={"level": 3})
+        result = optimizer.optimize(problem, catalog, top=1)
+        self.assertEqual(result["builds"][0]["value"], 15)
+        # Подкласс и доспех на max_hp не влияют и не перебираются
+        self.assertEqual(result["candidates"], 2)
+
+    def test_pruned_search_matches_exhaustive(self):
+        system = load_synthetic_system(
+            "optimizer-synthetic", features=10, traits=60, equipment=40, formulas=6
+        )
+        catalog = optimizer.get_catalog(system)
+        for target, direction in (("computed_0", "max"), ("computed_3", "min")):
+            # Маленький блок: много префиксов, и отсечение действительно работает
+            with mock.patch.object(optimizer, "BLOCK_SIZE", 4):
+                problem = optimizer.Problem(catalog, target, direction=direction)
+                result = optimizer.optimize(problem, catalog, top=5)
+            self.assertLess(result["evaluated"], problem.candidates)
+
+            values = sorted(
+                (
+                    problem.evaluate_build(problem.choices(key))[target]
+                    for key in range(problem.candidates)
+                ),
+                reverse=direction == "max",
+            )
+            self.assertEqual([build["value"] for build in result["builds"]], values[:5])
+
+    def test_api(self):
+        url = f"/api/v1/systems/{self.system.pk}/optimize/"
+        self.assertEqual(self.client.post(url, {"target": "evasion"}).status_code, 403)
+
+        self.client.force_login(User.objects.create(username="optimizer"))
+        response = self.client.post(
+            url, {"target": "evasion", "top": 1}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["builds"][0]["value"], 13)
+        response = self.client.post(
+            url, {"target": "nope"}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_api_limits(self):
+        url = f"/api/v1/systems/{self.system.pk}/optimize/"
+        self.client.force_login(User.objects.create(username="optimizer"))
+        for body in (
+            {"target": "evasion", "traits": list(range(201))},
+            {"target": "evasion", "equipment": list(range(201))},
+            {"target": "evasion", "stats": {f"stat{i}": 1 for i in range(201)}},
+        ):
+            with self.subTest(body=list(body)[-1]):
+                response = self.client.post(url, body, content_type="application/json")
+                self.assertEqual(response.status_code, 400)
+
+        # Перебор сверх лимита отклоняется до начала поиска
+        with override_settings(OPTIMIZER_MAX_CANDIDATES=1), mock.patch.object(
+            optimizer, "optimize"
+        ) as optimize:
+            response = self.client.post(
+                url, {"target": "evasion"}, content_type="application/json"
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("combinations to search", response.json()["target"])
+        optimize.assert_not_called()
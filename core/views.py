@@ -1,19 +1,27 @@
+from django.conf import settings
 from rest_framework import viewsets, permissions
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 
+from .db_router import ReplicaReadMixin
+from .engine import optimizer
 from .models import GameSystem, CharacterTrait, EquipmentTemplate, Feature
 from .serializers import (
     GameSystemSerializer,
     CharacterTraitSerializer,
     EquipmentTemplateSerializer,
     FeatureSerializer,
+    OptimizeBuildRequestSerializer,
+    OptimizeBuildSerializer,
 )
 
 # Мы добавим недостающие ViewSet'ы для полноты картины
 
 
 @extend_schema(tags=["Core - Game Systems"])
-class GameSystemViewSet(viewsets.ReadOnlyModelViewSet):
+class GameSystemViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """
     API эндпоинт для просмотра игровых систем.
     Доступен всем.
@@ -23,9 +31,55 @@ class GameSystemViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = GameSystemSerializer
     permission_classes = [permissions.AllowAny]
 
+    @extend_schema(
+        summary="Лучшие билды для вычисляемого стата",
+        description=(
+            "Перебирает комбинации черт и экипировки, от которых зависит target, "
+            "и возвращает top лучших по значению стата (например, какие класс, "
+            "подкласс и доспех дают максимальное уклонение). Листы не создаются, "
+            "после загрузки каталога БД не используется."
+        ),
+        request=OptimizeBuildRequestSerializer,
+        responses={200: OptimizeBuildSerializer},
+    )
+    @action(
+        detail=True,
+        methods=["post"],
+        permission_classes=[permissions.IsAuthenticated],
+    )
+    def optimize(self, request, pk=None):
+        params = OptimizeBuildRequestSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        params = params.validated_data
+
+        catalog = optimizer.get_catalog(self.get_object())
+        try:
+            problem = optimizer.Problem(
+                catalog,
+                params["target"],
+                direction=params["direction"],
+                stats=params["stats"],
+                traits=params["traits"],
+                equipment=params["equipment"],
+            )
+        except optimizer.OptimizerError as e:
+            raise ValidationError({"target": str(e)})
+        if problem.candidates > settings.OPTIMIZER_MAX_CANDIDATES:
+            raise ValidationError(
+                {
+                    "target": f"{problem.candidates} combinations to search, the "
+                    f"limit is {settings.OPTIMIZER_MAX_CANDIDATES}; fix some "
+                    "traits or equipment"
+                }
+            )
+        result = optimizer.optimize(
+            problem, catalog, top=params["top"], workers=settings.OPTIMIZER_WORKERS
+        )
+        return Response(OptimizeBuildSerializer(result).data)
+
 
 @extend_schema(tags=["Core - Rules"])
-class CharacterTraitViewSet(viewsets.ReadOnlyModelViewSet):
+class CharacterTraitViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """
     API эндпоинт для просмотра "строительных блоков" (классов, рас и т.д.).
     Фильтруется по системе и по категории.
@@ -73,7 +127,7 @@ class CharacterTraitViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 @extend_schema(tags=["Core - Rules"])
-class EquipmentTemplateViewSet(viewsets.ReadOnlyModelViewSet):
+class EquipmentTemplateViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """API эндпоинт для просмотра шаблонов экипировки."""
 
     queryset = EquipmentTemplate.objects.all()
@@ -90,7 +144,7 @@ class EquipmentTemplateViewSet(viewsets.ReadOnlyModelViewSet):
 
 
 @extend_schema(tags=["Core - Rules"])
-class FeatureViewSet(viewsets.ReadOnlyModelViewSet):
+class FeatureViewSet(ReplicaReadMixin, viewsets.ReadOnlyModelViewSet):
     """API эндпоинт для просмотра всех особенностей (Features)."""
 
     queryset = Feature.objects.all()
@@ -0,0 +1,65 @@
+"""
+Конфигурация gunicorn для продакшен-режима.
+
+WSGI (по умолчанию)::
+
+    gunicorn ttrpg_project.wsgi -c gunicorn.conf.py
+
+ASGI (воркеры uvicorn)::
+
+    GUNICORN_WORKER_CLASS=uvicorn_worker.UvicornWorker \\
+        gunicorn ttrpg_project.asgi -c gunicorn.conf.py
+
+Все параметры переопределяются переменными окружения GUNICORN_*.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "sync")
+# Для gthread: потоки внутри воркера (каждому нужно свое соединение с БД)
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# Периодический перезапуск воркеров ограничивает рост памяти;
+# jitter не дает всем воркерам перезапуститься одновременно
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+# Приложение (и снапшоты правил, отображенные в память при старте)
+# загружается в мастер-процессе до fork: страницы снапшотов делятся воркерами
+preload_app = os.environ.get("GUNICORN_PRELOAD", "True") == "True"
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+
+def on_starting(server):
+    # Метрики прошлых запусков в общем каталоге Prometheus больше не актуальны
+    directory = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".db"):
+                os.remove(os.path.join(directory, name))
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    # Соединения с БД, открытые в мастере до fork, не должны
+    # использоваться несколькими процессами одновременно
+    from django.db import connections
+
+    for connection in connections.all(initialized_only=True):
+        connection.close()
@@ -50,6 +50,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    # Время ответа по вью и действию для Prometheus (/metrics/)
+    "core.middleware.MetricsMiddleware",
+    # Метрики запроса в заголовке Server-Timing (SQL, сериализация, пересчет)
+    "core.middleware.PerformanceMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -92,6 +96,51 @@ DATABASES = {
     }
 }
 
+# --- Соединения с БД ---
+# DB_POOL=True включает пул соединений psycopg 3 внутри каждого воркера.
+# Без пула соединения переиспользуются между запросами (CONN_MAX_AGE секунд)
+# и перед переиспользованием проверяются (CONN_HEALTH_CHECKS).
+# Пул и постоянные соединения Django взаимоисключающие.
+DB_POOL = os.environ.get("DB_POOL", "False") == "True"
+if DB_POOL:
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+    DATABASES["default"]["OPTIONS"] = {
+        "pool": {
+            "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", 2)),
+            "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", 10)),
+            # Сколько секунд ждать свободное соединение
+            "timeout": float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        }
+    }
+else:
+    DATABASES["default"]["CONN_MAX_AGE"] = int(os.environ.get("CONN_MAX_AGE", 60))
+    DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+
+# Реплики только для чтения: хосты через запятую, например
+# DATABASE_REPLICAS=replica1,replica2:5433. Каждая становится алиасом replica_N
+# с теми же учетными данными, что и основная БД. В тестах реплики зеркалят default.
+REPLICA_DATABASES = []
+for index, replica in enumerate(
+    host.strip() for host in os.environ.get("DATABASE_REPLICAS", "").split(",")
+):
+    if not replica:
+        continue
+    host, _, port = replica.partition(":")
+    alias = f"replica_{index}"
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "HOST": host,
+        "PORT": int(port or 5432),
+        "TEST": {"MIRROR": "default"},
+    }
+    REPLICA_DATABASES.append(alias)
+
+DATABASE_ROUTERS = ["core.db_router.ReplicaRouter"]
+# Сколько секунд после своей записи клиент читает только с основной БД
+REPLICA_PIN_SECONDS = int(os.environ.get("REPLICA_PIN_SECONDS", 5))
+# Реплика с большим отставанием (в секундах) временно не используется
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 2))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -134,9 +183,24 @@ STATIC_URL = "static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Снапшоты скомпилированных правил и каталогов игровых систем
+# (собираются командой build_system_snapshot, читаются воркерами через mmap)
+RULES_SNAPSHOT_DIR = os.environ.get(
+    "RULES_SNAPSHOT_DIR", str(BASE_DIR / "var" / "snapshots")
+)
+# Отображать все снапшоты в память при старте процесса, а не при первом запросе
+RULES_SNAPSHOT_PRELOAD = os.environ.get("RULES_SNAPSHOT_PRELOAD", "False") == "True"
+
+# Оптимизатор билдов (POST /api/v1/systems/{id}/optimize/): процессов
+# на запрос и предельное число комбинаций, которое API согласен перебирать.
+# Поиск идет прямо в веб-воркере, поэтому лимит рассчитан на доли секунды;
+# большие переборы - через manage.py optimize_build
+OPTIMIZER_WORKERS = int(os.environ.get("OPTIMIZER_WORKERS", 1))
+OPTIMIZER_MAX_CANDIDATES = int(os.environ.get("OPTIMIZER_MAX_CANDIDATES", 500_000))
+
 REST_FRAMEWORK = {
     # Используем пагинацию, чтобы не отдавать тысячи записей за раз
-    "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.PageNumberPagination",
+    "DEFAULT_PAGINATION_CLASS": "core.pagination.EstimatedCountPagination",
     "PAGE_SIZE": 10,  # Количество записей на одной странице
     # Пока разрешим доступ всем для простоты разработки.
     # В будущем здесь будет TokenAuthentication.
@@ -156,3 +220,56 @@ SPECTACULAR_SETTINGS = {
     "VERSION": "1.0.0",
     "SERVE_INCLUDE_SCHEMA": False,  # Не показывать схему по умолчанию в UI
 }
+
+# --- Метрики производительности запросов (core.middleware.PerformanceMiddleware) ---
+PERFORMANCE_METRICS = os.environ.get("PERFORMANCE_METRICS", "True") == "True"
+# С таким числом повторяющихся запросов запрос попадает в лог как подозрение на N+1
+PERFORMANCE_DUPLICATE_QUERY_WARNING = int(
+    os.environ.get("PERFORMANCE_DUPLICATE_QUERY_WARNING", 10)
+)
+# Секрет для заголовка X-Profile; пустое значение отключает профилирование
+PERFORMANCE_PROFILE_TOKEN = os.environ.get("PERFORMANCE_PROFILE_TOKEN", "")
+PERFORMANCE_PROFILE_DIR = os.environ.get(
+    "PERFORMANCE_PROFILE_DIR", str(BASE_DIR / "var" / "profiles")
+)
+
+# --- Метрики Prometheus (core.metrics) ---
+# Для нескольких воркеров задайте переменную окружения PROMETHEUS_MULTIPROC_DIR
+# (общий каталог) до старта процессов.
+# Если задан токен, /metrics/ требует заголовок "Authorization: Bearer <токен>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# --- Логирование ---
+# Трассировка движка правил (формулы, статы до и после пересчета) пишется
+# на уровне DEBUG: включается ENGINE_LOG_LEVEL=DEBUG, а на нагруженном сервере
+# вместе с LOG_SAMPLE_RATE (доля сохраняемых DEBUG/INFO-записей, 0..1).
+# LOG_FORMAT=json - одна JSON-строка на запись с полями из extra=.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+ENGINE_LOG_LEVEL = os.environ.get("ENGINE_LOG_LEVEL", "WARNING")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1))
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "plain")
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "sample": {"()": "core.log.SamplingFilter", "rate": LOG_SAMPLE_RATE},
+    },
+    "formatters": {
+        "plain": {"format": "%(asctime)s %(levelname)s %(name)s: %(message)s"},
+        "json": {"()": "core.log.JsonFormatter"},
+    },
+    "handlers": {
+        "app": {
+            "class": "logging.StreamHandler",
+            "formatter": LOG_FORMAT,
+            "filters": ["sample"],
+        },
+    },
+    "loggers": {
+        "core": {"handlers": ["app"], "level": LOG_LEVEL, "propagate": False},
+        "characters": {"handlers": ["app"], "level": LOG_LEVEL, "propagate": False},
+        "core.engine": {"level": ENGINE_LOG_LEVEL},
+        "characters.services": {"level": ENGINE_LOG_LEVEL},
+    },
+}
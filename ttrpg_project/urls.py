@@ -18,6 +18,8 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from core import health, metrics
+
 # Импортируем вью для генерации схемы и UI
 from drf_spectacular.views import (
     SpectacularAPIView,
@@ -27,9 +29,15 @@ from drf_spectacular.views import (
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    # Проверки состояния для балансировщика и оркестратора
+    path("health/live/", health.live, name="health-live"),
+    path("health/ready/", health.ready, name="health-ready"),
+    path("metrics/", metrics.metrics_view, name="metrics"),
     # Наши основные эндпоинты API
     path("api/v1/", include("core.urls")),
     path("api/v1/", include("characters.urls")),
+    # Вход по сессии для browsable API и нагрузочного теста (run_loadtest)
+    path("api-auth/", include("rest_framework.urls")),
     # --- НОВЫЕ ПУТИ ДЛЯ ДОКУМЕНТАЦИИ ---
     # Эндпоинт, который генерирует сам файл schema.yml
     path("api/schema/", SpectacularAPIView.as_view(), name="schema"),